@@ -5,6 +5,7 @@ import json
 import csv
 import heapq
 import tempfile
+import pickle
 import itertools
 from collections import defaultdict
 from operator import itemgetter
@@ -286,37 +287,53 @@ def groupby(db, table, column, agg):
 
 
 def perform_groupby(filename, group_column, agg, project_columns):
-    # used defaultdict to create a dict w/o key existing, avoiding keyerror
-    group_data = defaultdict(lambda: defaultdict(list))
     with open(filename, 'r', newline='') as csvfile:
         reader = csv.DictReader(csvfile)
-        for row in reader:
-            for col in (project_columns if project_columns else reader.fieldnames):
-                try:
-                    # Convert value to float for aggregation
-                    value = float(row[col])
-                    group_data[row[group_column]][col].append(value)
-                except ValueError:
-                    if agg == "count" or project_columns:
-                        continue
-                    pass
+        return group_accumulators(reader, group_column, agg, project_columns or reader.fieldnames)
 
-    return {group: aggregate(group_vals, agg) for group, group_vals in group_data.items()}
+
+def group_accumulators(rows, group_column, agg, columns=None):
+    '''
+    agg of the numeric values of every column per group, folded into one accumulator
+    (count, sum, min, max) per group and column as the rows go by; columns=None takes every column of a row
+    '''
+    # used defaultdict to create a dict w/o key existing, avoiding keyerror
+    group_data = defaultdict(dict)
+    for row in rows:
+        group = row[group_column]
+        for col in columns or row.keys():
+            try:
+                # Convert value to float for aggregation
+                value = float(row[col])
+            except ValueError:
+                continue
+            accs = group_data[group]
+            acc = accs.get(col)
+            if acc is None:
+                accs[col] = [1, value, value, value]
+            else:
+                acc[0] += 1
+                acc[1] += value
+                acc[2] = min(acc[2], value)
+                acc[3] = max(acc[3], value)
+
+    return {group: aggregate(accs, agg) for group, accs in group_data.items()}
 
 
 def aggregate(group_data, agg):
+    ''' the agg result of every column's [count, sum, min, max] accumulator '''
     aggregated_data = {}
-    for col, values in group_data.items():
+    for col, (count, total, low, high) in group_data.items():
         if agg == "mean":
-            aggregated_data[col] = sum(values) / len(values) if values else 0
+            aggregated_data[col] = total / count
         elif agg == "min":
-            aggregated_data[col] = min(values) if values else 0
+            aggregated_data[col] = low
         elif agg == "max":
-            aggregated_data[col] = max(values) if values else 0
+            aggregated_data[col] = high
         elif agg == "sum":
-            aggregated_data[col] = sum(values) if values else 0
+            aggregated_data[col] = total
         elif agg == "count":
-            aggregated_data[col] = len(values)
+            aggregated_data[col] = count
     return aggregated_data
 
 
@@ -469,17 +486,7 @@ def groupby_aggregate(data, group_column, agg):
 
 
 def perform_groupby_query(data, group_column, agg, project_columns):
-    group_data = defaultdict(lambda: defaultdict(list))
-    for row in data:
-        for col in project_columns if project_columns else row.keys():
-            try:
-                value = float(row[col])
-                group_data[row[group_column]][col].append(value)
-            except ValueError:
-                if agg == "count" or project_columns:
-                    continue
-
-    return {group: aggregate(group_vals, agg) for group, group_vals in group_data.items()}
+    return group_accumulators(data, group_column, agg, project_columns)
 # ================================================
 
 
@@ -513,3 +520,108 @@ def break_into_sorted_chunks_query(data, column, ascending):
 def external_sort_query(data, column, ascending):
     chunk_files = break_into_sorted_chunks_query(data, column, ascending)
     return merge_chunks_query(chunk_files, column)
+# ================================================
+
+
+def iter_query(db, table, where, groupby, agg, having, order_col, ascending, project_col):
+    '''
+    streaming version of query: returns a generator of rows, or a string with the error message.
+    where / project_col run row by row, groupby keeps one accumulator per group and column and
+    order_col spills sorted runs to temp files, so memory does not grow with the table
+    '''
+    db_path = os.path.join('../database', db)
+    table_path_csv = os.path.join(db_path, f"{table}.csv")
+
+    if not os.path.exists(db_path) or not os.path.exists(table_path_csv):
+        return "Database or table does not exist."
+
+    try:
+        conditions_dict = json.loads(where) if where else {}
+        having_dict = json.loads(having) if having else {}
+    except json.JSONDecodeError:
+        return "Invalid JSON string."
+
+    return _query_rows(table_path_csv, conditions_dict, groupby, agg,
+                       having_dict, order_col, ascending, project_col)
+
+
+def _query_rows(table_path_csv, conditions_dict, groupby, agg, having_dict, order_col, ascending, project_col):
+    with open(table_path_csv, 'r', newline='') as csvfile:
+        rows = csv.DictReader(csvfile)
+
+        if conditions_dict:
+            rows = (row for row in rows if all(evaluate_condition_query(
+                row.get(key, ""), cond) for key, cond in conditions_dict.items()))
+
+        if groupby and agg:
+            rows = groupby_aggregate(rows, groupby, agg)
+            if having_dict:
+                rows = filter_data(rows, having_dict)
+
+        if order_col:
+            rows = iter_external_sort(
+                rows, order_col, ASCEDNING_OPTION.get(ascending, True))
+
+        if project_col:
+            selected_columns = [col.strip() for col in project_col]
+            rows = ({col: row[col] for col in selected_columns if col in row}
+                    for row in rows)
+
+        yield from rows
+
+
+def iter_external_sort(rows, column, ascending, chunk_size=5000):
+    '''
+    sort chunk_size rows at a time into temp files, then lazily merge the runs.
+    runs are pickled (as spill.write_run does), so rows keep their keys and values with their types
+    and the merge compares the same keys the runs were sorted on
+    '''
+    key = lambda x: x[column]
+    run_files = []
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            chunk.sort(key=key, reverse=not ascending)
+            run = tempfile.TemporaryFile(mode='w+b')
+            for row in chunk:
+                pickle.dump(row, run, pickle.HIGHEST_PROTOCOL)
+            run.seek(0)
+            run_files.append(run)
+
+        yield from heapq.merge(*[read_run(run) for run in run_files], key=key, reverse=not ascending)
+    finally:
+        for run in run_files:
+            run.close()
+
+
+def read_run(run):
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            break
+
+
+def iter_filter_tb(db, table, conditions):
+    '''
+    streaming version of filter_tb: returns a generator of rows, or a string with the error message
+    '''
+    db_path = os.path.join('../database', db)
+    if not os.path.exists(db_path):
+        return "Database does not exist."
+
+    table_path_csv = os.path.join(db_path, f"{table}.csv")
+    if not os.path.exists(table_path_csv):
+        return "Table does not exist."
+
+    return _filter_rows(table_path_csv, conditions)
+
+
+def _filter_rows(table_path_csv, conditions):
+    with open(table_path_csv, 'r', newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            if all(evaluate_condition(row.get(key, ""), cond)
+                   for key, cond in conditions.items()):
+                yield row
@@ -0,0 +1,121 @@
+import itertools
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_CURSORS = 64
+CURSOR_TTL = 600  # seconds a cursor may sit idle before it is dropped
+
+# cursor id -> {"rows": iterator, "query": str, "template": str, "offset": int, "last_used": float, "lock": Lock,
+#               "peek": row, "last": (offset, rows, next token) of the page served last}
+# a page token is "<cursor id>.<offset of the page>", so every page has its own token
+_cursors = OrderedDict()
+_lock = threading.Lock()
+
+
+class PageGone(Exception):
+    """ Raised by fetch_page for a page before the last one served: its rows were not kept """
+
+
+def page_token(cursor_id, offset):
+    return f"{cursor_id}.{offset}"
+
+
+def parse_token(token):
+    """ (cursor id, offset) of a page token, None for a malformed one """
+    cursor_id, _, offset = token.rpartition('.')
+    if not cursor_id or not offset.isdigit():
+        return None
+    return cursor_id, int(offset)
+
+
+def page_size(requested):
+    """ Clamp a user supplied page size to 1..MAX_PAGE_SIZE """
+    try:
+        size = int(requested)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def open_cursor(rows, query, template):
+    """ Register a row iterator and return the token of its first page """
+    cursor_id = secrets.token_urlsafe(16)
+    with _lock:
+        _expire()
+        while len(_cursors) >= MAX_CURSORS:
+            _, oldest = _cursors.popitem(last=False)
+            _close(oldest)
+        _cursors[cursor_id] = {"rows": iter(rows), "query": query, "template": template, "offset": 0,
+                               "last_used": time.monotonic(), "lock": threading.Lock(), "last": None}
+    return page_token(cursor_id, 0)
+
+
+def fetch_page(token, size=PAGE_SIZE):
+    """
+    The page of a token: the next rows of the cursor, or the page served last again (a reload).
+    Returns (rows, offset of the first row, token for the next page or None), or None for an unknown
+    or expired token; raises PageGone for an earlier page.
+    """
+    parsed = parse_token(token)
+    if parsed is None:
+        return None
+    cursor_id, offset = parsed
+    with _lock:
+        _expire()
+        cursor = _cursors.get(cursor_id)
+        if cursor is None:
+            return None
+        _cursors.move_to_end(cursor_id)
+        cursor["last_used"] = time.monotonic()
+
+    with cursor["lock"]:
+        if cursor["last"] is not None and cursor["last"][1] == offset:
+            return cursor["last"]
+        if offset != cursor["offset"] or cursor["rows"] is None:
+            raise PageGone(f"Rows {offset}.. of this result were already read.")
+        # one row is read ahead so the last page does not offer an empty "next" link
+        rows = [cursor.pop("peek")] if "peek" in cursor else []
+        rows.extend(itertools.islice(cursor["rows"], size + 1 - len(rows)))
+        if len(rows) > size:
+            cursor["peek"] = rows.pop()
+        cursor["offset"] += len(rows)
+        if "peek" in cursor:
+            next_token = page_token(cursor_id, cursor["offset"])
+        else:
+            # the rows are released, the last page stays available for a reload until the cursor expires
+            next_token = None
+            _close(cursor)
+        cursor["last"] = (rows, offset, next_token)
+        return cursor["last"]
+
+
+def cursor_info(token):
+    """ (query, template) the cursor of a page token was opened for, or None """
+    parsed = parse_token(token)
+    cursor = _cursors.get(parsed[0]) if parsed else None
+    return (cursor["query"], cursor["template"]) if cursor else None
+
+
+def close_cursor(token):
+    parsed = parse_token(token)
+    with _lock:
+        cursor = _cursors.pop(parsed[0], None) if parsed else None
+    if cursor is not None:
+        _close(cursor)
+
+
+def _expire():
+    now = time.monotonic()
+    for token in [t for t, c in _cursors.items() if now - c["last_used"] > CURSOR_TTL]:
+        _close(_cursors.pop(token))
+
+
+def _close(cursor):
+    close = getattr(cursor["rows"], "close", None)
+    cursor["rows"] = None
+    if close is not None:
+        close()
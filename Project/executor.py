@@ -0,0 +1,234 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+MAX_WORKERS = 4         # queries running at the same time, each in its own process
+MAX_QUEUED = 16         # waiting queries before new work is rejected
+DEFAULT_TIMEOUT = 30    # seconds from start until a running query is killed
+MAX_TIMEOUT = 300
+KEEP_FINISHED = 256     # finished jobs remembered for /status and /result
+POLL_INTERVAL = 0.02
+WAIT_SECONDS = 1        # how long a request waits for its job before answering with the job id
+
+# job id -> job dict, in submission order
+_jobs = OrderedDict()
+_lock = threading.Lock()
+_wakeup = threading.Condition(_lock)
+_monitor = {"thread": None}
+
+
+class Overloaded(Exception):
+    """ Raised by submit when MAX_QUEUED queries are already waiting """
+
+
+def clamp_timeout(requested):
+    try:
+        timeout = float(requested)
+    except (TypeError, ValueError):
+        return DEFAULT_TIMEOUT
+    return max(1, min(timeout, MAX_TIMEOUT))
+
+
+def submit(target, args, timeout=DEFAULT_TIMEOUT, spool=False, label=''):
+    """
+    Queue target(*args) to run in a worker process and return its job id.
+    With spool=True target returns rows (or an error), which are written to an NDJSON file
+    the web worker can page through without holding them in memory. label is kept for /status.
+    """
+    with _lock:
+        queued = sum(1 for job in _jobs.values() if job["state"] == "queued")
+        if queued >= MAX_QUEUED:
+            raise Overloaded(f"{queued} queries are already waiting, try again later.")
+
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {"id": job_id, "label": label, "state": "queued", "target": target, "args": args,
+                         "timeout": timeout, "spool": spool, "submitted": time.time(),
+                         "started": None, "finished": None, "process": None, "conn": None,
+                         "result": None}
+        _ensure_monitor()
+        _wakeup.notify_all()
+    return job_id
+
+
+def status(job_id):
+    """ Public view of a job: state, timings and queue position (None for unknown ids) """
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        view = {key: job[key] for key in ("id", "label", "state", "submitted", "started", "finished", "timeout")}
+        if job["state"] == "queued":
+            view["position"] = [j["id"] for j in _jobs.values() if j["state"] == "queued"].index(job_id)
+        return view
+
+
+def result(job_id):
+    """ (state, result) of a job; result is only meaningful once state is done """
+    with _lock:
+        job = _jobs.get(job_id)
+        return (job["state"], job["result"]) if job else (None, None)
+
+
+def wait(job_id, timeout=None):
+    """
+    (state, result) of the job once it finished, failed, timed out or was cancelled, waiting at most
+    timeout seconds (WAIT_SECONDS by default) for that; (state, None) while it is still queued or running, (None, None) for an
+    unknown or evicted job
+    """
+    deadline = time.monotonic() + (WAIT_SECONDS if timeout is None else timeout)
+    with _lock:
+        while True:
+            job = _jobs.get(job_id)
+            if job is None:
+                return None, None
+            if job["state"] not in ("queued", "running"):
+                return job["state"], job["result"]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return job["state"], None
+            _wakeup.wait(remaining)
+
+
+def cancel(job_id):
+    """ Drop a queued job or kill a running one; returns False when there was nothing to cancel """
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None or job["state"] not in ("queued", "running"):
+            return False
+        if job["state"] == "running":
+            _kill(job)
+        _finish(job, "cancelled", {"error": "Query cancelled."})
+        _wakeup.notify_all()
+    return True
+
+
+def claim(job_id):
+    """
+    The spool file of a finished job, handed out once: the first caller reads it (and has it removed),
+    later callers and jobs without spooled rows get None
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None or job.get("claimed") or not isinstance(job["result"], dict):
+            return None
+        path = job["result"].get("spool")
+        if path is not None:
+            job["claimed"] = True
+        return path
+
+
+def iter_spool(path):
+    """ Rows of a spooled result; the file is removed once the rows are consumed or abandoned """
+    try:
+        with open(path, 'r') as spool:
+            for line in spool:
+                yield json.loads(line)
+    finally:
+        _remove_spool(path)
+
+
+def _remove_spool(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _run(conn, target, args, spool_path):
+    """ Worker process entry point """
+    try:
+        value = target(*args)
+        if spool_path and not isinstance(value, (str, dict)):
+            count = 0
+            with open(spool_path, 'w') as spool:
+                for row in value:
+                    spool.write(json.dumps(row) + '\n')
+                    count += 1
+            conn.send(("done", {"spool": spool_path, "rows": count}))
+        else:
+            conn.send(("done", value))
+    except Exception as e:
+        conn.send(("failed", {"error": f"{type(e).__name__}: {e}"}))
+    finally:
+        conn.close()
+
+
+def _start(job):
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    spool_path = None
+    if job["spool"]:
+        fd, spool_path = tempfile.mkstemp(prefix='synthquery_', suffix='.ndjson')
+        os.close(fd)
+    process = multiprocessing.Process(target=_run, args=(child_conn, job["target"], job["args"], spool_path),
+                                      daemon=True)
+    process.start()
+    child_conn.close()
+    job.update(state="running", started=time.time(), process=process, conn=parent_conn,
+               spool_path=spool_path)
+
+
+def _kill(job):
+    job["process"].kill()
+    job["process"].join()
+    job["conn"].close()
+    if job.get("spool_path"):
+        _remove_spool(job["spool_path"])
+
+
+def _finish(job, state, value):
+    job.update(state=state, result=value, finished=time.time(), process=None, conn=None,
+               target=None, args=None)
+    # requests waiting for the job
+    _wakeup.notify_all()
+
+
+def _collect(job):
+    try:
+        state, value = job["conn"].recv()
+    except EOFError:
+        state, value = "failed", {"error": "Worker process exited without a result."}
+    job["process"].join()
+    job["conn"].close()
+    _finish(job, state, value)
+
+
+def _tick():
+    now = time.time()
+    running = [job for job in _jobs.values() if job["state"] == "running"]
+    for job in running:
+        if job["conn"].poll():
+            _collect(job)
+        elif not job["process"].is_alive():
+            _collect(job)
+        elif now - job["started"] > job["timeout"]:
+            _kill(job)
+            _finish(job, "timeout", {"error": f"Query exceeded its {job['timeout']:g}s deadline."})
+
+    slots = MAX_WORKERS - sum(1 for job in _jobs.values() if job["state"] == "running")
+    for job in [job for job in _jobs.values() if job["state"] == "queued"][:max(slots, 0)]:
+        _start(job)
+
+    finished = [job_id for job_id, job in _jobs.items() if job["state"] not in ("queued", "running")]
+    for job_id in finished[:max(len(finished) - KEEP_FINISHED, 0)]:
+        job = _jobs.pop(job_id)
+        # rows nobody fetched (or a failed job's partial spool) would otherwise stay in the temp dir
+        if job.get("spool_path") and not job.get("claimed"):
+            _remove_spool(job["spool_path"])
+
+
+def _monitor_loop():
+    with _lock:
+        while True:
+            _tick()
+            _wakeup.wait(POLL_INTERVAL)
+
+
+def _ensure_monitor():
+    if _monitor["thread"] is None:
+        _monitor["thread"] = threading.Thread(target=_monitor_loop, name="query-executor", daemon=True)
+        _monitor["thread"].start()
@@ -568,3 +568,45 @@ def select_jval(db, table, where, groupby, orderby):
                         return {"data": data}
                     except json.JSONDecodeError:
                         return {"error": f"Invalid JSON format.{split_path}"}
+
+def iter_select_jval(db, table, where, groupby, orderby):
+    """
+    Streaming version of select_jval: returns a generator of records (one {field: key, "records": [...]}
+    per group when grouping), or an error dict. Only one table part is held in memory at a time.
+    """
+    db_path = os.path.join('../database', db)
+    if not os.path.exists(db_path):
+        return {"error": f"Database does not exist.{db_path}"}
+
+    split_path = split_json_file(db, table)
+
+    try:
+        criteria = json.loads(where.strip('\'')) if where.strip('\'') else {}
+    except json.JSONDecodeError:
+        return {"error": "Invalid JSON format."}
+
+    if split_path.endswith('.json'):
+        part_paths = [split_path]
+    else:
+        part_paths = [os.path.join(split_path, file_name) for file_name in sorted(os.listdir(split_path))
+                      if file_name.endswith('.json')]
+
+    return _select_records(part_paths, criteria, groupby, orderby)
+
+
+def _select_records(part_paths, criteria, groupby, orderby):
+    for part_path in part_paths:
+        with open(part_path, 'r') as file:
+            data = json.load(file)
+
+        if criteria:
+            data = filter_data(data, criteria)
+
+        if groupby:
+            for key, records in group_by(data, groupby).items():
+                yield {groupby: key, "records": records}
+        else:
+            if orderby:
+                order_fields = [field.strip() for field in orderby.split(',')]
+                data = order_by(data, order_fields)
+            yield from data
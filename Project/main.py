@@ -1,8 +1,13 @@
-from flask import Flask, request, render_template
+from flask import Flask, request, render_template, Response, stream_with_context, url_for, abort, jsonify
 import re
+import io
+import csv
 import json
 import json_file as jf
 import csv_file as cf
+import cursors
+import executor
+import prepared
 import shlex
 import re
 
@@ -36,195 +41,408 @@ def demo():
 def results():
     if request.method == 'POST':
         query = request.form['query']
-
-        # Process the query
-        query_brkdwn = query.split(' ')
-        func = query_brkdwn[2]
-        db = query_brkdwn[3][5:]
-        table = query_brkdwn[4][8:]
-        # python main.py select-jval --db=test-db --table=salaries --where='{"salary_in_usd":{"operation":">","value":"400000"}}' --groupby=job_title --orderby=salary_in_usd
-        if func == 'select-jval':
-            # select * from t
-            if len(query_brkdwn) == 5:
-                result = jf.select_jval(db, table, '', '', '')
-                pretty_result = json.dumps(result, indent=4)
-                return render_template('results.html', query=query, result=pretty_result)
-            elif len(query_brkdwn) == 6:
-                where = query_brkdwn[5][8:]
-                result = jf.select_jval(db, table, where, '', '')
-                pretty_result = json.dumps(result, indent=4)
-                return render_template('results.html', query=query, result=pretty_result)
-
-            # when there are conditions
-            where = query_brkdwn[5][8:]
-            groupby = query_brkdwn[6][10:]
-            orderby = query_brkdwn[7][10:]
-
-            result = jf.select_jval(db, table, where, groupby, orderby)
-
-        # python main.py ins-jval --db=test-db --table=salaries --values='[{"work_year":"2024","experience_level":"EX","employment_type":"FT","job_title":"Jedi_Master","salary":"1000000","salary_currency":"USD","salary_in_usd":"1000000","employee_residence":"US","remote_ratio":0,"company_location":"US","company_size":"S"}]'
-        # python main.py ins-jval --db=test-db --table=salaries --values='[{"work_year":"2024","experience_level":"EX"}]
-        elif func == 'ins-jval':
-            values = query_brkdwn[5][9:]
-
-            result = jf.ins_jval(db, table, values)
-
-        # python main.py del-rows-jval --db=test-db --table=salaries --conditions='{"work_year":"2024","experience_level":"EX"}'
-        # python main.py del-rows-jval --db=test-db --table=salaries --conditions='{"work_year":"2024","experience_level":"EX","employment_type":"FT","job_title":"Jedi_Master","salary":"1000000","salary_currency":"USD","salary_in_usd":"1000000","employee_residence":"US","remote_ratio":0,"company_location":"US","company_size":"S"}'
-        elif func == 'del-rows-jval':
-            conditions = query_brkdwn[5][13:]
-
-            result = jf.del_rows_jval(db, table, conditions)
-
-        # python main.py project-col-jval --db=test-db --table=salaries --columns=work_year,salary_in_usd
-        elif func == 'project-col-jval':
-            columns = query_brkdwn[5][10:]
-
-            result = jf.project_col_jval(db, table, columns)
-
-        # python main.py update-jval --db=test-db --table=salaries --record-id=1 --new-values='{"column1":"value1","column2":"3"}'
-        elif func == 'update-jval':
-            record_id = query_brkdwn[5][12:]
-            new_values = query_brkdwn[6][13:]
-
-            result = jf.update_jval(db, table, record_id, new_values)
-
-        # python main.py filter-jval --db=test-db --table=salaries --criteria='{"column2":"3"}'
-        elif func == 'filter-jval':
-            criteria = query_brkdwn[5][11:]
-
-            result = jf.filter_jval(db, table, criteria)
-
-        # python main.py order-jval --db=test-db --table=salaries --fields=salary_in_usd
-        elif func == 'order-jval':
-            fields = query_brkdwn[5][9:]
-
-            result = jf.order_jval(db, table, fields)
-
-        # python main.py group-by-jval --db=test-db --table=salaries --field=job_title
-        elif func == 'group-by-jval':
-            field = query_brkdwn[5][8:]
-
-            result = jf.group_by_jval(db, table, field)
-
-        # python main.py join-jval --db=test-db --table1=t --table2=t2 --join-field=column1
-        elif func == 'join-jval':
-            table1 = query_brkdwn[4][9:]
-            table2 = query_brkdwn[5][9:]
-            join_field = query_brkdwn[6][13:]
-
-            result = jf.join_jval(db, table1, table2, join_field)
-
-        pretty_result = json.dumps(result, indent=4)
-        return render_template('results.html', query=query, result=pretty_result)
+        return render_job(*run_job(json_call(query), query), query, 'results.html')
 
 
 @app.route('/csv_results', methods=['GET', 'POST'])
 def csv_results():
     if request.method == 'POST':
         csv_query = request.form['csv_query']
-        result = ''
-
-        # Split the query
-        query_parts = shlex.split(csv_query)
-
-        if len(query_parts) >= 4:
-            func = query_parts[2]
-            db = query_parts[3][5:]
-            table = query_parts[4][8:]
-
-            if func == 'ins-cval':
-                json_str = ' '.join(query_parts[5:])
-                json_str = json_str[json_str.index('=') + 1:]
-
-                try:
-                    values = json.loads(json_str)
-                    result = cf.ins_cval(db, table, values)
-                except json.JSONDecodeError as e:
-                    result = f"JSON decoding error: {e}"
-            elif func == 'del-rows':
-
-                conditions_str = ' '.join(query_parts[5:])
-                conditions_str = conditions_str[conditions_str.index('=') + 1:]
-                try:
-                    conditions_dict = json.loads(conditions_str)
-                    result = cf.del_rows(db, table, conditions_dict)
-                except json.JSONDecodeError as e:
-                    result = f"JSON decoding error: {e}"
-            elif func == 'project-col':
-                db = query_parts[3].split('=')[1]
-                table = query_parts[4].split('=')[1]
-
-                columns_str = query_parts[5].split('=')[1]
-                columns = [col.strip().replace('\'', '')
-                           for col in columns_str.split(',')]
-                result = cf.project_col(db, table, columns)
-            elif func == 'update-rows':
-                conditions_str = ' '.join(query_parts[5:])
-                conditions_str = conditions_str[conditions_str.index('=') + 1:]
-
-                try:
-                    conditions_dict = json.loads(conditions_str)
-                    result = cf.update_rows(db, table, conditions_dict)
-                except json.JSONDecodeError as e:
-                    result = f"JSON decoding error: {e}"
-            elif func == 'filter-tb':
-                conditions_str = ' '.join(query_parts[5:])
-                conditions_str = conditions_str[conditions_str.index('=') + 1:]
-
-                try:
-                    conditions_dict = json.loads(conditions_str)
-                    result = cf.filter_tb(db, table, conditions_dict)
-                except json.JSONDecodeError as e:
-                    result = f"JSON decoding error: {e}"
-            elif func == 'order-tb':
-                db = query_parts[3].split('=')[1]
-                table = query_parts[4].split('=')[1]
-                column = query_parts[5].split('=')[1].strip("'")
-                ascending = query_parts[6].split('=')[1]
-
-                result = cf.order_tb(db, table, column, ascending)
-            elif func == 'groupby':
-                db = query_parts[3].split('=')[1]
-                table = query_parts[4].split('=')[1]
-                column = query_parts[5].split('=')[1].strip("'")
-                agg = query_parts[6].split('=')[1]
-                result = cf.groupby(db, table, column, agg)
-            elif func == 'join-tb':
-                db = query_parts[3].split('=')[1]
-                tbl1 = query_parts[4].split('=')[1]
-                tbl2 = query_parts[5].split('=')[1]
-                column = query_parts[6].split('=')[1].replace('\'', '')
-
-                result = cf.join_tb(db, tbl1, tbl2, column)
-            elif func == 'query':
-                where = groupby = agg = having = order_col = ascending = project_col = ''
-
-                for part in query_parts[5:]:
-                    if '--where=' in part:
-                        where = part.split('=', 1)[1].replace('\'', '')
-                    elif '--groupby=' in part:
-                        groupby = part.split('=', 1)[1].replace('\'', '')
-                    elif '--agg=' in part:
-                        agg = part.split('=', 1)[1].replace('\'', '')
-                    elif '--having=' in part:
-                        having = part.split('=', 1)[1].replace('\'', '')
-                    elif '--order_col=' in part:
-                        order_col = part.split('=', 1)[1].replace('\'', '')
-                    elif '--ascending=' in part:
-                        ascending = part.split('=', 1)[1].replace('\'', '')
-                    elif '--project_col=' in part:
-                        project_col = part.split(
-                            '=', 1)[1].replace('\'', '').split(',')
-
-                result = cf.query(db, table, where, groupby, agg,
-                                  having, order_col, ascending, project_col)
-            else:
-                result = "Invalid query format."
-        else:
-            result = "Invalid query format."
-
-        return render_template('csv_results.html', query=csv_query, result=result)
+        call = csv_call(csv_query)
+        if isinstance(call, str):
+            return render_template('csv_results.html', query=csv_query, result=call)
+        return render_job(*run_job(call, csv_query), csv_query, 'csv_results.html')
+
+
+def json_call(query):
+    """ (function, args, spool) for a JSON command string; spool marks row results that are paged """
+    # Process the query
+    query_brkdwn = query.split(' ')
+    func = query_brkdwn[2]
+    db = query_brkdwn[3][5:]
+    table = query_brkdwn[4][8:]
+    # python main.py select-jval --db=test-db --table=salaries --where='{"salary_in_usd":{"operation":">","value":"400000"}}' --groupby=job_title --orderby=salary_in_usd
+    if func == 'select-jval':
+        where = groupby = orderby = ''
+        if len(query_brkdwn) >= 6:
+            where = query_brkdwn[5][8:]
+        if len(query_brkdwn) >= 8:
+            groupby = query_brkdwn[6][10:]
+            orderby = query_brkdwn[7][10:]
+        return jf.iter_select_jval, (db, table, where, groupby, orderby), True
+
+    # python main.py ins-jval --db=test-db --table=salaries --values='[{"work_year":"2024","experience_level":"EX","employment_type":"FT","job_title":"Jedi_Master","salary":"1000000","salary_currency":"USD","salary_in_usd":"1000000","employee_residence":"US","remote_ratio":0,"company_location":"US","company_size":"S"}]'
+    # python main.py ins-jval --db=test-db --table=salaries --values='[{"work_year":"2024","experience_level":"EX"}]
+    if func == 'ins-jval':
+        values = query_brkdwn[5][9:]
+
+        return jf.ins_jval, (db, table, values), False
+
+    # python main.py del-rows-jval --db=test-db --table=salaries --conditions='{"work_year":"2024","experience_level":"EX"}'
+    # python main.py del-rows-jval --db=test-db --table=salaries --conditions='{"work_year":"2024","experience_level":"EX","employment_type":"FT","job_title":"Jedi_Master","salary":"1000000","salary_currency":"USD","salary_in_usd":"1000000","employee_residence":"US","remote_ratio":0,"company_location":"US","company_size":"S"}'
+    elif func == 'del-rows-jval':
+        conditions = query_brkdwn[5][13:]
+
+        return jf.del_rows_jval, (db, table, conditions), False
+
+    # python main.py project-col-jval --db=test-db --table=salaries --columns=work_year,salary_in_usd
+    elif func == 'project-col-jval':
+        columns = query_brkdwn[5][10:]
+
+        return jf.project_col_jval, (db, table, columns), False
+
+    # python main.py update-jval --db=test-db --table=salaries --record-id=1 --new-values='{"column1":"value1","column2":"3"}'
+    elif func == 'update-jval':
+        record_id = query_brkdwn[5][12:]
+        new_values = query_brkdwn[6][13:]
+
+        return jf.update_jval, (db, table, record_id, new_values), False
+
+    # python main.py filter-jval --db=test-db --table=salaries --criteria='{"column2":"3"}'
+    elif func == 'filter-jval':
+        criteria = query_brkdwn[5][11:]
+
+        return jf.filter_jval, (db, table, criteria), False
+
+    # python main.py order-jval --db=test-db --table=salaries --fields=salary_in_usd
+    elif func == 'order-jval':
+        fields = query_brkdwn[5][9:]
+
+        return jf.order_jval, (db, table, fields), False
+
+    # python main.py group-by-jval --db=test-db --table=salaries --field=job_title
+    elif func == 'group-by-jval':
+        field = query_brkdwn[5][8:]
+
+        return jf.group_by_jval, (db, table, field), False
+
+    # python main.py join-jval --db=test-db --table1=t --table2=t2 --join-field=column1
+    elif func == 'join-jval':
+        table1 = query_brkdwn[4][9:]
+        table2 = query_brkdwn[5][9:]
+        join_field = query_brkdwn[6][13:]
+
+        return jf.join_jval, (db, table1, table2, join_field), False
+
+    return None
+
+
+def csv_call(csv_query):
+    """ (function, args, spool) for a CSV command string, or an error string """
+    # Split the query
+    query_parts = shlex.split(csv_query)
+
+    if len(query_parts) < 5:
+        return "Invalid query format."
+
+    func = query_parts[2]
+    db = query_parts[3][5:]
+    table = query_parts[4][8:]
+
+    if func == 'ins-cval':
+        json_str = ' '.join(query_parts[5:])
+        json_str = json_str[json_str.index('=') + 1:]
+
+        try:
+            values = json.loads(json_str)
+        except json.JSONDecodeError as e:
+            return f"JSON decoding error: {e}"
+        return cf.ins_cval, (db, table, values), False
+    elif func == 'del-rows':
+
+        conditions_str = ' '.join(query_parts[5:])
+        conditions_str = conditions_str[conditions_str.index('=') + 1:]
+        try:
+            conditions_dict = json.loads(conditions_str)
+        except json.JSONDecodeError as e:
+            return f"JSON decoding error: {e}"
+        return cf.del_rows, (db, table, conditions_dict), False
+    elif func == 'project-col':
+        db = query_parts[3].split('=')[1]
+        table = query_parts[4].split('=')[1]
+
+        columns_str = query_parts[5].split('=')[1]
+        columns = [col.strip().replace('\'', '')
+                   for col in columns_str.split(',')]
+        return cf.project_col, (db, table, columns), False
+    elif func == 'update-rows':
+        conditions_str = ' '.join(query_parts[5:])
+        conditions_str = conditions_str[conditions_str.index('=') + 1:]
+
+        try:
+            conditions_dict = json.loads(conditions_str)
+        except json.JSONDecodeError as e:
+            return f"JSON decoding error: {e}"
+        return cf.update_rows, (db, table, conditions_dict), False
+    elif func == 'filter-tb':
+        conditions_str = ' '.join(query_parts[5:])
+        conditions_str = conditions_str[conditions_str.index('=') + 1:]
+        try:
+            conditions_dict = json.loads(conditions_str)
+        except json.JSONDecodeError as e:
+            return f"JSON decoding error: {e}"
+        return cf.iter_filter_tb, (db, table, conditions_dict), True
+    elif func == 'order-tb':
+        db = query_parts[3].split('=')[1]
+        table = query_parts[4].split('=')[1]
+        column = query_parts[5].split('=')[1].strip("'")
+        ascending = query_parts[6].split('=')[1]
+
+        return cf.order_tb, (db, table, column, ascending), False
+    elif func == 'groupby':
+        db = query_parts[3].split('=')[1]
+        table = query_parts[4].split('=')[1]
+        column = query_parts[5].split('=')[1].strip("'")
+        agg = query_parts[6].split('=')[1]
+        return cf.groupby, (db, table, column, agg), False
+    elif func == 'join-tb':
+        db = query_parts[3].split('=')[1]
+        tbl1 = query_parts[4].split('=')[1]
+        tbl2 = query_parts[5].split('=')[1]
+        column = query_parts[6].split('=')[1].replace('\'', '')
+
+        return cf.join_tb, (db, tbl1, tbl2, column), False
+    elif func == 'query':
+        where = groupby = agg = having = order_col = ascending = project_col = ''
+
+        for part in query_parts[5:]:
+            if '--where=' in part:
+                where = part.split('=', 1)[1].replace('\'', '')
+            elif '--groupby=' in part:
+                groupby = part.split('=', 1)[1].replace('\'', '')
+            elif '--agg=' in part:
+                agg = part.split('=', 1)[1].replace('\'', '')
+            elif '--having=' in part:
+                having = part.split('=', 1)[1].replace('\'', '')
+            elif '--order_col=' in part:
+                order_col = part.split('=', 1)[1].replace('\'', '')
+            elif '--ascending=' in part:
+                ascending = part.split('=', 1)[1].replace('\'', '')
+            elif '--project_col=' in part:
+                project_col = part.split(
+                    '=', 1)[1].replace('\'', '').split(',')
+
+        return cf.iter_query, (db, table, where, groupby, agg,
+                               having, order_col, ascending, project_col), True
+
+    return "Invalid query format."
+
+
+def command_call(query):
+    """ JSON commands end in -jval, everything else goes to the CSV engine """
+    func = query.split(' ')[2] if len(query.split(' ')) > 2 else ''
+    if func.endswith('-jval'):
+        return json_call(query) or "Invalid query format."
+    return csv_call(query)
+
+
+def submit_job(call, query):
+    target, args, spool = call
+    return executor.submit(target, args, timeout=executor.clamp_timeout(
+        request.values.get('timeout')), spool=spool, label=query)
+
+
+def run_job(call, query=''):
+    """
+    Run a (function, args, spool) call in the execution pool, waiting briefly for it to finish;
+    returns (job id, state, result) with the state of a job that is still queued or running
+    """
+    if call is None:
+        return None, "done", None
+    job_id = submit_job(call, query)
+    state, result = executor.wait(job_id)
+    if state == "done":
+        # the caller reads the spooled rows, the job is not evicted with them
+        executor.claim(job_id)
+    return job_id, state, result
+
+
+def job_accepted(job_id):
+    """ 202 with the job id and its links, for a job that is still queued or running """
+    return jsonify({"id": job_id, "status": url_for('status', job_id=job_id),
+                    "result": url_for('job_result', job_id=job_id),
+                    "cancel": url_for('cancel', job_id=job_id)}), 202
+
+
+def job_gone(job_id):
+    return jsonify({"id": job_id, "error": "The job was evicted before its result was fetched."}), 410
+
+
+def render_job(job_id, state, result, query, template):
+    """
+    Render a finished job: spooled rows get a cursor, everything else is shown as is;
+    a job still running is answered with 202 and its id, an evicted one with 410
+    """
+    if state in ("queued", "running"):
+        return job_accepted(job_id)
+    if state is None:
+        return job_gone(job_id)
+    if state == "done" and isinstance(result, dict) and "spool" in result:
+        return render_page(cursors.open_cursor(executor.iter_spool(result["spool"]), query, template))
+
+    if template == 'results.html':
+        result = json.dumps(result, indent=4)
+    elif isinstance(result, dict) and "error" in result:
+        result = result["error"]
+    return render_template(template, query=query, csv_query=query, result=result)
+
+
+@app.route('/submit', methods=['POST'])
+def submit():
+    """ Queue a command string and return its job id right away; poll /status/<id>, fetch /result/<id> """
+    query = request.form.get('query') or request.form.get('csv_query', '')
+    call = command_call(query)
+    if isinstance(call, str):
+        return jsonify({"error": call}), 400
+    return job_accepted(submit_job(call, query))
+
+
+@app.route('/prepare', methods=['POST'])
+def prepare():
+    """ Register a named command string with $name placeholders, run it with /execute/<name> """
+    name = request.form.get('name', '')
+    query = request.form.get('query', '')
+    if not name:
+        return jsonify({"error": "No statement name given."}), 400
+    try:
+        plan = prepared.register(name, query, command_call)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"name": name, "params": plan.params,
+                    "execute": url_for('execute', name=name)}), 201
+
+
+@app.route('/execute/<name>', methods=['GET', 'POST'])
+def execute(name):
+    """
+    Run a prepared statement with the request's values for its placeholders (e.g. ?title=Data%20Scientist);
+    the compiled plan is reused, only the values are put in
+    """
+    try:
+        plan = prepared.lookup(name, command_call)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if plan is None:
+        abort(404)
+    values = {key: value for key, value in request.values.items() if key in plan.params}
+    try:
+        call, query = plan.bind(values)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    template = 'results.html' if query.split(' ')[2].endswith('-jval') else 'csv_results.html'
+    return render_job(*run_job(call, query), query, template)
+
+
+@app.route('/status/<job_id>')
+def status(job_id):
+    job = executor.status(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+@app.route('/cancel/<job_id>', methods=['GET', 'POST'])
+def cancel(job_id):
+    if executor.status(job_id) is None:
+        abort(404)
+    return jsonify({"id": job_id, "cancelled": executor.cancel(job_id)})
+
+
+@app.route('/result/<job_id>')
+def job_result(job_id):
+    job = executor.status(job_id)
+    if job is None:
+        abort(404)
+    query = job["label"]
+    state, result = executor.wait(job_id)
+    if state == "done" and isinstance(result, dict) and "spool" in result and executor.claim(job_id) is None:
+        # the rows were read by an earlier request (and their file removed)
+        return jsonify({"error": "The result of this job was already fetched."}), 410
+    template = 'results.html' if query.split(' ')[2].endswith('-jval') else 'csv_results.html'
+    return render_job(job_id, state, result, query, template)
+
+
+@app.errorhandler(executor.Overloaded)
+def overloaded(e):
+    return render_template('results.html', query='', result=str(e)), 503
+
+
+def render_page(token):
+    """
+    Render the page of a cursor token with links to the following page and the full download;
+    reloading a page shows it again, an earlier page is gone (410)
+    """
+    info = cursors.cursor_info(token)
+    if info is None:
+        abort(404)
+    query, template = info
+    size = cursors.page_size(request.args.get('size', cursors.PAGE_SIZE))
+    try:
+        page_rows = cursors.fetch_page(token, size)
+    except cursors.PageGone as e:
+        return render_template(template, query=query, csv_query=query, result=str(e)), 410
+    if page_rows is None:
+        # the cursor expired or was closed since cursor_info
+        abort(404)
+    rows, offset, next_token = page_rows
+
+    result = rows if template == 'csv_results.html' else json.dumps(rows, indent=4)
+    next_page = url_for('page', token=next_token, size=size) if next_token else None
+    downloads = {fmt: url_for('download', query=query, format=fmt) for fmt in ('ndjson', 'csv')}
+    return render_template(template, query=query, csv_query=query, result=result,
+                           offset=offset, next_page=next_page, downloads=downloads)
+
+
+@app.route('/page/<token>')
+def page(token):
+    return render_page(token)
+
+
+@app.route('/download')
+def download():
+    """ Run a query in the pool and stream its whole result as NDJSON or CSV with chunked transfer """
+    query = request.args.get('query', '')
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        abort(400)
+
+    call = command_call(query)
+    if isinstance(call, str) or not call[2]:
+        return jsonify({"error": call if isinstance(call, str) else "Only row results can be downloaded."}), 400
+    job_id, state, result = run_job(call, query)
+    if state in ("queued", "running"):
+        return job_accepted(job_id)
+    if state is None:
+        return job_gone(job_id)
+    if state != "done" or "spool" not in result:
+        return jsonify(result if isinstance(result, dict) else {"error": result}), 400
+    rows = executor.iter_spool(result["spool"])
+
+    if fmt == 'ndjson':
+        body = (json.dumps(row) + '\n' for row in rows)
+        mimetype = 'application/x-ndjson'
+    else:
+        body = stream_csv(rows)
+        mimetype = 'text/csv'
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=result.{fmt}'})
+
+
+def stream_csv(rows, batch_size=500):
+    """ Yield CSV text in batches of rows; the header comes from the first row """
+    buffer = io.StringIO()
+    writer = None
+    for i, row in enumerate(rows, 1):
+        if writer is None:
+            writer = csv.DictWriter(buffer, fieldnames=list(row.keys()), extrasaction='ignore')
+            writer.writeheader()
+        writer.writerow({key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                         for key, value in row.items()})
+        if i % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,223 @@
+import os
+import re
+import json
+import math
+import shlex
+import threading
+from collections import OrderedDict
+
+# shared with `python main.py prepare`, the web app runs inside Project/
+STORE = os.path.join('../database', '.prepared.json')
+PLACEHOLDER = re.compile(r'"\$([A-Za-z_]\w*)"|\$([A-Za-z_]\w*)')
+# a bare placeholder inside JSON, written as a string while the statement is compiled
+MARKER = re.compile(r'"\$=([A-Za-z_]\w*)"')
+MARKER_VALUE = re.compile(r'\$=([A-Za-z_]\w*)')
+MAX_PLANS = 64
+
+# name -> Plan, least recently executed first
+_plans = OrderedDict()
+_lock = threading.Lock()
+
+
+def compile_text(text):
+    """ text split at its placeholders into literal strings and (name, quoted) pairs, the text itself without any """
+    segments, position = [], 0
+    for found in PLACEHOLDER.finditer(text):
+        segments.append(text[position:found.start()])
+        segments.append((found.group(1), True) if found.group(1) else (found.group(2), False))
+        position = found.end()
+    if not segments:
+        return text
+    segments.append(text[position:])
+    return segments
+
+
+def bare_value(name, text):
+    """ The JSON text of a value bound to a bare $name: a number, true, false or null, ValueError for anything else """
+    try:
+        value = json.loads(text)
+    except ValueError:
+        value = text
+    if isinstance(value, (str, list, dict)) or isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f"${name} is a bare placeholder and takes a number, true, false or null, not {text!r}.")
+    return json.dumps(value)
+
+
+def bind_text(segments, values):
+    """ "$name" becomes the value as a JSON string, a bare $name the value as a JSON scalar """
+    if isinstance(segments, str):
+        return segments
+    return ''.join(segment if isinstance(segment, str) else
+                   json.dumps(values[segment[0]]) if segment[1] else bare_value(segment[0], values[segment[0]])
+                   for segment in segments)
+
+
+def mark_bare(template):
+    """
+    The template with the bare placeholders that stand for JSON values ({"value":$n}, [$a,$b]) written
+    as "$=name" strings, so that commands parsing their JSON while the statement is compiled get valid JSON
+    """
+    marked, depth, quoted, escaped, position = [], 0, False, False, 0
+    while position < len(template):
+        char = template[position]
+        if char == '$' and depth > 0 and not quoted:
+            found = PLACEHOLDER.match(template, position)
+            if found:
+                marked.append(f'"$={found.group(2)}"')
+                position = found.end()
+                continue
+        if quoted:
+            quoted = escaped or char != '"'
+            escaped = not escaped and char == '\\'
+        elif char == '"':
+            quoted = True
+        elif char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth = max(depth - 1, 0)
+        marked.append(char)
+        position += 1
+    return ''.join(marked)
+
+
+def json_value(name, text):
+    """ A bare value put into parsed JSON: the scalar it reads as (5, true, null, ...), see bare_value """
+    return json.loads(bare_value(name, text))
+
+
+def compile_value(value):
+    """ an argument of a call with its strings split at their placeholders (conditions arrive parsed) """
+    if isinstance(value, str):
+        bare = MARKER_VALUE.fullmatch(value)
+        if bare:
+            return ('bare', bare.group(1))
+        return ('text', compile_text(MARKER.sub(r'$\1', value)))
+    if isinstance(value, dict):
+        return ('dict', [(compile_value(key), compile_value(item)) for key, item in value.items()])
+    if isinstance(value, list):
+        return ('list', [compile_value(item) for item in value])
+    return ('const', value)
+
+
+def bind_value(compiled, values):
+    kind, body = compiled
+    if kind == 'text':
+        return bind_text(body, values)
+    if kind == 'dict':
+        return {bind_value(key, values): bind_value(item, values) for key, item in body}
+    if kind == 'list':
+        return [bind_value(item, values) for item in body]
+    if kind == 'bare':
+        return json_value(body, values[body])
+    return body
+
+
+def placeholders(compiled, found):
+    kind, body = compiled
+    if kind == 'text' and not isinstance(body, str):
+        found.update(segment[0] for segment in body if not isinstance(segment, str))
+    elif kind == 'dict':
+        for key, item in body:
+            placeholders(key, found)
+            placeholders(item, found)
+    elif kind == 'list':
+        for item in body:
+            placeholders(item, found)
+    elif kind == 'bare':
+        found.add(body)
+    return found
+
+
+def web_query(query):
+    """
+    A stored statement as the web app's command strings are written: with python main.py in front,
+    JSON commands without shell quoting or spaces in their JSON (they are split at spaces), CSV commands shell-quoted
+    """
+    tokens = shlex.split(query)
+    while tokens and (tokens[0] in ('python', 'python3') or tokens[0].endswith('main.py')):
+        tokens.pop(0)
+    if tokens and tokens[0].endswith('-jval'):
+        return 'python main.py ' + ' '.join(compact_json(token) for token in tokens)
+    return 'python main.py ' + shlex.join(tokens)
+
+
+def compact_json(token):
+    """ --option=<JSON> written without spaces """
+    option, sep, value = token.partition('=')
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        return token
+    if not sep or not isinstance(parsed, (dict, list)):
+        return token
+    return option + sep + json.dumps(parsed, separators=(',', ':'))
+
+
+class Plan:
+    """
+    A statement compiled through command_call once: the function to run, its arguments and the
+    command string, each split at the placeholders; executing only puts the values in
+    """
+
+    def __init__(self, name, query, command_call):
+        self.name = name
+        self.query = query
+        template = web_query(query)
+        call = command_call(mark_bare(template))
+        if isinstance(call, str):
+            raise ValueError(call)
+        self.target, args, self.spool = call
+        self.args = [compile_value(arg) for arg in args]
+        self.label = compile_text(template)
+        self.params = sorted(placeholders(('text', self.label), set()))
+
+    def bind(self, values):
+        """ ((function, args, spool), command string) with the values put in """
+        missing = [name for name in self.params if name not in values]
+        if missing:
+            raise ValueError(f"Missing value for {', '.join('$' + name for name in missing)}.")
+        args = tuple(bind_value(arg, values) for arg in self.args)
+        return (self.target, args, self.spool), bind_text(self.label, values)
+
+
+def statements():
+    """ {name: query} of the registered statements """
+    if not os.path.exists(STORE):
+        return {}
+    with open(STORE, 'r') as f:
+        return json.load(f)
+
+
+def register(name, query, command_call):
+    """ Compile and store a statement, ValueError when command_call cannot make a call of it """
+    plan = Plan(name, query, command_call)
+    with _lock:
+        registered = statements()
+        registered[name] = query
+        os.makedirs(os.path.dirname(STORE), exist_ok=True)
+        temp_path = STORE + '.web.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(registered, f, indent=4)
+        os.replace(temp_path, STORE)
+        _remember(plan)
+    return plan
+
+
+def lookup(name, command_call):
+    """ The compiled plan of a statement, compiled again when it was registered anew; None when unknown """
+    query = statements().get(name)
+    if query is None:
+        return None
+    with _lock:
+        plan = _plans.get(name)
+        if plan is None or plan.query != query:
+            plan = Plan(name, query, command_call)
+        _remember(plan)
+    return plan
+
+
+def _remember(plan):
+    _plans[plan.name] = plan
+    _plans.move_to_end(plan.name)
+    while len(_plans) > MAX_PLANS:
+        _plans.popitem(last=False)
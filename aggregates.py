@@ -0,0 +1,116 @@
+'''
+compact group-by accumulators: one small list per group instead of every value of the group
+an accumulator is [count, sum, min, max]
+'''
+
+AGGREGATES = ("count", "sum", "mean", "min", "max")
+
+
+def new_acc():
+    return [0, 0.0, None, None]
+
+
+def add(acc, value):
+    acc[0] += 1
+    acc[1] += value
+    if acc[2] is None or value < acc[2]:
+        acc[2] = value
+    if acc[3] is None or value > acc[3]:
+        acc[3] = value
+    return acc
+
+
+def add_count(acc):
+    ''' count a row whose value is not numeric (only meaningful for count) '''
+    acc[0] += 1
+    return acc
+
+
+def merge(acc, other):
+    acc[0] += other[0]
+    acc[1] += other[1]
+    if other[2] is not None and (acc[2] is None or other[2] < acc[2]):
+        acc[2] = other[2]
+    if other[3] is not None and (acc[3] is None or other[3] > acc[3]):
+        acc[3] = other[3]
+    return acc
+
+
+def result(acc, agg):
+    count, total, low, high = acc
+    if agg == "mean":
+        return total / count if count else 0
+    elif agg == "min":
+        return low if low is not None else 0
+    elif agg == "max":
+        return high if high is not None else 0
+    elif agg == "sum":
+        return total if count else 0
+    elif agg == "count":
+        return count
+    return None
+
+
+def parse_specs(text):
+    '''
+    "count,sum:salary,avg:salary" -> [(label, aggregate, field)], e.g. ("avg:salary", "mean", "salary");
+    each may also be written SQL style: "count(*), avg(Electric Range), max(Base MSRP)".
+    count without a field counts records, with one the records where the field is set.
+    raises ValueError for an unknown aggregate or a missing field
+    '''
+    specs = []
+    for label in (part.strip() for part in text.split(',')):
+        if not label:
+            continue
+        if label.endswith(')') and '(' in label:
+            agg, _, field = label[:-1].partition('(')
+            agg, field = agg.strip().lower(), field.strip()
+            field = '' if field == '*' else field
+        else:
+            agg, _, field = label.partition(':')
+        agg = "mean" if agg == "avg" else agg
+        if agg not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate '{agg}'")
+        if agg != "count" and not field:
+            raise ValueError(f"Aggregate '{agg}' needs a field, e.g. {agg}:column")
+        specs.append((label, agg, field or None))
+    return specs
+
+
+def to_number(value):
+    ''' a record value as a number, None when it is not numeric '''
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def new_accs(specs):
+    return [new_acc() for _ in specs]
+
+
+def add_record(accs, record, specs):
+    ''' fold one record into the accumulators of parse_specs specs '''
+    for acc, (_, agg, field) in zip(accs, specs):
+        if agg == "count":
+            if field is None or record.get(field) is not None:
+                add_count(acc)
+            continue
+        value = to_number(record.get(field))
+        if value is not None:
+            add(acc, value)
+    return accs
+
+
+def merge_accs(accs, other):
+    for acc, other_acc in zip(accs, other):
+        merge(acc, other_acc)
+    return accs
+
+
+def results(accs, specs):
+    return {label: result(acc, agg) for acc, (label, agg, _) in zip(accs, specs)}
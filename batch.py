@@ -0,0 +1,202 @@
+'''
+column-at-a-time execution for csv chunks (--batch): referenced columns are loaded into NumPy
+arrays BATCH_ROWS rows at a time, --where / --conditions become boolean masks and group-by
+aggregates are computed with np.unique + bincount instead of a dict per row
+'''
+import csv
+import itertools
+import numpy as np
+
+import aggregates
+import text_index
+
+BATCH_ROWS = 16384
+KEY_SEPARATOR = '\x1f'
+
+
+def iter_batches(path, columns=None, keep_rows=False, batch_rows=BATCH_ROWS):
+    '''
+    yields (fieldnames, rows, {column: str array}) per batch; rows are the raw csv lists
+    (only kept when keep_rows, e.g. to write the rows a mask selects)
+    '''
+    with open(path, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        fieldnames = next(reader, None)
+        if fieldnames is None:
+            return
+        wanted = [c for c in (fieldnames if columns is None else columns) if c in fieldnames]
+        positions = {c: fieldnames.index(c) for c in wanted}
+        width = len(fieldnames)
+
+        while True:
+            rows = list(itertools.islice(reader, batch_rows))
+            if not rows:
+                break
+            # short rows read as '' like DictReader's missing values would compare
+            fields = list(zip(*(row if len(row) >= width else row + [''] * (width - len(row))
+                                for row in rows)))
+            arrays = {c: np.array(fields[i], dtype=str) for c, i in positions.items()}
+            yield fieldnames, rows if keep_rows else None, arrays
+
+
+def to_float(values):
+    '''
+    str array -> float array, NaN where a value is not numeric
+    '''
+    try:
+        return values.astype(float)
+    except ValueError:
+        pass
+    # text columns repeat a lot, so only the distinct values go through float()
+    unique, inverse = np.unique(values, return_inverse=True)
+    return np.array([_float_or_nan(v) for v in unique.tolist()], dtype=float)[inverse]
+
+
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def condition_mask(values, condition):
+    '''
+    vectorized evaluate_condition over one column
+    '''
+    op = condition.get("operator", "eq")
+    value = condition["value"]
+    if op in ("gt", "lt", "ge", "le"):
+        numbers = to_float(values)
+        target = float(value)
+        with np.errstate(invalid='ignore'):
+            return {"gt": np.greater, "lt": np.less, "ge": np.greater_equal,
+                    "le": np.less_equal}[op](numbers, target)
+    elif op == "contains":
+        return np.char.find(values, value) >= 0
+    elif op == "match":
+        # the word test runs once per distinct value
+        unique, inverse = np.unique(values, return_inverse=True)
+        return np.array([text_index.match(v, value) for v in unique.tolist()], dtype=bool)[inverse]
+    # eq / ne compare the raw strings, a non-string value never equals a csv field
+    if not isinstance(value, str):
+        return np.full(len(values), op == "ne")
+    return values != value if op == "ne" else values == value
+
+
+def where_mask(arrays, conditions_dict, length):
+    '''
+    AND of every condition whose column exists in the batch
+    '''
+    mask = np.ones(length, dtype=bool)
+    for key, cond in conditions_dict.items():
+        if key in arrays:
+            mask &= condition_mask(arrays[key], cond)
+    return mask
+
+
+def group_keys(keys):
+    '''
+    unique keys in first-seen order and the group index of every row
+    '''
+    unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return unique[order], rank[inverse]
+
+
+def group_accumulators(inverse, groups, numbers, count_all=False):
+    '''
+    one aggregates accumulator [count, sum, min, max] per group over the numeric values;
+    with count_all the count includes rows whose value is not numeric
+    '''
+    valid = ~np.isnan(numbers)
+    idx, vals = inverse[valid], numbers[valid]
+    counts = np.bincount(inverse if count_all else idx, minlength=groups)
+    sums = np.bincount(idx, weights=vals, minlength=groups)
+    numeric = np.bincount(idx, minlength=groups)
+    lows = np.full(groups, np.inf)
+    highs = np.full(groups, -np.inf)
+    np.minimum.at(lows, idx, vals)
+    np.maximum.at(highs, idx, vals)
+
+    return [[int(counts[g]), float(sums[g]),
+             float(lows[g]) if numeric[g] else None,
+             float(highs[g]) if numeric[g] else None] for g in range(groups)]
+
+
+def chunk_group_pairs(path, group_column, agg):
+    '''
+    batch counterpart of group_and_aggregate_chunk: yields (group, accumulator) per group and batch,
+    to be folded with aggregates.merge
+    '''
+    for _, _, arrays in iter_batches(path, [group_column]):
+        if group_column not in arrays:
+            return
+        keys = arrays[group_column]
+        # groupby aggregates the grouped column itself
+        numbers = to_float(keys)
+        if agg != "count":
+            keep = ~np.isnan(numbers)
+            keys, numbers = keys[keep], numbers[keep]
+        unique, inverse = group_keys(keys)
+        yield from zip(unique.tolist(), group_accumulators(inverse, len(unique), numbers, agg == "count"))
+
+
+def chunk_group_specs(path, group_columns, specs, stats=None):
+    '''
+    batch counterpart of csv_file.group_rows: yields (key, [accumulator per aggregates.parse_specs spec])
+    per group and batch, the key a tuple for several group columns; to be folded with aggregates.merge_accs
+    '''
+    fields = [field for _, _, field in specs if field is not None]
+    for _, _, arrays in iter_batches(path, list(group_columns) + fields):
+        if any(column not in arrays for column in group_columns):
+            return
+        length = len(arrays[group_columns[0]])
+        if stats is not None:
+            stats["rows_in"] += length
+        # several columns group by their values joined with a separator, split again for the keys
+        keys = arrays[group_columns[0]]
+        for column in group_columns[1:]:
+            keys = np.char.add(np.char.add(keys, KEY_SEPARATOR), arrays[column])
+        unique, inverse = group_keys(keys)
+        groups = len(unique)
+
+        per_spec = []
+        for _, agg, field in specs:
+            if agg == "count":
+                # a csv row always has the field, counting it counts the rows
+                per_spec.append(group_accumulators(inverse, groups, np.zeros(length), count_all=True))
+            else:
+                per_spec.append(group_accumulators(inverse, groups, to_float(arrays[field])))
+
+        for g, key in enumerate(unique.tolist()):
+            if len(group_columns) > 1:
+                key = tuple(key.split(KEY_SEPARATOR))
+            yield key, [accs[g] for accs in per_spec]
+
+
+def groupby_columns(path, group_column, agg, stats=None):
+    '''
+    batch counterpart of perform_groupby (every numeric column aggregated per group);
+    returns {group: {column: value}}
+    '''
+    merged = {}
+    for fieldnames, _, arrays in iter_batches(path):
+        if stats is not None:
+            stats["rows_in"] += len(arrays[group_column])
+        unique, inverse = group_keys(arrays[group_column])
+        keys = unique.tolist()
+        for col in fieldnames:
+            accs = group_accumulators(inverse, len(keys), to_float(arrays[col]))
+            for key, acc in zip(keys, accs):
+                # like perform_groupby, a column only shows up for groups with numeric values in it
+                if acc[0]:
+                    group = merged.setdefault(key, {})
+                    if col in group:
+                        aggregates.merge(group[col], acc)
+                    else:
+                        group[col] = acc
+
+    return {key: {col: aggregates.result(acc, agg) for col, acc in cols.items()}
+            for key, cols in merged.items()}
@@ -0,0 +1,140 @@
+'''
+per-chunk column statistics and the schema of a csv table, collected by load-tb while it writes the
+chunks. table/.chunk_stats.json holds the header, the type of every column ("number" when all of its
+non-empty values parse as numbers, "text" otherwise, as csv_file.infer_types guesses from a sample)
+and for every chunk its (size, mtime_ns) stamp, row count and per column the number of empty values,
+the smallest and largest value as text and, for a numeric column, as numbers.
+an entry only describes its chunk while the stamp matches: a chunk changed since (ins-cval, del-rows,
+update-rows) is scanned as usual until the next load
+'''
+import os
+import json
+
+import table_cache
+
+STATS_FILE = '.chunk_stats.json'
+
+
+def stats_path(table_path):
+    return os.path.join(table_path, STATS_FILE)
+
+
+def column_stats(values):
+    ''' the statistics of one column of a chunk, values as read from the csv '''
+    present = [value for value in values if value]
+    stats = {"empty": len(values) - len(present)}
+    if present:
+        stats["min"], stats["max"] = min(present), max(present)
+        try:
+            numbers = [float(value) for value in present]
+        except ValueError:
+            numbers = None
+        if numbers is not None:
+            stats["number_min"], stats["number_max"] = min(numbers), max(numbers)
+    return stats
+
+
+def is_number(stats):
+    return "number_min" in stats or "min" not in stats
+
+
+def write(table_path, header, chunks):
+    '''
+    record the header, the column types and the stats of chunks [(chunk_path, rows, [column stats])]
+    '''
+    types = {column: "number" for column in header}
+    entries = {}
+    for chunk_path, rows, columns in chunks:
+        for column, stats in zip(header, columns):
+            if not is_number(stats):
+                types[column] = "text"
+        entries[os.path.basename(chunk_path)] = {
+            "stamp": _stamp(chunk_path), "rows": rows, "columns": dict(zip(header, columns))}
+
+    path = stats_path(table_path)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({"columns": list(header), "types": types, "chunks": entries}, f)
+    os.replace(temp_path, path)
+
+
+def drop(table_path):
+    if os.path.exists(stats_path(table_path)):
+        os.remove(stats_path(table_path))
+
+
+def load(table_path):
+    path = stats_path(table_path)
+    if not os.path.exists(path):
+        return None
+    return table_cache.get(path, _read)
+
+
+def fresh_entries(table_path):
+    ''' {chunk_path: entry} of the chunks whose stats still describe them '''
+    data = load(table_path)
+    if data is None:
+        return {}
+    entries = {}
+    for name, entry in data["chunks"].items():
+        chunk_path = os.path.join(table_path, name)
+        if os.path.exists(chunk_path) and entry["stamp"] == _stamp(chunk_path):
+            entries[chunk_path] = entry
+    return entries
+
+
+def schema(paths):
+    '''
+    {column: "number" | "text"} of the table the paths are the chunks of, None unless they are all
+    chunks of one loaded table and unchanged since
+    '''
+    if not paths:
+        return None
+    table_path = os.path.dirname(paths[0])
+    data = load(table_path)
+    if data is None or any(os.path.dirname(path) != table_path for path in paths):
+        return None
+    entries = fresh_entries(table_path)
+    if any(path not in entries for path in paths):
+        return None
+    return data["types"]
+
+
+def may_match(entry, conditions):
+    '''
+    False when the stats of a chunk show that no row satisfies conditions, as filter-tb evaluates
+    them: eq compares text, gt / lt / ge / le compare numbers. only decided for columns with no
+    empty values, which fail the numeric comparisons with an error
+    '''
+    for column, condition in conditions.items():
+        stats = entry["columns"].get(column)
+        if stats is None or not isinstance(condition, dict):
+            continue
+        op = condition.get("operator", "eq")
+        value = condition.get("value")
+        if op == "eq" and isinstance(value, str):
+            if value == "":
+                if stats["empty"] == 0:
+                    return False
+            elif "min" not in stats or not stats["min"] <= value <= stats["max"]:
+                return False
+        elif op in ("gt", "lt", "ge", "le") and "number_min" in stats and stats["empty"] == 0:
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                continue
+            low, high = stats["number_min"], stats["number_max"]
+            if (op == "gt" and high <= number) or (op == "ge" and high < number) or \
+                    (op == "lt" and low >= number) or (op == "le" and low > number):
+                return False
+    return True
+
+
+def _read(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
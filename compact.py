@@ -0,0 +1,124 @@
+'''
+compact in-memory form of a JSON array table for the table cache and the on-disk snapshots
+(see snapshot): the records share one key
+schema (the keys of the first record, in order) and each record that has exactly those keys is
+kept as a tuple of its values; any other record stays the dict it was parsed as. Repeated string
+values are stored once. A Records reads like a list of dicts, building each dict on access, so
+every *-jval operator runs on it unchanged while the cached table takes a fraction of the memory
+of the parsed dicts.
+'''
+import copy
+import json
+from collections.abc import Sequence
+
+import json_split
+import snapshot
+import table_cache
+
+# strings longer than this are rarely repeated and are not worth a lookup
+SHARE_CHARS = 64
+
+
+class Records(Sequence):
+    __slots__ = ('keys', 'rows')
+
+    def __init__(self, records=()):
+        self.keys = None
+        self.rows = []
+        shared = {}
+        for record in records:
+            self.append(record, shared)
+
+    def append(self, record, shared=None):
+        if not isinstance(record, dict):
+            self.rows.append(record)
+            return
+        if self.keys is None:
+            self.keys = tuple(record)
+        if tuple(record) != self.keys:
+            self.rows.append(record)
+        elif shared is None:
+            self.rows.append(tuple(record.values()))
+        else:
+            self.rows.append(tuple([shared.setdefault(value, value)
+                                    if type(value) is str and len(value) <= SHARE_CHARS else value
+                                    for value in record.values()]))
+
+    def record(self, row):
+        return dict(zip(self.keys, row)) if type(row) is tuple else row
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self.record(row) for row in self.rows[position]]
+        return self.record(self.rows[position])
+
+    def __iter__(self):
+        keys = self.keys
+        for row in self.rows:
+            yield dict(zip(keys, row)) if type(row) is tuple else row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+    def to_list(self):
+        '''
+        the records as a list of new dicts that can be changed and written back; the dicts kept for
+        records without the shared keys and nested lists and objects are copied, so the cached
+        table is never changed through them
+        '''
+        keys = self.keys
+        records = []
+        for row in self.rows:
+            if type(row) is tuple:
+                row = zip(keys, row)
+            elif isinstance(row, dict):
+                row = row.items()
+            else:
+                records.append(copy.deepcopy(row))
+                continue
+            records.append({key: copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+                            for key, value in row})
+        return records
+
+
+def load(path):
+    '''
+    Records of a JSON array file, from its snapshot when the file is unchanged since it was taken,
+    otherwise built while streaming through the file (so the parsed dicts never all exist at once)
+    and snapshotted; a file that does not hold an array is returned as json.load would
+    '''
+    found = snapshot.load(path)
+    if found is not None:
+        records = Records()
+        records.keys, records.rows = found
+        return records
+
+    source_stamp = snapshot.stamp(path)
+    with open(path, 'r') as f:
+        head = f.read(1)
+        while head and head.isspace():
+            head = f.read(1)
+        if head != '[':
+            f.seek(0)
+            return json.load(f)
+    records = Records(json_split.iter_array(path))
+    snapshot.save(path, source_stamp, records.keys, records.rows)
+    return records
+
+
+def cached(path):
+    '''
+    the records of a JSON array file, as Records while the table cache (kept in memory by the daemon)
+    or the snapshots are on
+    '''
+    if table_cache.enabled() or snapshot.enabled():
+        return table_cache.get(path, load)
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def is_table(data):
+    return isinstance(data, (list, Records))
@@ -3,12 +3,14 @@ import os
 import sys
 import json
 import csv
-import heapq
-import tempfile
 import itertools
 from collections import defaultdict
-from operator import itemgetter
 import operator
+import table_cache
+import row_index
+import text_index
+import writers
+import ordering
 
 
 def get_last_chunk_file(table_path, chunk_prefix):
@@ -53,17 +55,113 @@ def ins_cval(db, table, values, chunk_size=5000):
         output_file_path = os.path.join(
             table_path, f'chunk_{chunk_number}.csv')
 
+    # opened (and rebuilt when stale) before the chunk changes, so the new row can be added to them
+    indexes = text_indexes(table_path)
     with open(output_file_path, 'a', newline='') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=values_dict.keys())
         if csvfile.tell() == 0:
             writer.writeheader()
+        row_start = csvfile.tell()
         writer.writerow(values_dict)
+    row_index.append(output_file_path, row_start)
+    for index in indexes:
+        index.add(values_dict, output_file_path, row_index.row_count(output_file_path) - 1)
+        index.stamp(output_file_path)
+        index.save()
 
     click.echo(f"Values inserted successfully into {output_file_path}")
 
 
 def get_chunk_files(table_path):
-    return [f for f in os.listdir(table_path) if f.startswith('chunk_') and f.endswith('.csv')]
+    return table_cache.get(table_path, lambda path: [
+        f for f in os.listdir(path) if f.startswith('chunk_') and f.endswith('.csv')])
+
+
+def get_ordered_chunk_files(table_path):
+    '''
+    chunk_N.csv files in N order, the order row positions are counted in
+    '''
+    numbered = [f for f in get_chunk_files(table_path) if f[len('chunk_'):-len('.csv')].isdigit()]
+    return sorted(numbered, key=lambda f: int(f[len('chunk_'):-len('.csv')]))
+
+
+def text_index_for(table_path, column):
+    '''
+    the text index of a table column over its chunks in N order; rows are located by (chunk, position)
+    '''
+    chunk_paths = [os.path.join(table_path, chunk) for chunk in get_ordered_chunk_files(table_path)]
+    return text_index.TextIndex(table_path, chunk_paths, column, row_index.scan, lambda row: row.get(column))
+
+
+def text_indexes(table_path):
+    return [text_index_for(table_path, column) for column in text_index.declared(table_path)]
+
+
+@click.command()
+@click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
+@click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
+@click.option("--column", prompt="Enter the column to index", help="The column to index")
+@click.option("--drop", is_flag=True, help="Remove the index instead of building it.")
+def create_index_tb(db, table, column, drop):
+    '''
+    Build an inverted text index on a column, used by filter-tb for "contains" and "match" conditions
+    python3 main.py create-index-tb --db=ev --table=ev_data --column="Electric Utility"
+    '''
+    table_path = os.path.join('database', db, table)
+    if not os.path.exists(table_path):
+        click.echo("Table does not exist.")
+        sys.exit(1)
+
+    if drop:
+        if not text_index.drop(table_path, column):
+            click.echo(f"No text index on '{column}'.")
+            sys.exit(1)
+        click.echo(f"Dropped the text index on '{column}'.")
+        return
+
+    text_index.drop(table_path, column)
+    index = text_index_for(table_path, column)
+    index.save()
+    count = sum(len(locations) for locations in index.data["locations"])
+    click.echo(f"Built a text index on '{column}' over {count} rows.")
+
+
+@click.command()
+@click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
+@click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
+@click.option("--start", default=0, type=int, help="Position of the first row (0-based)")
+@click.option("--limit", default=10, type=int, help="Number of rows to fetch")
+@click.option("--chunk", default=None, type=int, help="Count positions within chunk_N.csv instead of the whole table")
+def get_rows(db, table, start, limit, chunk):
+    '''
+    fetch rows by position through the per-chunk row-offset index, without scanning the rows before them
+    python3 main.py get-rows --db=ev --table=ev_data --chunk=9 --start=4312 --limit=1
+    '''
+    db_path = os.path.join('database', db)
+    table_path = os.path.join(db_path, table)
+
+    if not os.path.exists(table_path):
+        click.echo("Table does not exist.")
+        sys.exit(1)
+
+    if start < 0 or limit < 0:
+        click.echo("--start and --limit must not be negative.")
+        sys.exit(1)
+
+    if chunk is not None:
+        chunk_paths = [os.path.join(table_path, f'chunk_{chunk}.csv')]
+        if not os.path.exists(chunk_paths[0]):
+            click.echo(f"Chunk {chunk} does not exist.")
+            sys.exit(1)
+    else:
+        chunk_paths = [os.path.join(table_path, f) for f in get_ordered_chunk_files(table_path)]
+
+    writer = None
+    for _, _, row in row_index.iter_table_rows(chunk_paths, start, start + limit):
+        if writer is None:
+            writer = csv.DictWriter(sys.stdout, fieldnames=list(row.keys()), extrasaction='ignore')
+            writer.writeheader()
+        writer.writerow(row)
 
 
 def del_rows_in_chunk(input_file, conditions_dict, output_file):
@@ -104,6 +202,7 @@ def del_rows(db, table, conditions):
         temp_chunk_path = os.path.join(table_path, f"temp_{chunk}")
         del_rows_in_chunk(chunk_path, conditions_dict, temp_chunk_path)
         os.replace(temp_chunk_path, chunk_path)
+        row_index.build(chunk_path)
 
     click.echo("Rows deleted successfully in all chunks.")
 
@@ -212,6 +311,7 @@ def update_rows(db, table, conditions):
         temp_chunk_path = os.path.join(table_path, f"temp_{chunk}")
         update_rows_in_chunk(chunk_path, conditions_dict, temp_chunk_path)
         os.replace(temp_chunk_path, chunk_path)
+        row_index.build(chunk_path)
 
     click.echo("Rows updated successfully in all chunks.")
 
@@ -223,7 +323,8 @@ operators = {
     "le": operator.le,
     "eq": operator.eq,
     "ne": operator.ne,
-    "contains": lambda a, b: b in a
+    "contains": lambda a, b: b in a,
+    "match": text_index.match
 }
 
 
@@ -232,14 +333,26 @@ def evaluate_condition(row_value, condition):
     value = condition["value"]
     if op in ["gt", "lt", "ge", "le"]:
         return operators[op](float(row_value), float(value))
-    elif op == "contains":
+    elif op in ("contains", "match"):
         return operators[op](row_value, value)
     else:  # eq, ne
         return operators[op](row_value, value)
 # filter
 
 
+def row_predicate(conditions_dict):
+    ''' the row -> bool test of filter conditions, as a physical.Filter predicate; columns a row lacks are ignored '''
+    return lambda row: all(evaluate_condition(row[key], cond) for key, cond in conditions_dict.items() if key in row)
+
+
+def count_rows(rows, stats):
+    for row in rows:
+        stats["rows_in"] += 1
+        yield row
+
+
 def filter_rows_in_chunk(input_file, conditions_dict, output):
+    import physical
     with open(input_file, 'r', newline='') as csvfile:
         reader = csv.DictReader(csvfile)
 
@@ -254,23 +367,64 @@ def filter_rows_in_chunk(input_file, conditions_dict, output):
             if output == sys.stdout:
                 writer.writeheader()
 
-        for row in reader:
-            if all(evaluate_condition(row[key], cond) for key, cond in conditions_dict.items() if key in row):
-                writer.writerow(row)
+        writer.writerows(physical.Filter(physical.Scan(reader), row_predicate(conditions_dict)).records())
 
         if isinstance(output, str):
             output_file.close()
 
 
+def filter_rows_at(input_file, positions, conditions_dict, output):
+    '''
+    filter_rows_in_chunk over only the rows at positions (as found by a text index)
+    '''
+    import physical
+    with open(input_file, 'r', newline='') as csvfile:
+        fieldnames = next(csv.reader(csvfile), [])
+
+    output_file = open(output, 'w', newline='') if isinstance(output, str) else output
+    writer = csv.DictWriter(output_file, fieldnames=fieldnames, extrasaction='ignore')
+    if isinstance(output, str) or output == sys.stdout:
+        writer.writeheader()
+    writer.writerows(physical.Filter(physical.Scan(row_index.read_positions(input_file, positions)),
+                                     row_predicate(conditions_dict)).records())
+    if isinstance(output, str):
+        output_file.close()
+
+
+def filter_rows_in_chunk_batch(input_file, conditions_dict, output):
+    '''
+    filter_rows_in_chunk evaluating the conditions as NumPy masks, one batch of rows at a time
+    '''
+    import batch
+
+    output_file = open(output, 'w', newline='') if isinstance(output, str) else output
+    writer = csv.writer(output_file)
+    header_written = False
+    for fieldnames, rows, arrays in batch.iter_batches(input_file, list(conditions_dict), keep_rows=True):
+        if not header_written and (isinstance(output, str) or output == sys.stdout):
+            writer.writerow(fieldnames)
+        header_written = True
+        mask = batch.where_mask(arrays, conditions_dict, len(rows))
+        writer.writerows(itertools.compress(rows, mask))
+
+    if isinstance(output, str):
+        output_file.close()
+
+
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
 @click.option("--conditions", prompt="Enter the update conditions as a JSON string", help="The conditions for row update", required=True)
 @click.option("--save", prompt="Save the output to a file? (yes/no)", default='no', help="Whether to save the output to a file", required=False)
-def filter_tb(db, table, conditions, save):
+@click.option("--batch", is_flag=True, help="Evaluate the conditions column-wise with NumPy")
+def filter_tb(db, table, conditions, save, batch):
     '''
     python3 main.py filter-tb --db=ev --table=ev_data --conditions '{"Make": {"operator": "eq", "value": "TESLA"}}'
+    add --batch for the vectorized path; "contains" / "match" conditions on a column with a text index
+    (create-index-tb) only read the rows the index finds, eq / gt / lt / ge / le conditions skip the
+    chunks whose stats (load-tb) rule them out
     '''
+    import chunk_stats
     db_path = os.path.join('database', db)
     table_path = os.path.join(db_path, table)
 
@@ -285,13 +439,28 @@ def filter_tb(db, table, conditions, save):
         click.echo("Invalid JSON string.")
         sys.exit(1)
 
+    locations = None
+    if isinstance(conditions_dict, dict):
+        chunk_paths = [os.path.join(table_path, chunk) for chunk in get_ordered_chunk_files(table_path)]
+        locations = text_index.candidates(table_path, chunk_paths, conditions_dict, row_index.scan,
+                                          lambda row, column: row.get(column))
+
+    # chunks whose load-tb stats rule out every row are not read
+    entries = chunk_stats.fresh_entries(table_path) if isinstance(conditions_dict, dict) else {}
     chunk_files = get_chunk_files(table_path)
     for chunk in chunk_files:
         chunk_path = os.path.join(table_path, chunk)
         output_file_path = os.path.join(
             table_path, f"filtered_{chunk}") if save.lower() == 'yes' else sys.stdout
 
-        filter_rows_in_chunk(chunk_path, conditions_dict, output_file_path)
+        if chunk_path in entries and not chunk_stats.may_match(entries[chunk_path], conditions_dict):
+            filter_rows_at(chunk_path, [], conditions_dict, output_file_path)
+        elif locations is not None:
+            filter_rows_at(chunk_path, locations.get(chunk_path, []), conditions_dict, output_file_path)
+        elif batch:
+            filter_rows_in_chunk_batch(chunk_path, conditions_dict, output_file_path)
+        else:
+            filter_rows_in_chunk(chunk_path, conditions_dict, output_file_path)
 
     if save.lower() == 'yes':
         click.echo(f"Filtered data saved in {table_path} directory.")
@@ -311,12 +480,15 @@ ASCEDNING_OPTION = {
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
-@click.option("--column", prompt="Enter the column to order by", help="The column to order by", required=True)
-@click.option("--ascending", prompt="Ascending (T/F)", default='T', help="Sorting method", required=False)
+@click.option("--column", prompt="Enter the column(s) to order by", help="Column(s) to order by, comma-separated, each optionally followed by asc or desc", required=True)
+@click.option("--ascending", prompt="Ascending (T/F)", default='T', help="Direction of the columns given without one", required=False)
+@click.option("--nulls", type=click.Choice(ordering.NULLS), default='last', help="Sort empty values first or last", required=False)
 @click.option("--save", prompt="Save the output to a file? (yes/no)", default='no', help="Whether to save the output to a file", required=False)
-def order_tb(db, table, column, ascending, save):
+def order_tb(db, table, column, ascending, nulls, save):
     '''
     python3 main.py order-tb --db=ev --table=ev_data --column="2020 Census Tract" --ascending=F
+    or --column='Make asc, Electric Range desc' to sort by several columns, each in its own direction;
+    numeric columns sort by value, empty values go last (--nulls=first), ties keep their table order
     '''
     db_path = os.path.join('database', db)
     table_path = os.path.join(db_path, table)
@@ -325,137 +497,196 @@ def order_tb(db, table, column, ascending, save):
         click.echo("Table does not exist.")
         sys.exit(1)
 
-    reverse = not ASCEDNING_OPTION[ascending]
-    final_sorted_chunks = []
-    chunk_files = get_chunk_files(table_path)
+    try:
+        order = ordering.parse_order(column, descending=not ASCEDNING_OPTION[ascending])
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
+    chunk_paths = [os.path.join(table_path, chunk) for chunk in get_ordered_chunk_files(table_path)]
+    if not order or not chunk_paths:
+        click.echo("Nothing to sort.")
+        sys.exit(1)
 
-    for chunk in chunk_files:
-        chunk_path = os.path.join(table_path, chunk)
-        sorted_chunk = sort_and_merge_chunk(chunk_path, column, reverse)
-        final_sorted_chunks.append(sorted_chunk)
+    try:
+        fieldnames, rows = sorted_rows(chunk_paths, order, nulls)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
 
     if save.lower() == 'yes':
         final_output_file = os.path.join(table_path, f"{table}_sorted.csv")
-        merge_chunks(final_sorted_chunks, final_output_file, column)
+        with open(final_output_file, 'w', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(fieldnames)
+            writer.writerows(rows)
         click.echo(f"Sorted data saved to {final_output_file}")
     else:
-        for sorted_chunk in final_sorted_chunks:
-            with open(sorted_chunk, 'r', newline='') as csvfile:
-                reader = csv.reader(csvfile)
-                for row in reader:
-                    print(','.join(row))
-            os.remove(sorted_chunk)
+        writer = csv.writer(sys.stdout)
+        writer.writerow(fieldnames)
+        writer.writerows(rows)
 
 
-def external_sort(filename, column, reverse):
+def infer_types(paths, columns, sample_rows=1000):
     '''
-    perform external sort, the file will be place into temp files of chunks and sort then merged
+    {column: "number"} for the columns whose non-empty values all parse as numbers in the first sample_rows
+    rows, "text" for the others (compared as strings, even the values that look like numbers); taken from
+    the schema of the whole table when the paths are the chunks of a table loaded with load-tb
     '''
-    chunk_files = break_into_sorted_chunks(filename, column, reverse)
-    merge_chunks(chunk_files, filename, column)
-
-
-def break_into_sorted_chunks(filename, column, reverse):
+    import chunk_stats
+    schema = chunk_stats.schema(paths)
+    if schema is not None and all(column in schema for column in columns):
+        return {column: schema[column] for column in columns}
+    types = {column: "number" for column in columns}
+    seen = 0
+    for path in paths:
+        with open(path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                for column in columns:
+                    if types[column] == "number" and row.get(column):
+                        try:
+                            float(row[column])
+                        except ValueError:
+                            types[column] = "text"
+                seen += 1
+                if seen >= sample_rows:
+                    return types
+    return types
+
+
+def sorted_rows(paths, order, nulls="last", stats=None):
     '''
-    breaking the files into disired chunks size, default is 5000 (lines)
+    (fieldnames, rows in parse_order order) of csv files sharing a header; every row's typed key is
+    encoded once (see ordering.encode_func) and the sort runs and their merge compare those keys.
+    an empty value is a null. raises ValueError for a column the files do not have
     '''
-    chunk_size = 5000
-    chunk_files = []
-
-    with open(filename, 'r', newline='') as file:
-        reader = csv.DictReader(file)
-        # return the iterator of the reader
-        chunk = list(itertools.islice(reader, chunk_size))
-        # creating the temperary files
-        while chunk:
-            tmpfile = tempfile.NamedTemporaryFile(
-                delete=False, mode='w', newline='')
-            chunk_files.append(tmpfile.name)
-            writer = csv.DictWriter(tmpfile, fieldnames=reader.fieldnames)
-            writer.writeheader()
-            if reverse:
-                writer.writerows(sorted(chunk, key=lambda x: x[column]))
-            else:
-                writer.writerows(
-                    sorted(chunk, key=lambda x: x[column], reverse=True))
-            tmpfile.close()
-            chunk = list(itertools.islice(reader, chunk_size))
-
-    return chunk_files
-
-
-def sort_chunk(input_file, column, reverse):
-    sorted_file_path = input_file + "_sorted.csv"
-    with open(input_file, 'r', newline='') as file, open(sorted_file_path, 'w', newline='') as outfile:
-        reader = csv.DictReader(file)
-        writer = csv.DictWriter(outfile, fieldnames=reader.fieldnames)
-        writer.writeheader()
-        sorted_rows = sorted(
-            reader, key=lambda row: row[column], reverse=reverse)
-        writer.writerows(sorted_rows)
-    return sorted_file_path
-
-
-def merge_chunks(chunk_files, output_file, column):
-    with open(output_file, 'w', newline='') as file:
-        files = [open(chunk_file, 'r', newline='')
-                 for chunk_file in chunk_files]
-        readers = [csv.DictReader(f) for f in files]
-
-        writer = csv.DictWriter(file, fieldnames=readers[0].fieldnames)
-        writer.writeheader()
-
-        merged = heapq.merge(*readers, key=lambda x: x[column])
-        for row in merged:
-            writer.writerow(row)
+    import physical
+    with open(paths[0], 'r', newline='') as f:
+        fieldnames = next(csv.reader(f), [])
+    missing = [field for field, _ in order if field not in fieldnames]
+    if missing:
+        raise ValueError(f"Column(s) {', '.join(missing)} not found in the table.")
+
+    positions = {field: fieldnames.index(field) for field, _ in order}
+    key = ordering.encode_func(order, nulls, infer_types(paths, list(positions)),
+                               lambda row, field: (row[positions[field]] or None) if positions[field] < len(row) else None)
+
+    def keyed_rows():
+        for path in paths:
+            with open(path, 'r', newline='') as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                for row in reader:
+                    if stats is not None:
+                        stats["rows_in"] += 1
+                    yield key(row), row
 
-        # Close all the file objects
-        for f in files:
-            f.close()
+    ordered = physical.ExternalSort(physical.Scan(keyed_rows()), operator.itemgetter(0)).records()
+    return fieldnames, (row for _, row in ordered)
 
 
-def sort_and_merge_chunk(chunk_file, column, reverse):
-    sorted_sub_chunk_files = break_into_sorted_chunks(
-        chunk_file, column, reverse)
-    merged_chunk_file = chunk_file + "_sorted.csv"
-    merge_chunks(sorted_sub_chunk_files, merged_chunk_file, column)
-    return merged_chunk_file
+def external_sort(filename, order, nulls="last", stats=None):
+    '''
+    sort a csv file in place by parse_order order (see sorted_rows), sorted runs spill to temp files
+    '''
+    fieldnames, rows = sorted_rows([filename], order, nulls, stats)
+    temp_path = filename + '.sorting'
+    with open(temp_path, 'w', newline='') as output:
+        writer = csv.writer(output)
+        writer.writerow(fieldnames)
+        writer.writerows(rows)
+    os.replace(temp_path, filename)
 
 
 def group_and_aggregate_chunk(chunk_file, group_column, agg):
-    group_data = defaultdict(lambda: defaultdict(list))
+    '''
+    yields (group, value) for every row of the chunk, value is None when it is not numeric
+    '''
     with open(chunk_file, 'r', newline='') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
             try:
                 value = float(row[group_column])
-                group_data[row[group_column]][group_column].append(value)
+                yield row[group_column], value
             except ValueError:
                 if agg == "count":
-                    group_data[row[group_column]][group_column].append(
-                        1)  # For count, just add 1
-    return group_data
+                    yield row[group_column], None  # For count, just add 1
 
 
 def merge_group_data(all_group_data):
-    merged_data = defaultdict(lambda: defaultdict(list))
-    for group_data in all_group_data:
-        for group, values in group_data.items():
-            for col, vals in values.items():
-                merged_data[group][col].extend(vals)
-    return merged_data
+    '''
+    fold the (group, value) pairs of all chunks into one compact accumulator per group,
+    spilling to disk past --memory-limit; yields (group, accumulator)
+    '''
+    import aggregates
+    import spill
+
+    def update(acc, value):
+        return aggregates.add_count(acc) if value is None else aggregates.add(acc, value)
+
+    return spill.hash_aggregate(itertools.chain.from_iterable(all_group_data), aggregates.new_acc, update)
+
+
+def group_specs(agg):
+    '''
+    aggregates.parse_specs specs of --agg, None for a single bare aggregate (count, sum, mean, min, max),
+    which aggregates the grouped column itself (groupby) or every numeric column (query) as before
+    '''
+    import aggregates
+    if agg.strip() in aggregates.AGGREGATES:
+        return None
+    return aggregates.parse_specs(agg)
+
+
+def group_rows(paths, columns, specs, batch=False, stats=None):
+    '''
+    (key, {label: result}) per distinct value of the group columns (a tuple of values for several)
+    over the rows of csv files; every spec is computed in the same single pass, with one list of
+    accumulators per group (spilled to disk past --memory-limit).
+    raises ValueError for a column the files do not have
+    '''
+    import aggregates
+    import physical
+    import spill
+    with open(paths[0], 'r', newline='') as f:
+        fieldnames = next(csv.reader(f), [])
+    missing = [column for column in list(columns) + [field for _, _, field in specs if field]
+               if column not in fieldnames]
+    if missing:
+        raise ValueError(f"Column(s) {', '.join(dict.fromkeys(missing))} not found in the table.")
+
+    if batch:
+        import batch as batch_mode
+        # per-batch accumulators, folded into the same spilling hash table
+        merged = spill.hash_aggregate(
+            itertools.chain.from_iterable(batch_mode.chunk_group_specs(path, columns, specs, stats) for path in paths),
+            lambda: aggregates.new_accs(specs), aggregates.merge_accs)
+        return ((key, aggregates.results(accs, specs)) for key, accs in merged)
+
+    rows = physical.CsvSource(paths).records()
+    return physical.HashAggregate(physical.Scan(rows if stats is None else count_rows(rows, stats)), columns, specs).groups()
+
+
+def group_records(groups, columns):
+    ''' {column: value, ..., label: result, ...} rows of group_rows pairs '''
+    for key, results in groups:
+        yield {**dict(zip(columns, key if len(columns) > 1 else (key,))), **results}
 
 
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
-@click.option("--column", prompt="Enter the column to group by", help="The column to group by", required=True)
-@click.option("--agg", prompt="Enter the aggregation for group by", help="The aggregation to group by", required=True)
+@click.option("--column", prompt="Enter the column(s) to group by", help="The column(s) to group by, comma-separated", required=True)
+@click.option("--agg", prompt="Enter the aggregation for group by", help="The aggregation, or a list like 'count(*), avg(Electric Range), max(Base MSRP)'", required=True)
 @click.option("--save", prompt="Save the output to a file? (yes/no)", default='no', help="Whether to save the output to a file", required=False)
-def groupby(db, table, column, agg, save):
+@click.option("--batch", is_flag=True, help="Aggregate column-wise with NumPy")
+def groupby(db, table, column, agg, save, batch):
+    import aggregates
+    import spill
     db_path = os.path.join('database', db)
     '''
     python3 main.py groupby --db ev --table ev_data --column Make --agg count
+    or --column='Make,Model Year' --agg='count(*), avg(Electric Range), max(Base MSRP)' for every aggregate
+    of every (Make, Model Year) in one scan (also count:col, avg:col); add --batch for the vectorized path
     '''
     if not os.path.exists(db_path):
         click.echo("Database does not exist.")
@@ -471,22 +702,30 @@ def groupby(db, table, column, agg, save):
         click.echo("No chunk files found in the specified table.")
         sys.exit(1)
 
-    db_path = os.path.join('database', db)
-    table_path = os.path.join(db_path, table)
-    all_group_data = []
-
-    chunk_files = get_chunk_files(table_path)
-    for chunk in chunk_files:
-        chunk_path = os.path.join(table_path, chunk)
-        group_data = group_and_aggregate_chunk(chunk_path, column, agg)
-        all_group_data.append(group_data)
+    try:
+        specs = group_specs(agg)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
+    columns = [name.strip() for name in column.split(',') if name.strip()]
+    if specs is not None or len(columns) > 1:
+        group_table(db_path, table, table_path, columns, specs or aggregates.parse_specs(agg), save, batch)
+        return
 
-    merged_group_data = merge_group_data(all_group_data)
-    final_results = {group: aggregate(vals, agg)
-                     for group, vals in merged_group_data.items()}
+    if batch:
+        import batch as batch_mode
+        # per-batch accumulators, folded into the same spilling hash table
+        merged_group_data = spill.hash_aggregate(
+            itertools.chain.from_iterable(
+                batch_mode.chunk_group_pairs(os.path.join(table_path, chunk), column, agg) for chunk in chunk_files),
+            aggregates.new_acc, aggregates.merge)
+    else:
+        all_group_data = (group_and_aggregate_chunk(os.path.join(table_path, chunk), column, agg)
+                          for chunk in chunk_files)
 
-    fieldnames = ['Group'] + \
-        list(set(k for v in final_results.values() for k in v.keys()))
+        # rows are written as groups come out of the aggregation, never all held at once
+        merged_group_data = merge_group_data(all_group_data)
+    fieldnames = ['Group', column]
 
     if save.lower() == 'yes':
         output_path = os.path.join(db_path, table + "_groupby_temp.csv")
@@ -494,26 +733,51 @@ def groupby(db, table, column, agg, save):
             writer = csv.DictWriter(output, fieldnames=fieldnames)
             writer.writeheader()
 
-            for key, value in final_results.items():
-                row = {'Group': key, **value}
-                writer.writerow(row)
+            for key, acc in merged_group_data:
+                writer.writerow({'Group': key, column: aggregates.result(acc, agg)})
 
         click.echo(f"Grouped data saved to {output_path}")
     else:
         writer = csv.DictWriter(
             sys.stdout, fieldnames=fieldnames, extrasaction='ignore')
         writer.writeheader()
-        for key, value in final_results.items():
-            row = {'Group': key, **value}
-            writer.writerow(row)
+        for key, acc in merged_group_data:
+            writer.writerow({'Group': key, column: aggregates.result(acc, agg)})
+
+
+def group_table(db_path, table, table_path, columns, specs, save, batch=False):
+    '''
+    groupby over several columns and / or aggregates: one row per group with a column per group column
+    and per aggregate, all computed in one scan of the chunks
+    '''
+    chunk_paths = [os.path.join(table_path, chunk) for chunk in get_ordered_chunk_files(table_path)]
+    try:
+        groups = group_rows(chunk_paths, columns, specs, batch)
+        fieldnames = columns + [label for label, _, _ in specs]
+        if save.lower() == 'yes':
+            output_path = os.path.join(db_path, table + "_groupby_temp.csv")
+            with open(output_path, 'w', newline='') as output:
+                writer = csv.DictWriter(output, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(group_records(groups, columns))
+            click.echo(f"Grouped data saved to {output_path}")
+        else:
+            writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(group_records(groups, columns))
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
 
 
-def perform_groupby(filename, group_column, agg, project_columns):
+def perform_groupby(filename, group_column, agg, project_columns, stats=None):
     # used defaultdict to create a dict w/o key existing, avoiding keyerror
     group_data = defaultdict(lambda: defaultdict(list))
     with open(filename, 'r', newline='') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
+            if stats is not None:
+                stats["rows_in"] += 1
             for col in (project_columns if project_columns else reader.fieldnames):
                 try:
                     # Convert value to float for aggregation
@@ -543,78 +807,39 @@ def aggregate(group_data, agg):
     return aggregated_data
 
 
-def external_sort_join(file_path, key_column):
-    with open(file_path, 'r', newline='') as file, \
-            tempfile.NamedTemporaryFile(mode='w+', newline='', delete=False) as outfile:
-
-        reader = csv.DictReader(file)
-        writer = csv.DictWriter(outfile, fieldnames=reader.fieldnames)
-        writer.writeheader()
-        sorted_rows = sorted(reader, key=lambda row: row[key_column])
-        writer.writerows(sorted_rows)
-
-        return outfile.name
-
-
-def sort_merge_join(left_file, right_file, left_column, right_column):
-    with open(left_file, 'r', newline='') as left, open(right_file, 'r', newline='') as right:
-        left_reader = csv.DictReader(left)
-        right_reader = csv.DictReader(right)
-
-        left_iter = itertools.groupby(
-            sorted(left_reader, key=itemgetter(left_column)), key=itemgetter(left_column))
-        right_iter = itertools.groupby(sorted(right_reader, key=itemgetter(
-            right_column)), key=itemgetter(right_column))
-
-        result = []
-        for left_key, left_group in left_iter:
-            right_group = next(
-                (rg for rk, rg in right_iter if rk == left_key), [])
-            for left_row in left_group:
-                for right_row in right_group:
-                    combined_row = {**left_row, **right_row}
-                    result.append(combined_row)
-
-        return result
-
-
-def process_chunk_pair(left_chunk, right_chunk, left_column, right_column):
-    sorted_left = external_sort_join(left_chunk, left_column)
-    sorted_right = external_sort_join(right_chunk, right_column)
-    return sort_merge_join(sorted_left, sorted_right, left_column, right_column)
-
-
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--tbl1", prompt="Enter the name of the (left) table to join", help="The name of the table", required=True)
 @click.option("--tbl2", prompt="Enter the name of the (right) table to join", help="The name of the table", required=True)
 @click.option("--column", prompt="Enter the column to join on", help="The column to join on")
-def join_tb(db, tbl1, tbl2, column):
+@click.option("--output-format", type=click.Choice(writers.FORMATS), default='csv', help="csv, ndjson (one row per line) or json (indented array)")
+@click.option("--output", default=None, help="Write the joined rows to this file instead of printing them")
+def join_tb(db, tbl1, tbl2, column, output_format, output):
     '''
     python3 main.py join-tb --db=ev --tbl1=ev_data --tbl2=emission_standards --column='Model Year','Model Year'
+    add --output=joined.csv (or --output-format=ndjson) to stream the joined rows to a file;
+    either table may be a JSON table of the database (a CSV table joined with a JSON table)
     '''
-    db_path = os.path.join('database', db)
-    left_table_path = os.path.join(db_path, tbl1)
-    right_table_path = os.path.join(db_path, tbl2)
+    import physical
     left_column, right_column = column.split(',')
 
-    left_chunks = get_chunk_files(left_table_path)
-    right_chunks = get_chunk_files(right_table_path)
-
-    if not (left_chunks and right_chunks):
+    # either table may be a CSV chunk table or a JSON table of the same database
+    left = physical.table_source(db, tbl1)
+    right = physical.table_source(db, tbl2)
+    if not (left and right):
         click.echo("One or both tables do not have chunk files.")
         return
 
-    # Assuming each table has an equal number of chunks,
-    # or logic needs to be adjusted for unequal chunk counts
-    for left_chunk, right_chunk in zip(left_chunks, right_chunks):
-        left_chunk_path = os.path.join(left_table_path, left_chunk)
-        right_chunk_path = os.path.join(right_table_path, right_chunk)
-
-        joined_data = process_chunk_pair(
-            left_chunk_path, right_chunk_path, left_column, right_column)
-        for row in joined_data:
-            click.echo(row)
+    # a CSV cell is always a string, so across formats "2019" has to meet 2019 by value
+    typed = type(left) is not type(right)
+    joined_rows = physical.HashJoin(
+        physical.Scan(left), physical.Scan(right),
+        lambda row: physical.join_key(row, [left_column], typed),
+        lambda row: physical.join_key(row, [right_column], typed),
+        build='right' if right.size() <= left.size() else 'left').records()
+    count = writers.write_records(joined_rows, output_format, output)
+    if output:
+        click.echo(f"Wrote {count} rows to {output}.")
 
 
 # =======================================================
@@ -624,16 +849,25 @@ def join_tb(db, tbl1, tbl2, column):
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
 @click.option("--where", default='', help="Conditions for filtering", required=False)
-@click.option("--groupby", default='', help="Column to group by", required=False)
-@click.option("--agg", default='', help="Aggregation for group by", required=False)
+@click.option("--groupby", default='', help="Column(s) to group by, comma-separated", required=False)
+@click.option("--agg", default='', help="Aggregation for group by, or a list like 'count(*), avg(Electric Range)'", required=False)
 @click.option("--having", default='', help="where for group by", required=False)
 @click.option("--order_col", default='', help="Column to order by", required=False)
 @click.option("--ascending", default='T', help="ascending (T/F)", required=False)
 @click.option("--project_col", default='', help="Columns to project", required=False)
-def query(db, table, where, groupby, agg, having, order_col, ascending, project_col):
+@click.option("--explain", is_flag=True, help="Print the stage plan without running the query")
+@click.option("--analyze", is_flag=True, help="Run the query and report rows, bytes, chunks, time and peak memory per stage")
+@click.option("--profile", default='', help="Write a cProfile dump of the query to this file", required=False)
+@click.option("--batch", is_flag=True, help="Run the filter and group stages column-wise with NumPy")
+def query(db, table, where, groupby, agg, having, order_col, ascending, project_col, explain, analyze, profile, batch):
     '''
     e.g. python3 main.py query --db=ev --table=ev_data --where='{"Make": {"operator": "eq", "value": "TESLA"}}' --groupby='Model' --agg=count --order_col='Base MSRP' --ascending=T --project_col='2020 Census Tract'
+    --groupby='Make,Model Year' --agg='count(*), max(Base MSRP)' groups on both columns, with a column per
+    aggregate (count(*), max(Base MSRP)) that --having can filter on;
+    add --explain to print the plan, --analyze for per-stage statistics, --profile=query.prof for a cProfile dump,
+    --batch for the vectorized filter and group stages
     '''
+    import profiler
 
     db_path = os.path.join('database', db)
     if not os.path.exists(db_path):
@@ -646,44 +880,128 @@ def query(db, table, where, groupby, agg, having, order_col, ascending, project_
         sys.exit(1)
 
     try:
-        conditions_dict = json.loads(where)
+        conditions_dict = json.loads(where) if where else {}
     except json.JSONDecodeError:
         click.echo("Invalid JSON string.")
         sys.exit(1)
 
+    if explain:
+        click.echo(profiler.format_plan(table, query_plan(
+            table_path_csv, where, groupby, agg, having, order_col, ascending, project_col, batch)))
+        return
+
+    stages = profiler.start_analyze(analyze)
+    with profiler.cprofile(profile):
+        run_query(db_path, table, table_path_csv, conditions_dict, groupby,
+                  agg, having, order_col, ascending, project_col, stages, batch)
+
+    if analyze:
+        click.echo(profiler.format_stages(stages))
+    if profile:
+        click.echo(f"cProfile dump written to {profile}")
+
+
+def query_plan(table_path_csv, where, groupby, agg, having, order_col, ascending, project_col, batch=False):
+    mode = " (batch)" if batch else ""
+    steps = [f"Scan {table_path_csv}"]
     if where:
+        steps.append(f"Filter{mode} {where}")
+    if groupby and agg:
+        steps.append(f"Group by{mode} {groupby} agg={agg}")
+        if having:
+            steps.append(f"Having {having}")
+    if order_col:
+        steps.append(f"Sort {order_col} ascending={ascending}")
+    if project_col:
+        steps.append(f"Project {project_col}")
+    return steps
+
+
+def run_query(db_path, table, table_path_csv, conditions_dict, groupby, agg, having, order_col, ascending, project_col, stages=None, batch=False):
+    import aggregates
+    import physical
+    import profiler
+    rows = None
+    if batch:
+        import batch as batch_mode
+
+    if conditions_dict:
 
         output_path = os.path.join(
             db_path, table + "_filter_temp" + ".csv")
 
-        with open(table_path_csv, 'r', newline='') as csvfile, \
-                open(output_path, 'w', newline='') if output_path else sys.stdout as output:
-
-            reader = csv.DictReader(csvfile)
-            writer = csv.DictWriter(
-                output, fieldnames=reader.fieldnames, extrasaction='ignore')
-            if output_path:
+        with profiler.stage(stages, "filter") as stats, \
+                open(table_path_csv, 'r', newline='') as csvfile, \
+                open(output_path, 'w', newline='') as output:
+            profiler.scan_file(stats, table_path_csv)
+
+            if batch:
+                writer = csv.writer(output)
+                for fieldnames, batch_rows, arrays in batch_mode.iter_batches(
+                        table_path_csv, list(conditions_dict), keep_rows=True):
+                    if not stats["rows_in"]:
+                        writer.writerow(fieldnames)
+                    stats["rows_in"] += len(batch_rows)
+                    mask = batch_mode.where_mask(arrays, conditions_dict, len(batch_rows))
+                    writer.writerows(itertools.compress(batch_rows, mask))
+                    stats["rows_out"] += int(mask.sum())
+            else:
+                reader = csv.DictReader(csvfile)
+                writer = csv.DictWriter(
+                    output, fieldnames=reader.fieldnames, extrasaction='ignore')
                 writer.writeheader()
 
-            for row in reader:
-                if all(evaluate_condition(row[key], cond)
-                       for key, cond in conditions_dict.items() if key in row):
+                for row in physical.Filter(physical.Scan(count_rows(reader, stats)),
+                                           row_predicate(conditions_dict)).records():
                     writer.writerow(row)
+                    stats["rows_out"] += 1
+            rows = stats["rows_out"]
         table_path_csv = output_path
     if groupby and agg:
-        results = perform_groupby(table_path_csv, groupby, agg, None)
-
-        fieldnames = ['Group'] + \
-            list(set(k for v in results.values() for k in v.keys()))
-
-        output_path = os.path.join(db_path, table + "_groupby_temp.csv")
-        with open(output_path, 'w', newline='') as output:
-            writer = csv.DictWriter(output, fieldnames=fieldnames)
-            writer.writeheader()
+        with profiler.stage(stages, "group", rows_in=rows or 0) as stats:
+            profiler.scan_file(stats, table_path_csv)
+            output_path = os.path.join(db_path, table + "_groupby_temp.csv")
+            columns = [name.strip() for name in groupby.split(',') if name.strip()]
+            try:
+                specs = group_specs(agg)
+            except ValueError as e:
+                click.echo(str(e))
+                sys.exit(1)
+            if specs is not None or len(columns) > 1:
+                # every aggregate of every group in one pass, a column per group column and per aggregate
+                specs = specs or aggregates.parse_specs(agg)
+                try:
+                    groups = group_rows([table_path_csv], columns, specs, batch,
+                                        stats if rows is None else None)
+                    with open(output_path, 'w', newline='') as output:
+                        writer = csv.DictWriter(output, fieldnames=columns + [label for label, _, _ in specs])
+                        writer.writeheader()
+                        for record in group_records(groups, columns):
+                            writer.writerow(record)
+                            stats["rows_out"] += 1
+                except ValueError as e:
+                    click.echo(str(e))
+                    sys.exit(1)
+                rows = stats["rows_out"]
+            else:
+                if batch:
+                    results = batch_mode.groupby_columns(
+                        table_path_csv, groupby, agg, stats if rows is None else None)
+                else:
+                    results = perform_groupby(
+                        table_path_csv, groupby, agg, None, stats if rows is None else None)
+
+                fieldnames = ['Group'] + \
+                    list(set(k for v in results.values() for k in v.keys()))
+
+                with open(output_path, 'w', newline='') as output:
+                    writer = csv.DictWriter(output, fieldnames=fieldnames)
+                    writer.writeheader()
 
-            for key, value in results.items():
-                row = {'Group': key, **value}
-                writer.writerow(row)
+                    for key, value in results.items():
+                        row = {'Group': key, **value}
+                        writer.writerow(row)
+                rows = stats["rows_out"] = len(results)
         table_path_csv = output_path
 
         if having:
@@ -691,26 +1009,35 @@ def query(db, table, where, groupby, agg, having, order_col, ascending, project_
 
             output_path = os.path.join(
                 db_path, table + "_having_temp" + ".csv")
-            with open(table_path_csv, 'r', newline='') as csvfile, \
-                    open(output_path, 'w', newline='') if output_path else sys.stdout as output:
+            with profiler.stage(stages, "having", rows_in=rows) as stats, \
+                    open(table_path_csv, 'r', newline='') as csvfile, \
+                    open(output_path, 'w', newline='') as output:
+                profiler.scan_file(stats, table_path_csv)
 
                 reader = csv.DictReader(csvfile)
                 writer = csv.DictWriter(
                     output, fieldnames=reader.fieldnames, extrasaction='ignore')
-                if output_path:
-                    writer.writeheader()
+                writer.writeheader()
 
                 for row in reader:
                     condition_met = all(evaluate_condition(
                         row[key], value) for key, value in conditions_dict.items())
                     if condition_met:
                         writer.writerow(row)
+                        stats["rows_out"] += 1
+                rows = stats["rows_out"]
             table_path_csv = output_path
     if order_col:
         if ascending:
-            external_sort(table_path_csv, order_col,
-                          ASCEDNING_OPTION[ascending])
-            table_path_csv = output_path
+            with profiler.stage(stages, "sort", rows_in=rows or 0) as stats:
+                profiler.scan_file(stats, table_path_csv)
+                try:
+                    external_sort(table_path_csv, ordering.parse_order(order_col, descending=not ASCEDNING_OPTION[ascending]),
+                                  stats=stats if rows is None else None)
+                except ValueError as e:
+                    click.echo(str(e))
+                    sys.exit(1)
+                rows = stats["rows_out"] = stats["rows_in"]
 
     if project_col:
         selected_columns = [col.strip()
@@ -718,8 +1045,10 @@ def query(db, table, where, groupby, agg, having, order_col, ascending, project_
 
         output_path = os.path.join(
             db_path, table + "_project_temp" + ".csv")
-        with open(table_path_csv, 'r', newline='') as csvfile, \
-                open(output_path, 'w', newline='') if output_path else sys.stdout as output:
+        with profiler.stage(stages, "project", rows_in=rows or 0) as stats, \
+                open(table_path_csv, 'r', newline='') as csvfile, \
+                open(output_path, 'w', newline='') as output:
+            profiler.scan_file(stats, table_path_csv)
 
             reader = csv.DictReader(csvfile)
             writer = csv.DictWriter(
@@ -727,8 +1056,11 @@ def query(db, table, where, groupby, agg, having, order_col, ascending, project_
 
             if not selected_columns or all(col in reader.fieldnames for col in selected_columns):
                 writer.writeheader()
-                for row in reader:
+                for row in physical.Project(physical.Scan(reader), selected_columns or reader.fieldnames).records():
                     writer.writerow(row)
+                    stats["rows_out"] += 1
+                if rows is None:
+                    stats["rows_in"] = stats["rows_out"]
             else:
                 click.echo(
                     "One or more selected columns do not exist in the table.")
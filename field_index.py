@@ -0,0 +1,376 @@
+'''
+secondary indexes for JSON tables on a field or a dotted path into nested documents (address.city).
+table/.field_index/<field>.hash maps every value to the locations of its records, <field>.sorted
+keeps (typed value, location) pairs in value order for range predicates and <field>.text is an
+inverted word / trigram index for contains and match (see text_index). A location is
+(file number, offset) with offsets as in id_index. Each index records the (size, mtime_ns) stamps
+of the table files it covers; ins-jval and update-jval patch the indexes, anything else that changes
+the files (deletes, splits, hand edits) makes them stale and they are rebuilt on next use.
+'''
+import os
+import bisect
+import json
+import pickle
+from collections import OrderedDict
+from urllib.parse import quote, unquote
+
+import compact
+import id_index
+import ordering
+import table_cache
+import text_index
+
+INDEX_DIR = '.field_index'
+KINDS = ("hash", "sorted", "text")
+MAX_PLANS = 64
+
+# (table, index directory stamp, criteria, operations) -> plan, least recently used first
+_plans = OrderedDict()
+
+
+def get_path(record, path, default=None):
+    ''' record[path], or the value at a dotted path into nested objects; default when missing '''
+    if path in record:
+        return record[path]
+    value = record
+    for name in path.split('.'):
+        if not isinstance(value, dict) or name not in value:
+            return default
+        value = value[name]
+    return value
+
+
+def hash_key(value):
+    ''' dict key for a value, equal for values that compare equal '''
+    if isinstance(value, (list, dict)):
+        return ('json', json.dumps(value, sort_keys=True))
+    return value
+
+
+def index_dir(table_dir):
+    return os.path.join(table_dir, INDEX_DIR)
+
+
+def index_path(table_dir, field, kind):
+    return os.path.join(index_dir(table_dir), f"{quote(field, safe='')}.{kind}")
+
+
+def declared(table_dir):
+    ''' (field, kind) of every index of the table '''
+    directory = index_dir(table_dir)
+    if not os.path.isdir(directory):
+        return []
+    indexes = []
+    for name in sorted(os.listdir(directory)):
+        field, _, kind = name.rpartition('.')
+        if kind in KINDS:
+            indexes.append((unquote(field), kind))
+    return indexes
+
+
+class FieldIndex:
+    def __init__(self, table_dir, paths, field, kind):
+        self.path = index_path(table_dir, field, kind)
+        self.field = field
+        self.kind = kind
+        self.paths = list(paths)
+        self.names = [os.path.relpath(path, table_dir) for path in self.paths]
+        self.dirty = False
+        self.data = None
+        if os.path.exists(self.path):
+            self.data = table_cache.get(self.path, _load)
+        self.shared = self.data is not None and table_cache.enabled()
+        if not self.fresh():
+            self.rebuild()
+
+    def fresh(self):
+        return self.data is not None and self.data["files"] == self.names and all(
+            self.data["stamps"].get(name) == _stamp(path) for name, path in zip(self.names, self.paths))
+
+    def rebuild(self):
+        self.shared = False
+        self.data = {"field": self.field, "kind": self.kind, "files": self.names,
+                     "stamps": {name: _stamp(path) for name, path in zip(self.names, self.paths)},
+                     "entries": {}, "keys": [], "locations": [], "nulls": []}
+        if self.kind == "sorted":
+            pairs = []
+            for path in self.paths:
+                for offset, record in id_index.iter_offsets(path):
+                    value = get_path(record, self.field)
+                    location = (self.paths.index(path), offset)
+                    if value is None:
+                        self.data["nulls"].append(location)
+                    else:
+                        pairs.append((ordering.value_key(value), location))
+            pairs.sort()
+            self.data["keys"] = [key for key, _ in pairs]
+            self.data["locations"] = [location for _, location in pairs]
+        else:
+            for path in self.paths:
+                for offset, record in id_index.iter_offsets(path):
+                    self.add(record, path, offset)
+        self.dirty = True
+
+    def _own(self):
+        ''' copy data the table cache holds before changing it, so a change that fails never reaches the cache '''
+        if self.shared:
+            self.data = pickle.loads(pickle.dumps(self.data, pickle.HIGHEST_PROTOCOL))
+            self.shared = False
+
+    def add(self, record, path, offset):
+        self._own()
+        location = (self.paths.index(path), offset)
+        value = get_path(record, self.field)
+        if self.kind == "hash":
+            self.data["entries"].setdefault(hash_key(value), []).append(location)
+        elif value is None:
+            self.data["nulls"].append(location)
+        else:
+            key = ordering.value_key(value)
+            position = bisect.bisect_right(self.data["keys"], key)
+            self.data["keys"].insert(position, key)
+            self.data["locations"].insert(position, location)
+        self.dirty = True
+
+    def remove(self, record, path, offset):
+        self._own()
+        location = (self.paths.index(path), offset)
+        value = get_path(record, self.field)
+        if self.kind == "hash":
+            locations = self.data["entries"].get(hash_key(value), [])
+            if location in locations:
+                locations.remove(location)
+                if not locations:
+                    del self.data["entries"][hash_key(value)]
+        elif value is None:
+            if location in self.data["nulls"]:
+                self.data["nulls"].remove(location)
+        else:
+            key = ordering.value_key(value)
+            start = bisect.bisect_left(self.data["keys"], key)
+            end = bisect.bisect_right(self.data["keys"], key)
+            for position in range(start, end):
+                if self.data["locations"][position] == location:
+                    del self.data["keys"][position]
+                    del self.data["locations"][position]
+                    break
+        self.dirty = True
+
+    def stamp(self, path):
+        self._own()
+        self.data["stamps"][self.names[self.paths.index(path)]] = _stamp(path)
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self.data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.path)
+        self.dirty = False
+
+    def equal(self, value):
+        ''' locations of the records whose field may equal value '''
+        if value is None:
+            return list(self.data["entries"].get(None, [])) if self.kind == "hash" else list(self.data["nulls"])
+        if self.kind == "hash":
+            return list(self.data["entries"].get(hash_key(value), []))
+        key = ordering.value_key(value)
+        keys = self.data["keys"]
+        return self.data["locations"][bisect.bisect_left(keys, key):bisect.bisect_right(keys, key)]
+
+    def between(self, low, high):
+        ''' locations of the records with a numeric value in low..high (None = unbounded); sorted indexes only '''
+        keys = self.data["keys"]
+        start = bisect.bisect_left(keys, (0, low)) if low is not None else bisect.bisect_left(keys, (0,))
+        end = bisect.bisect_right(keys, (0, high)) if high is not None else bisect.bisect_left(keys, (1,))
+        return self.data["locations"][start:end]
+
+    def missing(self):
+        ''' locations of records without a value for the field '''
+        if self.kind == "hash":
+            return list(self.data["entries"].get(None, []))
+        return list(self.data["nulls"])
+
+
+def open_index(table_dir, paths, field, kind):
+    ''' the index of a table on field, rebuilt when stale '''
+    if kind == "text":
+        return text_index.TextIndex(table_dir, paths, field, id_index.iter_offsets,
+                                    lambda record: get_path(record, field))
+    return FieldIndex(table_dir, paths, field, kind)
+
+
+class Indexes:
+    '''
+    every index of a table, opened (and rebuilt when stale) before the table files are changed
+    so the change can be applied to them; saved on exit
+    '''
+
+    def __init__(self, table_dir, paths):
+        self.indexes = [open_index(table_dir, paths, field, kind) for field, kind in declared(table_dir)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # a change that failed part way is not saved: its files keep their stamps, so the
+        # half-patched index would pass as fresh
+        if exc_type is None:
+            for index in self.indexes:
+                index.save()
+
+    def add(self, record, path, offset):
+        for index in self.indexes:
+            index.add(record, path, offset)
+
+    def remove(self, record, path, offset):
+        for index in self.indexes:
+            index.remove(record, path, offset)
+
+    def stamp(self, path):
+        for index in self.indexes:
+            index.stamp(path)
+
+
+def create(table_dir, paths, field, kind):
+    ''' build (or rebuild) an index; returns the number of indexed records '''
+    if os.path.exists(index_path(table_dir, field, kind)):
+        os.remove(index_path(table_dir, field, kind))
+    index = open_index(table_dir, paths, field, kind)
+    index.save()
+    if kind == "text":
+        return sum(len(locations) for locations in index.data["locations"])
+    if kind == "hash":
+        return sum(len(locations) for locations in index.data["entries"].values())
+    return len(index.data["keys"]) + len(index.data["nulls"])
+
+
+def drop(table_dir, field, kind):
+    path = index_path(table_dir, field, kind)
+    if not os.path.exists(path):
+        return False
+    os.remove(path)
+    return True
+
+
+def predicate(condition, operations):
+    '''
+    what an index can look up for one criteria entry: ("eq", value, missing too),
+    ("range", low, high, missing too) or ("text", operator, text, False), None when it cannot
+    narrow the scan. with operations, {"operation": "=" | ">" | "<", "value": v} is read like
+    filter_data does: digit strings and numbers compare numerically and a missing field compares
+    as 0; {"operation": "contains" | "match", "value": text} searches the text of the field
+    '''
+    if operations and isinstance(condition, dict) and 'operation' in condition and 'value' in condition:
+        operation, value = condition['operation'], condition['value']
+        if operation in text_index.OPERATORS:
+            return ("text", operation, value, False) if isinstance(value, str) else None
+        if operation not in ('=', '>', '<'):
+            return None
+        numeric = (isinstance(value, (int, float)) and not isinstance(value, bool)) or (
+            isinstance(value, str) and value.isdigit())
+        if numeric:
+            number = float(value)
+            missing = {'=': 0 == number, '>': 0 > number, '<': 0 < number}[operation]
+            low, high = {'=': (number, number), '>': (number, None), '<': (None, number)}[operation]
+            return ("range", low, high, missing)
+        if operation == '=':
+            return ("eq", value, value == 0)
+        return None
+    return ("eq", condition, condition is None)
+
+
+def plan(table_dir, criteria, operations=False):
+    '''
+    [(field, kind, predicate)] of the criteria entries an index of the table can answer; kept per
+    criteria until an index of the table is created or dropped (the index directory changes)
+    '''
+    try:
+        indexes_stamp = os.stat(index_dir(table_dir)).st_mtime_ns
+    except OSError:
+        indexes_stamp = None
+    key = (os.path.abspath(table_dir), indexes_stamp, json.dumps(criteria, sort_keys=True), operations)
+    steps = _plans.get(key)
+    if steps is None:
+        steps = _plan(table_dir, criteria, operations)
+        _plans[key] = steps
+        if len(_plans) > MAX_PLANS:
+            _plans.popitem(last=False)
+    else:
+        _plans.move_to_end(key)
+    return steps
+
+
+def _plan(table_dir, criteria, operations):
+    available = declared(table_dir)
+    steps = []
+    for field, condition in criteria.items():
+        lookup = predicate(condition, operations)
+        if lookup is None:
+            continue
+        kinds = [kind for indexed, kind in available if indexed == field]
+        # a range needs the sorted index, equality prefers the hash index
+        if lookup[0] == "text":
+            if "text" in kinds:
+                steps.append((field, "text", lookup))
+        elif lookup[0] == "range" and "sorted" in kinds:
+            steps.append((field, "sorted", lookup))
+        elif lookup[0] == "eq" and ("hash" in kinds or "sorted" in kinds):
+            steps.append((field, "hash" if "hash" in kinds else "sorted", lookup))
+    return steps
+
+
+def candidates(table_dir, paths, criteria, operations=False):
+    '''
+    {path: sorted offsets} of the records that can match criteria according to the indexes of the
+    table (every indexed entry narrows the set), or None when no index applies and the table has to
+    be scanned. the caller still applies the criteria to the records read from these offsets
+    '''
+    steps = plan(table_dir, criteria, operations)
+    if not steps:
+        return None
+    found = None
+    for field, kind, lookup in steps:
+        index = open_index(table_dir, paths, field, kind)
+        if lookup[0] == "text":
+            locations = index.search(lookup[1], lookup[2])
+        elif lookup[0] == "eq":
+            locations = set(index.equal(lookup[1]))
+        else:
+            locations = set(index.between(lookup[1], lookup[2]))
+        if lookup[-1]:
+            locations.update(index.missing())
+        index.save()
+        found = locations if found is None else found & locations
+    by_path = {path: [] for path in paths}
+    for file_number, offset in sorted(found):
+        by_path[paths[file_number]].append(offset)
+    return by_path
+
+
+def read_records(path, offsets):
+    ''' the records at offsets (as given by candidates) of one table file, in file order '''
+    if not offsets:
+        return []
+    if path.endswith('.jsonl'):
+        records = []
+        with open(path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                records.append(json.loads(f.readline()))
+        return records
+    data = compact.cached(path)
+    return [data[offset] for offset in offsets]
+
+
+def _load(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
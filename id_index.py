@@ -0,0 +1,223 @@
+'''
+primary-key index for JSON tables: id -> (table file, offset) plus the id sequence.
+table/.id_index/slots is a hash table of fixed-size slots (open addressing, linear probing) that
+doubles once it is half full, so a lookup or an insert is a seek or two whatever the ids look like;
+table/.id_index/meta.json holds the indexed files, their (size, mtime_ns) stamps, the slot count
+and the last id handed out. When a file changed without going through the index it is rebuilt.
+records whose id is not an integer have no slot, locate() finds them by a scan.
+offset is the byte offset of the line for JSON Lines files and the list position for JSON arrays.
+'''
+import os
+import json
+import struct
+
+import compact
+
+INDEX_DIR = '.id_index'
+# id, file number + 1 (0 = empty slot), offset
+SLOT = struct.Struct('<qIQ')
+MIN_SLOTS = 1024
+# bumped when the slot layout changes, older indexes are rebuilt
+FORMAT = 2
+
+
+class IdIndex:
+    def __init__(self, table_dir, paths):
+        self.table_dir = table_dir
+        self.paths = list(paths)
+        self.names = [os.path.relpath(path, table_dir) for path in self.paths]
+        index_dir = os.path.join(table_dir, INDEX_DIR)
+        os.makedirs(index_dir, exist_ok=True)
+        self.meta_path = os.path.join(index_dir, 'meta.json')
+        self.slots_path = os.path.join(index_dir, 'slots')
+
+        self.meta = {"files": [], "stamps": {}, "seq": 0, "slots": 0, "count": 0}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.meta = json.load(f)
+        if not os.path.exists(self.slots_path):
+            open(self.slots_path, 'wb').close()
+        self.slots = open(self.slots_path, 'r+b')
+        if not self.fresh():
+            self.rebuild()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.slots.close()
+        temp_path = self.meta_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(temp_path, self.meta_path)
+
+    def fresh(self):
+        return self.meta.get("format") == FORMAT and self.meta["files"] == self.names and all(
+            self.meta["stamps"].get(name) == _stamp(path) for name, path in zip(self.names, self.paths))
+
+    def next_id(self):
+        self.meta["seq"] += 1
+        return self.meta["seq"]
+
+    def lookup(self, record_id):
+        ''' (path, offset) of the record from its slot, or None '''
+        if not _indexable(record_id) or not self.meta["slots"]:
+            return None
+        slot, file_number, offset = self._probe(record_id)
+        if file_number == 0:
+            return None
+        return self.paths[file_number - 1], offset
+
+    def locate(self, record_id):
+        ''' (path, offset) of the record, scanning the files when it has no slot; None when there is none '''
+        location = self.lookup(record_id)
+        if location is not None:
+            return location
+        for path in self.paths:
+            for offset, record in iter_offsets(path):
+                if isinstance(record, dict) and record.get('id') == record_id:
+                    return path, offset
+        return None
+
+    def put(self, record_id, path, offset):
+        if not _indexable(record_id):
+            return
+        if (self.meta["count"] + 1) * 2 > self.meta["slots"]:
+            self._grow()
+        slot, file_number, _ = self._probe(record_id)
+        if file_number == 0:
+            self.meta["count"] += 1
+        self._write(slot, record_id, self.paths.index(path) + 1, offset)
+        self.meta["seq"] = max(self.meta["seq"], record_id)
+
+    def stamp(self, path):
+        ''' record that path was changed through the index '''
+        self.slots.flush()
+        self.meta["stamps"][self.names[self.paths.index(path)]] = _stamp(path)
+
+    def rebuild(self):
+        seq = self.meta.get("seq", 0)
+        self.meta = {"format": FORMAT, "files": self.names, "stamps": {}, "seq": seq, "slots": 0, "count": 0}
+        entries = []
+        for file_number, path in enumerate(self.paths, 1):
+            for offset, record in iter_offsets(path):
+                record_id = record.get('id') if isinstance(record, dict) else None
+                if _indexable(record_id):
+                    entries.append((record_id, file_number, offset))
+                    self.meta["seq"] = max(self.meta["seq"], record_id)
+        self._fill(entries)
+        self.meta["stamps"] = {name: _stamp(path) for name, path in zip(self.names, self.paths)}
+
+    def _probe(self, record_id):
+        ''' (slot, file number, offset) of the slot holding record_id, or of the empty slot where it would go '''
+        mask = self.meta["slots"] - 1
+        slot = _hash(record_id, self.meta["slots"])
+        while True:
+            self.slots.seek(slot * SLOT.size)
+            stored_id, file_number, offset = SLOT.unpack(self.slots.read(SLOT.size))
+            if file_number == 0 or stored_id == record_id:
+                return slot, file_number, offset
+            slot = (slot + 1) & mask
+
+    def _write(self, slot, record_id, file_number, offset):
+        self.slots.seek(slot * SLOT.size)
+        self.slots.write(SLOT.pack(record_id, file_number, offset))
+
+    def _grow(self):
+        self.slots.seek(0)
+        self._fill([entry for entry in SLOT.iter_unpack(self.slots.read()) if entry[1]])
+
+    def _fill(self, entries):
+        ''' rewrite the slot file holding entries, with at least twice as many slots '''
+        slots = MIN_SLOTS
+        while slots < 2 * (len(entries) + 1) or slots <= self.meta["slots"]:
+            slots *= 2
+        table = bytearray(slots * SLOT.size)
+        positions = {}
+        for record_id, file_number, offset in entries:
+            slot = _hash(record_id, slots)
+            while positions.get(slot, record_id) != record_id:
+                slot = (slot + 1) & (slots - 1)
+            positions[slot] = record_id
+            SLOT.pack_into(table, slot * SLOT.size, record_id, file_number, offset)
+        self.slots.seek(0)
+        self.slots.truncate()
+        self.slots.write(table)
+        self.slots.flush()
+        self.meta["slots"] = slots
+        self.meta["count"] = len(positions)
+
+
+def iter_offsets(path):
+    ''' (offset, record) for every record of a JSON Lines or JSON array file '''
+    if path.endswith('.jsonl'):
+        with open(path, 'rb') as f:
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if line.strip():
+                    yield offset, json.loads(line)
+        return
+
+    try:
+        data = compact.cached(path)
+    except json.JSONDecodeError:
+        return  # an empty table created by cre-tb
+    if compact.is_table(data):
+        yield from enumerate(data)
+
+
+def read_at(path, offset):
+    ''' the record stored at offset of path '''
+    if path.endswith('.jsonl'):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+    return compact.cached(path)[offset]
+
+
+def rewrite_line(path, offset, record, append_path):
+    '''
+    replace the JSON Lines record at offset: in place (padded with spaces) when the new line fits,
+    otherwise the old line is blanked and the record appended to append_path.
+    returns (path, offset) of the record afterwards
+    '''
+    line = json.dumps(record).encode('utf-8')
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        old = f.readline().rstrip(b'\n')
+        f.seek(offset)
+        if len(line) <= len(old):
+            f.write(line + b' ' * (len(old) - len(line)))
+            return path, offset
+        # blank lines are skipped by every scan
+        f.write(b' ' * len(old))
+
+    with open(append_path, 'a+b') as f:
+        new_offset = f.tell()
+        if new_offset:
+            f.seek(new_offset - 1)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+                new_offset += 1
+        f.write(line + b'\n')
+    return append_path, new_offset
+
+
+def _indexable(record_id):
+    return isinstance(record_id, int) and not isinstance(record_id, bool) and -2 ** 63 <= record_id < 2 ** 63
+
+
+def _hash(record_id, slots):
+    # Fibonacci hashing: the top bits of id * 2^64/phi spread consecutive ids over the table
+    return ((record_id * 0x9E3779B97F4A7C15) % 2 ** 64) >> (65 - slots.bit_length())
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
@@ -2,10 +2,38 @@ import click
 import os
 import sys
 import json
-from collections import defaultdict
-
-def split_json_file(db, table, max_size_mb=3):
-    """Split a JSON file into multiple smaller files if it exceeds a specified size."""
+import copy
+import itertools
+import functools
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict, OrderedDict
+import profiler
+import table_cache
+import compact
+import spill
+import aggregates
+import ordering
+import id_index
+import field_index
+import json_split
+import writers
+import text_index
+import physical
+
+# criteria key -> compiled test (see compile_criteria), least recently used first
+_predicates = OrderedDict()
+MAX_PREDICATES = 64
+
+
+def split_json_file(db, table, max_size_mb=3, to_jsonl=False, resplit=False):
+    """
+    Split a JSON file into multiple smaller files if it exceeds a specified size.
+    The table is streamed into size-balanced part_N.json (or part_N.jsonl) files and recorded in a
+    manifest (see json_split); later calls re-split only the parts that grew.
+    to_jsonl converts a JSON array table (and its parts) to JSON Lines first,
+    resplit discards the parts and splits the source file again.
+    """
     
     db_path = os.path.join('database', db)
     if not os.path.exists(db_path):
@@ -18,42 +46,232 @@ def split_json_file(db, table, max_size_mb=3):
         os.makedirs(table_path_json)
     
     path_json = os.path.join(table_path_json, f"{table}.json")
+    path_jsonl = os.path.join(table_path_json, f"{table}.jsonl")
+    output_dir = os.path.join(table_path_json, 'split_json')
+
+    if to_jsonl and os.path.exists(path_json):
+        convert_to_jsonl(path_json, path_jsonl, output_dir)
+    source = path_jsonl if os.path.exists(path_jsonl) else path_json
+    max_bytes = max_size_mb * 1024 * 1024
 
-    file_size_mb = os.path.getsize(path_json) / (1024 * 1024)
+    file_size_mb = os.path.getsize(source) / (1024 * 1024)
     if file_size_mb <= max_size_mb:
         print("File size is within the limit. No need to split.")
-        return path_json
-    
-    output_dir = os.path.join(table_path_json, 'split_json')
+        return source
+
     if os.path.exists(output_dir):
+        if resplit:
+            parts = json_split.resplit_table(source, table_path_json, output_dir, max_bytes)
+            print(f"JSON file split into {len(parts)} parts.")
+            return output_dir
+        if json_split.source_replaced(source, table_path_json):
+            # the parts hold every change since the split, they are only dropped on request
+            click.echo(f"{source} was replaced since the table was split; the parts are still used, "
+                       f"run split-jval --resplit to split it again.", err=True)
+        # re-split the parts that grew
+        json_split.maintain(source, table_path_json, output_dir, max_bytes)
         return output_dir
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    with open(path_json, 'r') as file:
-        data = json.load(file)
-
-    part = 0
-    current_size = 0
-    current_data = []
-    for item in data:
-        current_data.append(item)
-        current_size += len(json.dumps(item))
-        if current_size >= max_size_mb * 1024 * 1024:
-            with open(os.path.join(output_dir, f'part_{part}.json'), 'w') as f:
-                json.dump(current_data, f)
-            part += 1
-            current_data = []
-            current_size = 0
-
-    if current_data:
-        with open(os.path.join(output_dir, f'part_{part}.json'), 'w') as f:
-            json.dump(current_data, f)
-
-    print(f"JSON file split into {part + 1} parts.")
+    # streamed record by record, the table is never loaded whole
+    parts = json_split.split_table(source, table_path_json, output_dir, max_bytes)
+    print(f"JSON file split into {len(parts)} parts.")
     return output_dir
 
+
+def convert_to_jsonl(path_json, path_jsonl, output_dir):
+    """ Rewrite a JSON array table, and the parts it was split into, as JSON Lines. """
+    write_records(path_jsonl, json_split.iter_array(path_json))
+    os.remove(path_json)
+
+    if os.path.isdir(output_dir):
+        for file_name in os.listdir(output_dir):
+            if file_name.endswith('.json'):
+                part_path = os.path.join(output_dir, file_name)
+                write_records(part_path + 'l', json_split.iter_array(part_path))
+                os.remove(part_path)
+    # rebuilt from the converted parts on next use
+    json_split.remove_manifest(os.path.dirname(path_json))
+
+@click.command()
+@click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
+@click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
+def convert_jval(db, table):
+    """
+    Convert a JSON array table (and its parts) to JSON Lines.
+    e.g. python main.py convert-jval --db=test-db --table=t
+    """
+    table_dir = os.path.join('database', db, table)
+    if not os.path.exists(os.path.join(table_dir, f"{table}.json")):
+        click.echo("Table does not exist or is already JSON Lines.")
+        sys.exit(1)
+
+    split_json_file(db, table, to_jsonl=True)
+    click.echo(f"Table {table} converted to JSON Lines.")
+
+
+@click.command()
+@click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
+@click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
+@click.option("--resplit", is_flag=True, help="Discard the parts, and every change made to them, and split the source file again")
+def split_jval(db, table, resplit):
+    """
+    Split a table over 3 MB into parts, or bring its split up to date.
+    e.g. python main.py split-jval --db=test-db --table=salaries --resplit
+    --resplit is needed after the table file was replaced, other commands keep using the parts
+    """
+    table_dir = os.path.join('database', db, table)
+    if not any(os.path.exists(os.path.join(table_dir, f"{table}.{extension}")) for extension in ('json', 'jsonl')):
+        click.echo("Table does not exist.")
+        sys.exit(1)
+
+    split_json_file(db, table, resplit=resplit)
+
+
+def load_table(jsonfile, mutable=False):
+    """
+    json.load a table file, reusing the parsed records while the file is unchanged (see table_cache).
+    A cached table is held as compact.Records; mutable=True returns a list of dicts to change and write back
+    """
+    data = compact.cached(jsonfile.name)
+    if not mutable:
+        return data
+    if isinstance(data, compact.Records):
+        return data.to_list()
+    # a table that is not an array is cached as parsed
+    return copy.deepcopy(data) if table_cache.enabled() else data
+
+
+def list_parts(split_path):
+    """ Sorted part file names of a split table """
+    return table_cache.get(split_path, lambda path: sorted(os.listdir(path)))
+
+
+def part_number(file_name):
+    return int(file_name.split('_')[-1].split('.')[0])
+
+
+def jsonl_parts(split_path):
+    """
+    Paths of a JSON Lines table (its .jsonl file, or its parts in part order),
+    None when the table is stored as JSON arrays.
+    """
+    if split_path.endswith('.jsonl'):
+        return [split_path]
+    if split_path.endswith('.json'):
+        return None
+    names = [f for f in list_parts(split_path) if f.endswith('.jsonl')]
+    if not names:
+        return None
+    return [os.path.join(split_path, f) for f in sorted(names, key=part_number)]
+
+
+def table_files(split_path):
+    """ Paths of the table file, or of all parts of a split table in part order, in either format """
+    if os.path.isfile(split_path):
+        return [split_path]
+    return jsonl_parts(split_path) or [os.path.join(split_path, f) for f in sorted(
+        (f for f in list_parts(split_path) if f.endswith('.json')), key=part_number)]
+
+
+def table_index(db, table, split_path):
+    """ The id index of a table (see id_index), rebuilt first if its files changed behind its back """
+    return id_index.IdIndex(os.path.join('database', db, table), table_files(split_path))
+
+
+def table_field_indexes(db, table, split_path):
+    """ The secondary indexes of a table (see field_index), opened before its files are changed """
+    return field_index.Indexes(os.path.join('database', db, table), table_files(split_path))
+
+
+def reindex_table(db, table, split_path):
+    """ Bring the id index and the secondary indexes up to date after table files were rewritten """
+    with table_index(db, table, split_path), table_field_indexes(db, table, split_path):
+        pass  # opening an index whose files changed rebuilds it
+
+
+def scan_records(path):
+    """
+    Records of one table file or part, one at a time: a JSON Lines file is parsed line by line,
+    a JSON array file is loaded whole (see load_table).
+    """
+    if path.endswith('.jsonl'):
+        with open(path, 'r') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        return
+
+    with open(path, 'r') as file:
+        data = load_table(file)
+    if not compact.is_table(data):
+        click.echo("Invalid table format.")
+        sys.exit(1)
+    yield from data
+
+
+def write_records(path, records):
+    """ Write records to a table file or part in its format, replacing it only once it is complete. """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        if path.endswith('.jsonl'):
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+        else:
+            json.dump(list(records), file, indent=4)
+    os.replace(temp_path, path)
+
+
+def echo_records(records):
+    """
+    Print records as json.dumps(records, indent=4) would, one record at a time.
+    Returns how many were printed.
+    """
+    return writers.write_records(records)
+
+
+def emit_records(records, output_format="json", output=None):
+    """ Stream result records to --output (stdout by default) in --output-format (see writers) """
+    count = writers.write_records(records, output_format, output)
+    if output:
+        click.echo(f"Wrote {count} records to {output}.")
+
+
+def emit_groups(pairs, output_format="json", output=None, rows=lambda key, records: records):
+    """
+    Stream (key, value) groups to --output: one JSON object of the groups for json,
+    otherwise the records rows(key, value) makes of every group
+    """
+    if output_format == "json":
+        count, noun = writers.write_groups(pairs, output), "groups"
+    else:
+        records = itertools.chain.from_iterable(rows(key, value) for key, value in pairs)
+        count, noun = writers.write_records(records, output_format, output), "records"
+    if output:
+        click.echo(f"Wrote {count} {noun} to {output}.")
+
+
+def single_output(output_format, output):
+    """ Whether a command writes one result for the whole table instead of one per part """
+    return output_format != "json" or bool(output)
+
+
+def append_records(path, records):
+    """
+    Append records to a JSON Lines file, O(1) in the size of the file.
+    Returns the byte offset of every appended line.
+    """
+    offsets = []
+    with open(path, 'a+b') as file:
+        size = file.tell()
+        if size:
+            file.seek(size - 1)
+            if file.read(1) != b'\n':
+                file.write(b'\n')
+        for record in records:
+            offsets.append(file.tell())
+            file.write(json.dumps(record).encode('utf-8') + b'\n')
+    return offsets
+
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
@@ -81,62 +299,44 @@ def ins_jval(db, table, values):
             click.echo("Values must be a list for a JSON file.")
             sys.exit(1)
 
-    if split_path.endswith('.json'):
-        with open(split_path, 'r+') as jsonfile:
+    with table_index(db, table, split_path) as index, table_field_indexes(db, table, split_path) as indexes:
+        parts = jsonl_parts(split_path)
+        if parts is not None:
+            # ids come from the index sequence, the table itself is not read
+            for record in values_list:
+                record['id'] = index.next_id()
+            for record, offset in zip(values_list, append_records(parts[-1], values_list)):
+                index.put(record['id'], parts[-1], offset)
+                indexes.add(record, parts[-1], offset)
+            index.stamp(parts[-1])
+            indexes.stamp(parts[-1])
+            click.echo("Values inserted successfully!")
+            return
+
+        # JSON array tables are rewritten, only their last part when split
+        path = table_files(split_path)[-1]
+        if os.path.isdir(split_path):
+            click.echo(f"####{os.path.basename(path)}####")
+        with open(path, 'r+') as jsonfile:
             try:
-                existing_data = json.load(jsonfile)
-                if not isinstance(existing_data, list):
+                existing_data = load_table(jsonfile, mutable=True)
+                if not compact.is_table(existing_data):
                     click.echo("Invalid table format.")
                     sys.exit(1)
-                # Generate new IDs
-                last_id = max((record.get('id', 0)
-                              for record in existing_data), default=0)
-                for record in values_list:
-                    last_id += 1
-                    record['id'] = last_id
-                existing_data.extend(values_list)
-                jsonfile.seek(0)
-                jsonfile.truncate()
-                json.dump(existing_data, jsonfile, indent=4)
             except json.JSONDecodeError:
                 click.echo("Empty JSON file, inserting values...")
-                # Assign IDs for the first set of records
-                for i, record in enumerate(values_list, start=1):
-                    record['id'] = i
-                jsonfile.seek(0)
-                json.dump(values_list, jsonfile, indent=4)
-        click.echo("Values inserted successfully!")
-    else:
-        for file_name in sorted(os.listdir(split_path)):
-            click.echo(f"####{file_name}####")
-            if file_name.endswith('.json'):
-                with open(os.path.join(split_path, file_name), 'r') as jsonfile:
-                    try:
-                        existing_data = json.load(jsonfile)
-                        if not isinstance(existing_data, list):
-                            click.echo("Invalid table format.")
-                            sys.exit(1)
-                        # Generate new IDs
-                        last_id = max((record.get('id', 0)
-                                    for record in existing_data), default=0)
-                        for record in values_list:
-                            last_id += 1
-                            record['id'] = last_id
-                        existing_data.extend(values_list)
-                        jsonfile.seek(0)
-                        jsonfile.truncate()
-                        json.dump(existing_data, jsonfile, indent=4)
-                    except json.JSONDecodeError:
-                        click.echo("Empty JSON file, inserting values...")
-                        # Assign IDs for the first set of records
-                        for i, record in enumerate(values_list, start=1):
-                            record['id'] = i
-                        jsonfile.seek(0)
-                        json.dump(values_list, jsonfile, indent=4)
-                click.echo("Values inserted successfully!")
-            else:
-                click.echo("Table does not exist.")
-                sys.exit(1)
+                existing_data = []
+            for position, record in enumerate(values_list, len(existing_data)):
+                record['id'] = index.next_id()
+                index.put(record['id'], path, position)
+                indexes.add(record, path, position)
+            existing_data.extend(values_list)
+            jsonfile.seek(0)
+            jsonfile.truncate()
+            json.dump(existing_data, jsonfile, indent=4)
+        index.stamp(path)
+        indexes.stamp(path)
+    click.echo("Values inserted successfully!")
 
 
 @click.command()
@@ -161,9 +361,21 @@ def del_rows_jval(db, table, conditions):
     except json.JSONDecodeError:
         click.echo("Invalid JSON string.")
         sys.exit(1)
+
+    parts = jsonl_parts(split_path)
+    if parts is not None:
+        for path in parts:
+            if os.path.isdir(split_path):
+                click.echo(f"####{os.path.basename(path)}####")
+            write_records(path, (row for row in scan_records(path) if not all(
+                row.get(key) == value for key, value in conditions_dict.items())))
+        reindex_table(db, table, split_path)
+        click.echo("Rows deleted successfully.")
+        return
+
     if split_path.endswith('.json'):
         with open(split_path, 'r') as jsonfile:
-            data = json.load(jsonfile)
+            data = load_table(jsonfile)
 
         # Filtering rows that do not meet the conditions
         filtered_data = [row for row in data if not all(
@@ -173,19 +385,20 @@ def del_rows_jval(db, table, conditions):
         with open(split_path, 'w') as jsonfile:
             json.dump(filtered_data, jsonfile, indent=4)
     else:
-         for file_name in sorted(os.listdir(split_path)):
+         for file_name in list_parts(split_path):
             click.echo(f"####{file_name}####")
             if file_name.endswith('.json'):
                 with open(os.path.join(split_path, file_name), 'r') as jsonfile:
-                    data = json.load(jsonfile)
+                    data = load_table(jsonfile)
 
                 # Filtering rows that do not meet the conditions
                 filtered_data = [row for row in data if not all(
                     row.get(key) == value for key, value in conditions_dict.items())]
 
                 # Writing the updated data back to the JSON file
-                with open(split_path, 'w') as jsonfile:
+                with open(os.path.join(split_path, file_name), 'w') as jsonfile:
                     json.dump(filtered_data, jsonfile, indent=4)
+    reindex_table(db, table, split_path)
     click.echo("Rows deleted successfully.")
 
 
@@ -193,68 +406,54 @@ def del_rows_jval(db, table, conditions):
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
 @click.option("--columns", prompt="Enter the columns to select as a comma-separated list (leave empty to select all)", default='', help="The columns to project", required=False)
-def project_col_jval(db, table, columns):
+@click.option("--workers", default=1, type=click.IntRange(min=0), help="Scan the parts of a split table on this many processes (0 = one per core) and merge the results.")
+def project_col_jval(db, table, columns, workers):
     """
     Project specified columns from a JSON table in the specified database.
     e.g. python main.py project-col-jval --db=test-db --table=t --columns=column1
+    add --workers=4 to scan the parts of a split table in parallel
     """
     db_path = os.path.join('database', db)
     if not os.path.exists(db_path):
         click.echo("Database does not exist.")
         sys.exit(1)
     
-    table_path_json = os.path.join(db_path, f"{table}.json")
     split_path = split_json_file(db, table)
-    
-    if split_path.endswith('.json'):
-        with open(split_path, 'r+') as jsonfile:
+    columns = [column.strip() for column in columns.split(',') if column.strip()]
+
+    if workers != 1 and os.path.isdir(split_path):
+        results = map_parts(project_part, table_files(split_path), workers, columns)
+        echo_records(itertools.chain.from_iterable(results))
+        return
+
+    parts = jsonl_parts(split_path)
+    if parts is not None:
+        for path in parts:
+            if os.path.isdir(split_path):
+                click.echo(f"####{os.path.basename(path)}####")
+            echo_records(project_records(scan_records(path), columns))
+        return
+
+    paths = [split_path] if split_path.endswith('.json') else \
+        [os.path.join(split_path, file_name) for file_name in list_parts(split_path) if file_name.endswith('.json')]
+    for path in paths:
+        if path != split_path:
+            click.echo(f"####{os.path.basename(path)}####")
+        with open(path, 'r') as jsonfile:
             try:
-                data = json.load(jsonfile)
-                # Access all columns
-                col_list = []
-                for record in data:
-                    for key, value in record.items():
-                        if len(columns) == 0:
-                            print(data)
-                            break
-                        elif key in columns:
-                            col_list.append({key: value})
-                click.echo(json.dumps(col_list, indent=4))
+                click.echo(json.dumps(list(project_records(load_table(jsonfile), columns)), indent=4))
             except json.JSONDecodeError:
-
                 click.echo("Empty JSON file...")
-    else:
-        for file_name in sorted(os.listdir(split_path)):
-            click.echo(f"####{file_name}####")
-            if file_name.endswith('.json'):
-                with open(os.path.join(split_path, file_name), 'r') as jsonfile:
-                    try:
-                        data = json.load(jsonfile)
-                        # Access all columns
-                        col_list = []
-                        for record in data:
-                            for key, value in record.items():
-                                if len(columns) == 0:
-                                    print(data)
-                                    break
-                                elif key in columns:
-                                    col_list.append({key: value})
-                        click.echo(json.dumps(col_list, indent=4))
-                    except json.JSONDecodeError:
-
-                        click.echo("Empty JSON file...")
 
 
-def update_record(data, record_id, new_values):
+def record_position(data, record_id):
     """
-    Update a record in the data list by its ID with new values.
+    Position of the record with the given ID in the data list, None when there is none.
     """
-    for record in data:
+    for position, record in enumerate(data):
         if record.get('id') == record_id:
-            for key, value in new_values.items():
-                record[key] = value  # Manually update each field
-            return True
-    return False
+            return position
+    return None
 
 
 @click.command()
@@ -275,77 +474,143 @@ def update_jval(db, table, record_id, new_values):
     table_path_json = os.path.join(db_path, f"{table}.json")
     split_path = split_json_file(db, table)
 
-    if split_path.endswith('.json'):
-        with open(split_path, 'r+') as jsonfile:
-            try:
-                data = json.load(jsonfile)
-                if not isinstance(data, list):
-                    click.echo("Invalid table format.")
-                    sys.exit(1)
+    try:
+        record_id = int(record_id)
+        new_values = json.loads(new_values)
+    except (ValueError, json.JSONDecodeError):
+        click.echo("Invalid record ID or JSON format for new values.")
+        sys.exit(1)
 
+    with table_index(db, table, split_path) as index, table_field_indexes(db, table, split_path) as indexes:
+        location = index.locate(record_id)
+        if location is None:
+            click.echo("No matching record found to update.")
+            return
+        path, offset = location
+        if os.path.isdir(split_path):
+            click.echo(f"####{os.path.basename(path)}####")
+
+        if path.endswith('.jsonl'):
+            # rewritten in place when the new line fits, otherwise moved to the end of the table
+            record = id_index.read_at(path, offset)
+            indexes.remove(record, path, offset)
+            record.update(new_values)
+            new_path, new_offset = id_index.rewrite_line(path, offset, record, table_files(split_path)[-1])
+            index.put(record_id, new_path, new_offset)
+            indexes.add(record, new_path, new_offset)
+            for changed in {path, new_path}:
+                index.stamp(changed)
+                indexes.stamp(changed)
+        else:
+            with open(path, 'r+') as jsonfile:
                 try:
-                    record_id = int(record_id)
-                    new_values = json.loads(new_values)
-                except (ValueError, json.JSONDecodeError):
-                    click.echo("Invalid record ID or JSON format for new values.")
+                    data = load_table(jsonfile, mutable=True)
+                except json.JSONDecodeError:
+                    click.echo("Invalid JSON file.")
+                    sys.exit(1)
+                if not compact.is_table(data):
+                    click.echo("Invalid table format.")
                     sys.exit(1)
 
-                if update_record(data, record_id, new_values):
-                    jsonfile.seek(0)
-                    jsonfile.truncate()
-                    json.dump(data, jsonfile, indent=4)
-                    click.echo("Record updated successfully.")
-                else:
+                position = offset if offset < len(data) and data[offset].get('id') == record_id \
+                    else record_position(data, record_id)
+                if position is None:
                     click.echo("No matching record found to update.")
-            except json.JSONDecodeError:
-                click.echo("Invalid JSON file.")
-                sys.exit(1)
-    else:
-        for file_name in sorted(os.listdir(split_path)):
-            click.echo(f"####{file_name}####")
-            if file_name.endswith('.json'):
-                with open(os.path.join(split_path, file_name), 'r') as jsonfile:
-                    try:
-                        data = json.load(jsonfile)
-                        if not isinstance(data, list):
-                            click.echo("Invalid table format.")
-                            sys.exit(1)
+                    return
+                indexes.remove(data[position], path, position)
+                data[position].update(new_values)
+                indexes.add(data[position], path, position)
+                jsonfile.seek(0)
+                jsonfile.truncate()
+                json.dump(data, jsonfile, indent=4)
+            index.stamp(path)
+            indexes.stamp(path)
+    click.echo("Record updated successfully.")
 
-                        try:
-                            record_id = int(record_id)
-                            new_values = json.loads(new_values)
-                        except (ValueError, json.JSONDecodeError):
-                            click.echo("Invalid record ID or JSON format for new values.")
-                            sys.exit(1)
 
-                        if update_record(data, record_id, new_values):
-                            jsonfile.seek(0)
-                            jsonfile.truncate()
-                            json.dump(data, jsonfile, indent=4)
-                            click.echo("Record updated successfully.")
-                        else:
-                            click.echo("No matching record found to update.")
-                    except json.JSONDecodeError:
-                        click.echo("Invalid JSON file.")
-                        sys.exit(1)
+@click.command()
+@click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
+@click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
+@click.option('--id', 'record_id', prompt="Enter the ID of the record", type=int, help="ID of the record to fetch.")
+def get_jval(db, table, record_id):
+    """
+    Fetch one record by id through the table's id index.
+    e.g. python main.py get-jval --db=test-db --table=t --id=1
+    """
+    db_path = os.path.join('database', db)
+    if not os.path.exists(db_path):
+        click.echo("Database does not exist.")
+        sys.exit(1)
+
+    split_path = split_json_file(db, table)
+    with table_index(db, table, split_path) as index:
+        location = index.locate(record_id)
+    if location is None:
+        click.echo(f"No record with id {record_id}.")
+        sys.exit(1)
+    click.echo(json.dumps(id_index.read_at(*location), indent=4))
+
+
+@click.command()
+@click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
+@click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
+@click.option('--field', prompt="Enter the field to index", help="Field to index, a dotted path reaches into nested objects (e.g. address.city).")
+@click.option('--kind', type=click.Choice(field_index.KINDS), default='hash', help="hash for equality lookups, sorted for equality and range lookups, text for contains / match.")
+@click.option('--drop', is_flag=True, help="Remove the index instead of building it.")
+def create_index_jval(db, table, field, kind, drop):
+    """
+    Build a secondary index on a field of a JSON table, used by filter-jval and select-jval.
+    e.g. python main.py create-index-jval --db=test-db --table=t --field=column1 --kind=sorted
+    """
+    db_path = os.path.join('database', db)
+    if not os.path.exists(db_path):
+        click.echo("Database does not exist.")
+        sys.exit(1)
+
+    table_dir = os.path.join(db_path, table)
+    if drop:
+        if not field_index.drop(table_dir, field, kind):
+            click.echo(f"No {kind} index on '{field}'.")
+            sys.exit(1)
+        click.echo(f"Dropped the {kind} index on '{field}'.")
+        return
+
+    split_path = split_json_file(db, table)
+    try:
+        count = field_index.create(table_dir, table_files(split_path), field, kind)
+    except json.JSONDecodeError:
+        click.echo("Invalid JSON file.")
+        sys.exit(1)
+    click.echo(f"Built a {kind} index on '{field}' over {count} records.")
+
+
+def index_candidates(db, table, split_path, criteria, operations=False):
+    """
+    {path: offsets} of the records the table's secondary indexes allow to match criteria,
+    None when no index applies (see field_index.candidates)
+    """
+    return field_index.candidates(os.path.join('database', db, table), table_files(split_path), criteria, operations)
+
+
+def matches_criteria(record, criteria):
+    return all(field_index.get_path(record, key) == value for key, value in criteria.items())
 
 
 def filter_records(data, criteria):
     """
     Filter records in the data list based on the given criteria.
     """
-    filtered_data = []
-    for record in data:
-        if all(record.get(key) == value for key, value in criteria.items()):
-            filtered_data.append(record)
-    return filtered_data
+    return list(physical.Filter(physical.Scan(data), lambda record: matches_criteria(record, criteria)).records())
 
 
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
 @click.option('--criteria', prompt="Enter the filter criteria as a JSON string", help="Filter criteria as a JSON string.")
-def filter_jval(db, table, criteria):
+@click.option("--workers", default=1, type=click.IntRange(min=0), help="Scan the parts of a split table on this many processes (0 = one per core) and merge the results.")
+@click.option('--output-format', type=click.Choice(writers.FORMATS), default='json', help="json (indented array), ndjson (one record per line) or csv.")
+@click.option('--output', default=None, help="Write the result to this file instead of printing it.")
+def filter_jval(db, table, criteria, workers, output_format, output):
     """
     Filter records in a JSON file based on provided criteria.
     e.g. python main.py filter-jval --db=test-db --table=t --criteria='{"column2": "3"}'
@@ -357,12 +622,63 @@ def filter_jval(db, table, criteria):
     
     table_path_json = os.path.join(db_path, f"{table}.json")
     split_path = split_json_file(db, table)
+
+    try:
+        criteria_dict = json.loads(criteria)
+    except json.JSONDecodeError:
+        click.echo("Invalid JSON format for criteria.")
+        sys.exit(1)
+
+    # --output-format / --output stream one result for the whole table
+    if single_output(output_format, output):
+        try:
+            emit_records(filter_table(db, table, split_path, criteria_dict, workers), output_format, output)
+        except json.JSONDecodeError:
+            click.echo("Invalid JSON file.")
+            sys.exit(1)
+        return
+
+    locations = index_candidates(db, table, split_path, criteria_dict) if isinstance(criteria_dict, dict) else None
+    if locations is not None:
+        # only the records the indexes point at are read, and checked against all criteria
+        for path in table_files(split_path):
+            if os.path.isdir(split_path):
+                click.echo(f"####{os.path.basename(path)}####")
+            matches = [record for record in field_index.read_records(path, locations[path])
+                       if matches_criteria(record, criteria_dict)]
+            if matches:
+                echo_records(matches)
+            else:
+                click.echo("No matching records found.")
+        return
+
+    if workers != 1 and os.path.isdir(split_path):
+        # one result for the whole table, parts concatenated in part order
+        results = map_parts(filter_part, table_files(split_path), workers, criteria_dict)
+        if not any(results):
+            click.echo("No matching records found.")
+        else:
+            echo_records(itertools.chain.from_iterable(results))
+        return
+
+    parts = jsonl_parts(split_path)
+    if parts is not None:
+        for path in parts:
+            if os.path.isdir(split_path):
+                click.echo(f"####{os.path.basename(path)}####")
+            matches = (record for record in scan_records(path) if matches_criteria(record, criteria_dict))
+            first = next(matches, None)
+            if first is None:
+                click.echo("No matching records found.")
+            else:
+                echo_records(itertools.chain([first], matches))
+        return
     
     if split_path.endswith('.json'):
         with open(split_path, 'r') as jsonfile:
             try:
-                data = json.load(jsonfile)
-                if not isinstance(data, list):
+                data = load_table(jsonfile)
+                if not compact.is_table(data):
                     click.echo("Invalid table format.")
                     sys.exit(1)
 
@@ -381,13 +697,13 @@ def filter_jval(db, table, criteria):
                 click.echo("Invalid JSON file.")
                 sys.exit(1)
     else:
-        for file_name in sorted(os.listdir(split_path)):
+        for file_name in list_parts(split_path):
             click.echo(f"####{file_name}####")
             if file_name.endswith('.json'):
                 with open(os.path.join(split_path, file_name), 'r') as jsonfile:
                     try:
-                        data = json.load(jsonfile)
-                        if not isinstance(data, list):
+                        data = load_table(jsonfile)
+                        if not compact.is_table(data):
                             click.echo("Invalid table format.")
                             sys.exit(1)
 
@@ -406,84 +722,106 @@ def filter_jval(db, table, criteria):
                         click.echo("Invalid JSON file.")
                         sys.exit(1)
 
-def sort_records(data, fields):
+def filter_table(db, table, split_path, criteria, workers=1):
     """
-    Sort records in the data list based on the specified fields.
+    Records of the whole table matching criteria, parts in part order, read through the indexes
+    when they apply, on a worker pool with workers != 1, otherwise scanned as they are yielded
     """
-    return sorted(data, key=lambda x: tuple(x[field] for field in fields))
+    paths = table_files(split_path)
+    locations = index_candidates(db, table, split_path, criteria) if isinstance(criteria, dict) else None
+    if locations is not None:
+        for path in paths:
+            yield from (record for record in field_index.read_records(path, locations[path])
+                        if matches_criteria(record, criteria))
+    elif workers != 1 and len(paths) > 1:
+        for matches in map_parts(filter_part, paths, workers, criteria):
+            yield from matches
+    else:
+        for path in paths:
+            yield from physical.Filter(physical.Scan(scan_records(path)),
+                                        lambda record: matches_criteria(record, criteria)).records()
+
+
+def sort_records(data, key, limit=0):
+    """
+    Records of data in key order: the first limit ones through a heap of limit records,
+    all of them through spill.external_sort (see physical.ExternalSort).
+    """
+    return physical.ExternalSort(physical.Scan(data), key, limit).records()
 
 
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
-@click.option('--fields', prompt="Enter the fields to sort by, separated by commas", help="Fields to sort by.")
-def order_jval(db, table, fields):
+@click.option('--fields', prompt="Enter the fields to sort by, separated by commas", help="Fields to sort by, each optionally followed by asc or desc.")
+@click.option('--nulls', type=click.Choice(ordering.NULLS), default='last', help="Sort records with a null or missing field first or last.")
+@click.option('--limit', default=0, type=click.IntRange(min=0), help="Only the first N records (top-N without sorting the whole table).")
+@click.option('--output-format', type=click.Choice(writers.FORMATS), default='json', help="json (indented array), ndjson (one record per line) or csv.")
+@click.option('--output', default=None, help="Write the result to this file instead of printing it.")
+def order_jval(db, table, fields, nulls, limit, output_format, output):
     """
     Sort records in a JSON file based on specified fields.
-    e.g. python main.py order-jval --db=test-db --table=t --fields=column2
+    e.g. python main.py order-jval --db=test-db --table=t --fields='salary_in_usd desc, work_year' --limit=10
     """
     db_path = os.path.join('database', db)
     if not os.path.exists(db_path):
         click.echo("Database does not exist.")
         sys.exit(1)
 
-    table_path_json = os.path.join(db_path, f"{table}.json")
+    try:
+        order = ordering.parse_order(fields)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
+    if not order:
+        click.echo("No sorting field given.")
+        sys.exit(1)
+
     split_path = split_json_file(db, table)
 
-    if split_path.endswith('.json'):
-        with open(split_path, 'r') as jsonfile:
-            try:
-                data = json.load(jsonfile)
-                if not isinstance(data, list):
-                    click.echo("Invalid table format.")
-                    sys.exit(1)
+    # the parts of a split table are sorted as one, --limit keeps a heap of the first records
+    try:
+        emit_records(sort_records(iter_table(table_files(split_path)), ordering.key_func(order, nulls), limit),
+                     output_format, output)
+    except json.JSONDecodeError:
+        click.echo("Invalid JSON file.")
+        sys.exit(1)
 
-                sort_fields = [field.strip() for field in fields.split(',')]
-                sorted_data = sort_records(data, sort_fields)
-                click.echo(json.dumps(sorted_data, indent=4))
-            except json.JSONDecodeError:
-                click.echo("Invalid JSON file.")
-                sys.exit(1)
-            except KeyError as e:
-                click.echo(f"Invalid sorting field: {e}")
-                sys.exit(1)
-    else:
-        for file_name in sorted(os.listdir(split_path)):
-            if file_name.endswith('.json'):
-                with open(os.path.join(split_path, file_name), 'r') as jsonfile:
-                    try:
-                        data = json.load(jsonfile)
-                        if not isinstance(data, list):
-                            click.echo("Invalid table format.")
-                            sys.exit(1)
-
-                        sort_fields = [field.strip() for field in fields.split(',')]
-                        sorted_data = sort_records(data, sort_fields)
-                        click.echo(json.dumps(sorted_data, indent=4))
-                    except json.JSONDecodeError:
-                        click.echo("Invalid JSON file.")
-                        sys.exit(1)
-                    except KeyError as e:
-                        click.echo(f"Invalid sorting field: {e}")
-                        sys.exit(1)
 
 def group_by_field(data, field):
     """
     Group records in the data list based on the specified field.
+    Yields (key, records); past --memory-limit the groups are partitioned to temp files.
     """
-    grouped_data = defaultdict(list)
-    for record in data:
-        key = record.get(field, None)
-        if key is not None:
-            grouped_data[key].append(record)
-    return dict(grouped_data)
+    records = (record for record in data if record.get(field, None) is not None)
+    return spill.hash_group(records, lambda record: record.get(field))
+
+
+def aggregate_groups(data, field, specs):
+    """
+    One pass over the records keeping only the aggregates.parse_specs accumulators of every group,
+    so memory is O(groups); returns {key: accumulators} (see spill.hash_aggregate for --memory-limit).
+    """
+    return dict(spill.hash_aggregate(((record.get(field, None), record) for record in data),
+                                     lambda: aggregates.new_accs(specs),
+                                     lambda accs, record: aggregates.add_record(accs, record, specs)))
+
+
+def echo_groups(grouped_data):
+    """
+    Print (key, records) pairs as one JSON object, a group at a time.
+    """
+    writers.write_groups(grouped_data)
 
 
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
 @click.option('--field', prompt="Enter the field to group by", help="Field to group by.")
-def group_by_jval(db, table, field):
+@click.option('--agg', default='', help="Aggregates per group instead of the records, e.g. count,sum:salary_in_usd,avg:salary_in_usd (also min:, max:).")
+@click.option('--output-format', type=click.Choice(writers.FORMATS), default='json', help="json (an object of the groups), ndjson or csv (one row per record, or per group with --agg).")
+@click.option('--output', default=None, help="Write the result to this file instead of printing it.")
+def group_by_jval(db, table, field, agg, output_format, output):
     """
     Group records in a JSON file based on a specified field.
     e.g. python main.py group-by-jval --db=test-db --table=t --field=column1
@@ -493,19 +831,51 @@ def group_by_jval(db, table, field):
         click.echo("Database does not exist.")
         sys.exit(1)
 
+    try:
+        specs = aggregates.parse_specs(agg)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
+
     table_path_json = os.path.join(db_path, f"{table}.json")
     split_path = split_json_file(db, table)
+
+    # --agg keeps one accumulator per aggregate and group, merged over all parts into one result
+    if specs:
+        records = physical.Filter(physical.Scan(physical.JsonSource(table_files(split_path))),
+                                   lambda record: record.get(field, None) is not None)
+        try:
+            groups = list(physical.HashAggregate(records, [field], specs).groups())
+        except json.JSONDecodeError:
+            click.echo("Invalid JSON file.")
+            sys.exit(1)
+        emit_groups(groups, output_format, output, lambda key, results: [{field: key, **results}])
+        return
+
+    # --output-format / --output stream one result for the whole table
+    if single_output(output_format, output):
+        try:
+            emit_groups(group_by_field(iter_table(table_files(split_path)), field), output_format, output)
+        except json.JSONDecodeError:
+            click.echo("Invalid JSON file.")
+            sys.exit(1)
+        return
+
+    parts = jsonl_parts(split_path)
+    if parts is not None:
+        for path in parts:
+            echo_groups(group_by_field(scan_records(path), field))
+        return
     
     if split_path.endswith('.json'):
         with open(split_path, 'r') as jsonfile:
             try:
-                data = json.load(jsonfile)
-                if not isinstance(data, list):
+                data = load_table(jsonfile)
+                if not compact.is_table(data):
                     click.echo("Invalid table format.")
                     sys.exit(1)
 
-                grouped_data = group_by_field(data, field)
-                click.echo(json.dumps(grouped_data, indent=4))
+                echo_groups(group_by_field(data, field))
             except json.JSONDecodeError:
                 click.echo("Invalid JSON file.")
                 sys.exit(1)
@@ -513,17 +883,16 @@ def group_by_jval(db, table, field):
                 click.echo(f"Field '{field}' not found in records.")
                 sys.exit(1)
     else:
-        for file_name in sorted(os.listdir(split_path)):
+        for file_name in list_parts(split_path):
             if file_name.endswith('.json'):
                 with open(os.path.join(split_path, file_name), 'r') as jsonfile:
                     try:
-                        data = json.load(jsonfile)
-                        if not isinstance(data, list):
+                        data = load_table(jsonfile)
+                        if not compact.is_table(data):
                             click.echo("Invalid table format.")
                             sys.exit(1)
 
-                        grouped_data = group_by_field(data, field)
-                        click.echo(json.dumps(grouped_data, indent=4))
+                        echo_groups(group_by_field(data, field))
                     except json.JSONDecodeError:
                         click.echo("Invalid JSON file.")
                         sys.exit(1)
@@ -531,118 +900,121 @@ def group_by_jval(db, table, field):
                         click.echo(f"Field '{field}' not found in records.")
                         sys.exit(1)
 
-def natural_join(data1, data2):
-    """
-    Perform a natural join on two sets of data.
-    """
-    # Identify common fields
-    common_fields = set(data1[0].keys()) & set(data2[0].keys())
-    joined_data = []
-    for record1 in data1:
-        for record2 in data2:
-            if all(record1[field] == record2[field] for field in common_fields):
-                joined_record = {**record1, **record2}
-                joined_data.append(joined_record)
-    return joined_data
-
 
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table1", prompt="Enter the name of the first table", help="The name of the first table", required=True)
 @click.option("--table2", prompt="Enter the name of the second table", help="The name of the second table", required=True)
-@click.option('--join-field', prompt="Enter the join field", help="Field on which to join the tables.")
-def join_jval(db, table1, table2, join_field):
+@click.option('--join-field', prompt="Enter the join field", help="Field(s) on which to join the tables, comma-separated.")
+@click.option('--how', type=click.Choice(['inner', 'left']), default='inner', help="inner join, or left join keeping unmatched records of table1.")
+@click.option('--output-format', type=click.Choice(writers.FORMATS), default='json', help="json (indented array), ndjson (one record per line) or csv.")
+@click.option('--output', default=None, help="Write the result to this file instead of printing it.")
+def join_jval(db, table1, table2, join_field, how, output_format, output):
     """
     Join two JSON tables in a database based on a specified field.
     e.g. python main.py join-jval --db=test-db --table1=t --table2=t2 --join-field=column1
+    add --how=left to keep the records of table1 without a match,
+    --output-format=ndjson|csv and --output=FILE to stream the joined records out
     """
     db_path = os.path.join('database', db)
     if not os.path.exists(db_path):
         click.echo("Database does not exist.")
         sys.exit(1)
 
-    table1_path = os.path.join(db_path, f"{table1}.json")
-    table2_path = os.path.join(db_path, f"{table2}.json")
+    fields = [field.strip() for field in join_field.split(',') if field.strip()]
+    if not fields:
+        click.echo("No join field given.")
+        sys.exit(1)
 
-    table_path_json = os.path.join(db_path, f"{table1}.json")
     split_path1 = split_json_file(db, table1)
     split_path2 = split_json_file(db, table2)
 
-    if split_path1.endswith('.json') and split_path2.endswith('.json'):
-        with open(split_path1, 'r') as jsonfile1, open(split_path2, 'r') as jsonfile2:
-            try:
-                data1 = json.load(jsonfile1)
-                data2 = json.load(jsonfile2)
-                if not (isinstance(data1, list) and isinstance(data2, list)):
-                    click.echo("Invalid table formats.")
-                    sys.exit(1)
+    try:
+        emit_records(hash_join_tables(table_files(split_path1), table_files(split_path2), fields, how),
+                     output_format, output)
+    except json.JSONDecodeError:
+        click.echo("Invalid JSON in one or both files.")
+        sys.exit(1)
 
-                joined_data = natural_join(data1, data2)
-                click.echo(json.dumps(joined_data, indent=4))
-            except json.JSONDecodeError:
-                click.echo("Invalid JSON in one or both files.")
-                sys.exit(1)
-            except KeyError as e:
-                click.echo(f"Error in joining tables: {e}")
-                sys.exit(1)
-    else:
-        for file_name in sorted(os.listdir(split_path1)):
-            for file_name2 in sorted(os.listdir(split_path2)):
-                if file_name.endswith('.json') and file_name2.endswith('.json'):
-                    with open(os.path.join(split_path1, file_name), 'r') as jsonfile1, open(os.path.join(split_path2, file_name2), 'r') as jsonfile2:
-                        try:
-                            data1 = json.load(jsonfile1)
-                            data2 = json.load(jsonfile2)
-                            if not (isinstance(data1, list) and isinstance(data2, list)):
-                                click.echo("Invalid table formats.")
-                                sys.exit(1)
-
-                            joined_data = natural_join(data1, data2)
-                            click.echo(json.dumps(joined_data, indent=4))
-                        except json.JSONDecodeError:
-                            click.echo("Invalid JSON in one or both files.")
-                            sys.exit(1)
-                        except KeyError as e:
-                            click.echo(f"Error in joining tables: {e}")
-                            sys.exit(1)
+
+def join_key(record, fields):
+    """ Hashable join key of a record, None (never matches) when a join field is missing or null """
+    return physical.join_key(record, fields)
+
+
+def iter_table(paths):
+    """ Records of all files of a table, streamed part by part (a JSON array part from its snapshot when fresh) """
+    return physical.JsonSource(paths).records()
+
+
+def hash_join_tables(paths1, paths2, fields, how):
+    """
+    Join the records of two tables on fields: the smaller table (by bytes) is hashed, once for all
+    of its parts, and the other one streamed past it (see physical.HashJoin).
+    Joined records are {**record1, **record2}; a left join keeps unmatched records of the first table.
+    """
+    key = functools.partial(join_key, fields=fields)
+    source1, source2 = physical.JsonSource(paths1), physical.JsonSource(paths2)
+    return physical.HashJoin(physical.Scan(source1), physical.Scan(source2), key, key, how,
+                              build='right' if source2.size() <= source1.size() else 'left').records()
 
 
 def filter_data(data, criteria):
-    """ Filter data based on criteria which can include > and < operations. """
-    filtered_data = []
-    for record in data:
-        include_record = True
-        for field, condition in criteria.items():
-            if 'operation' in condition and 'value' in condition:
-                operation = condition['operation']
-                value = condition['value']
-                
-                # convert str to float if possible
-                if isinstance(value, str) and value.isdigit():
-                    value = float(value)
-                    comp_val = float(record.get(field, 0))
-                    comp_eq_val = float(record.get(field, 0))
-                else:
-                    value = value
-                    comp_val = record.get(field, 0)
-                    comp_eq_val = record.get(field, 0)
-                
-                # compare values
-                if operation == '=' and not comp_eq_val == value:
-                    include_record = False
-                    break
-                elif operation == '>' and not comp_val > value:
-                    include_record = False
-                    break
-                elif operation == '<' and not comp_val < value:
-                    include_record = False
-                    break
-            elif record.get(field) != condition:
-                include_record = False
-                break
-        if include_record:
-            filtered_data.append(record)
-    return filtered_data
+    """ Filter data based on criteria which can include >, <, contains and match operations. """
+    return list(physical.Filter(physical.Scan(data), compile_criteria(criteria)).records())
+
+
+def compile_criteria(criteria):
+    """
+    The record -> bool test of filter_data criteria, built once per distinct criteria and kept
+    (a repeated or prepared query in the daemon reuses it); every entry must hold.
+    """
+    key = json.dumps(criteria, sort_keys=True)
+    test = _predicates.get(key)
+    if test is not None:
+        _predicates.move_to_end(key)
+        return test
+
+    tests = [condition_test(field, condition) for field, condition in criteria.items()]
+    if len(tests) == 1:
+        test = tests[0]
+    else:
+        test = lambda record: all(check(record) for check in tests)
+    _predicates[key] = test
+    if len(_predicates) > MAX_PREDICATES:
+        _predicates.popitem(last=False)
+    return test
+
+
+def condition_test(field, condition):
+    """
+    The test of one criteria entry: {"operation": "=" | ">" | "<", "value": v} compares numerically
+    when v is a digit string (a missing field as 0), contains / match search the text of the field
+    (see text_index), any other condition is an equality
+    """
+    if not (isinstance(condition, dict) and 'operation' in condition and 'value' in condition):
+        return lambda record: field_index.get_path(record, field) == condition
+
+    operation, value = condition['operation'], condition['value']
+    # substring / word search on the text of the field (see text_index)
+    if operation in text_index.OPERATORS:
+        search = text_index.OPERATORS[operation]
+        return lambda record: search(field_index.get_path(record, field), value)
+
+    # convert str to float if possible
+    if isinstance(value, str) and value.isdigit():
+        value = float(value)
+        read = lambda record: float(field_index.get_path(record, field, 0))
+    else:
+        read = lambda record: field_index.get_path(record, field, 0)
+
+    if operation == '=':
+        return lambda record: read(record) == value
+    if operation == '>':
+        return lambda record: read(record) > value
+    if operation == '<':
+        return lambda record: read(record) < value
+    return lambda record: True
 
 def group_by(data, field):
     """ Group data by a field """
@@ -651,9 +1023,185 @@ def group_by(data, field):
         grouped_data[record.get(field, None)].append(record)
     return dict(grouped_data)
 
-def order_by(data, fields):
-    """ Sort data by given fields """
-    return sorted(data, key=lambda x: tuple(x.get(field, None) for field in fields))
+def order_by(data, orderby, nulls="last", limit=0):
+    """ Sort data by the fields of orderby with typed keys (see ordering), only the first limit records when set """
+    key = ordering.key_func(ordering.parse_order(orderby), nulls)
+    return list(physical.ExternalSort(physical.Scan(data), key, limit).records())
+
+
+def select_plan(split_path, criteria, groupby, orderby, workers=None, specs=None, limit=0, indexes=()):
+    scans = table_files(split_path)
+
+    steps = [f"Scan {', '.join(scans)}"]
+    if indexes:
+        steps[0] = "Index scan " + ", ".join(f"{field} ({kind})" for field, kind, _ in indexes) + " of " + ", ".join(scans)
+    elif criteria and scans[0].endswith('.jsonl'):
+        steps[0] += " (streaming)"
+    if criteria:
+        steps.append(f"Filter {json.dumps(criteria)}")
+    if groupby and specs:
+        steps.append(f"Aggregate {', '.join(label for label, _, _ in specs)} by {groupby}")
+    elif groupby:
+        steps.append(f"Group by {groupby}")
+    elif orderby:
+        steps.append(f"Sort {orderby}" + (f" (top {limit})" if limit else ""))
+    if len(scans) > 1 and workers is not None:
+        steps.append(f"(run for each part on {workers or os.cpu_count()} workers)")
+    elif len(scans) > 1:
+        steps.append("(repeated for each part)")
+    if len(scans) > 1 and merges_parts(workers is not None, specs, groupby, orderby, limit):
+        steps.append("Merge parts" + (" by group" if groupby else " in sort order" if orderby else " in part order"))
+    if limit:
+        steps.append(f"Limit {limit}")
+    return steps
+
+
+def merges_parts(parallel, specs, groupby, orderby, limit):
+    """ Whether select-jval combines the parts of a split table into one result instead of printing each """
+    return parallel or bool(specs) or (not groupby and bool(orderby or limit))
+
+
+def map_parts(func, paths, workers, *args):
+    """
+    func(path, *args) for every part on a pool of worker processes (workers=0: one per core),
+    results returned in part order
+    """
+    workers = min(workers or os.cpu_count(), len(paths)) or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, paths, *[itertools.repeat(arg) for arg in args]))
+
+
+def filter_part(path, criteria):
+    return list(physical.Filter(physical.Scan(scan_records(path)),
+                                lambda record: matches_criteria(record, criteria)).records())
+
+
+def project_part(path, columns):
+    return list(project_records(scan_records(path), columns))
+
+
+def project_records(records, columns):
+    """ {field: value} of every field of columns a record has, one per field; all records without columns """
+    if not columns:
+        return records
+    return ({key: value} for record in physical.Project(physical.Scan(records), columns).records()
+            for key, value in record.items())
+
+
+def select_part_worker(path, criteria, groupby, orderby, analyze, specs, nulls, limit, locations):
+    stages = profiler.start_analyze(analyze)
+    offsets = locations[path] if locations is not None else None
+    return select_part(path, criteria, groupby, orderby, stages, specs, nulls, limit, offsets), stages or []
+
+
+def merge_selects(results, groupby, orderby, specs=None, nulls="last", limit=0):
+    """
+    Combine per-part select results: aggregates merged and finished per group, groups merged by key,
+    sorted runs merged (global order), otherwise concatenated; records cut at limit when set.
+    Records are merged lazily, as an iterator over the per-part results
+    """
+    if groupby and specs:
+        merged = {}
+        for groups in results:
+            for key, accs in groups.items():
+                if key in merged:
+                    aggregates.merge_accs(merged[key], accs)
+                else:
+                    merged[key] = accs
+        return {key: aggregates.results(accs, specs) for key, accs in merged.items()}
+    if groupby:
+        merged = {}
+        for groups in results:
+            for key, records in groups.items():
+                merged.setdefault(key, []).extend(records)
+        return merged
+    if orderby:
+        key = ordering.key_func(ordering.parse_order(orderby), nulls)
+        records = heapq.merge(*results, key=key)
+    else:
+        records = itertools.chain.from_iterable(results)
+    return itertools.islice(records, limit or None)
+
+
+def emit_select(data, groupby, specs, output_format="json", output=None):
+    """ Write a select result, records or {key: group}, as json.dumps(data, indent=4) would or to --output """
+    if isinstance(data, dict):
+        rows = (lambda key, results: [{groupby: key, **results}]) if specs else (lambda key, records: records)
+        emit_groups(data.items(), output_format, output, rows)
+    else:
+        emit_records(data, output_format, output)
+
+
+def count_rows(records, stats):
+    for record in records:
+        stats["rows_in"] += 1
+        yield record
+
+
+def stream_part(path, criteria, orderby, nulls="last", limit=0, offsets=None):
+    """
+    The records select_part returns without --groupby, as an iterator: read, filtered, sorted and cut
+    while the result is written, so only a sort holds the records of the part (spilled past --memory-limit)
+    """
+    plan = physical.Scan(scan_records(path) if offsets is None else field_index.read_records(path, offsets))
+    if criteria:
+        plan = physical.Filter(plan, compile_criteria(criteria))
+    if orderby:
+        plan = physical.ExternalSort(plan, ordering.key_func(ordering.parse_order(orderby), nulls), limit)
+    elif limit:
+        plan = physical.Limit(plan, limit)
+    return plan.records()
+
+
+def select_part(path, criteria, groupby, orderby, stages=None, specs=None, nulls="last", limit=0, offsets=None):
+    """
+    Run where / groupby / orderby / limit over a single table file or part;
+    with aggregate specs the groups are {key: accumulators} for merge_selects to finish.
+    offsets (from index_candidates) restricts the scan to the records at those offsets
+    """
+    part_name = os.path.basename(path)
+    with profiler.stage(stages, f"{'scan' if offsets is None else 'index scan'} {part_name}") as stats:
+        if offsets is None:
+            profiler.scan_file(stats, path)
+        # JSON Lines parts are filtered while they are read, only the matches are kept
+        streaming = path.endswith('.jsonl') and criteria
+        try:
+            records = scan_records(path) if offsets is None else field_index.read_records(path, offsets)
+            if streaming:
+                records = count_rows(records, stats)
+                data = filter_data(records, criteria)
+            else:
+                data = list(records)
+                stats["rows_in"] = len(data)
+        except json.JSONDecodeError:
+            click.echo("Invalid JSON format.")
+            sys.exit(1)
+        stats["rows_out"] = len(data)
+
+    # Apply where
+    if criteria and not streaming:
+        with profiler.stage(stages, f"filter {part_name}", rows_in=len(data)) as stats:
+            data = filter_data(data, criteria)
+            stats["rows_out"] = len(data)
+
+    # Apply groupby
+    if groupby and specs:
+        with profiler.stage(stages, f"aggregate {part_name}", rows_in=len(data)) as stats:
+            data = aggregate_groups(data, groupby, specs)
+            stats["rows_out"] = len(data)
+    elif groupby:
+        with profiler.stage(stages, f"group {part_name}", rows_in=len(data)) as stats:
+            data = group_by(data, groupby)
+            # If grouped, ordering within groups isn't handled in this implementation
+            stats["rows_out"] = len(data)
+    elif orderby:  # Apply orderby only if not grouped
+        with profiler.stage(stages, f"sort {part_name}", rows_in=len(data)) as stats:
+            data = order_by(data, orderby, nulls, limit)
+            stats["rows_out"] = len(data)
+    elif limit:
+        data = list(physical.Limit(physical.Scan(data), limit).records())
+    return data
+
 
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
@@ -661,7 +1209,17 @@ def order_by(data, fields):
 @click.option("--where", prompt="Enter the filter criteria as a JSON string", default="{}", help="Filter criteria as a JSON string.")
 @click.option("--groupby", prompt="Enter the field to group by", default="", help="Field to group by.")
 @click.option("--orderby", prompt="Enter the fields to sort by, separated by commas", default="", help="Fields to sort by.")
-def select_jval(db, table, where, groupby, orderby):
+@click.option("--explain", is_flag=True, help="Print the stage plan without running the query.")
+@click.option("--analyze", is_flag=True, help="Run the query and report per-stage statistics instead of the records.")
+@click.option("--profile", default="", help="Write a cProfile dump of the query to this file.")
+@click.option("--workers", default=1, type=click.IntRange(min=0), help="Scan the parts of a split table on this many processes (0 = one per core) and merge the results.")
+@click.option("--agg", default="", help="Aggregates per group instead of the records, e.g. count,sum:salary_in_usd,avg:salary_in_usd (also min:, max:).")
+@click.option("--nulls", type=click.Choice(ordering.NULLS), default="last", help="Sort records with a null or missing orderby field first or last.")
+@click.option("--limit", default=0, type=click.IntRange(min=0), help="Return only the first N records (top-N with --orderby); not with --groupby.")
+@click.option("--output-format", type=click.Choice(writers.FORMATS), default="json", help="json (indented array), ndjson (one record per line) or csv.")
+@click.option("--output", default=None, help="Write the result to this file instead of printing it.")
+def select_jval(db, table, where, groupby, orderby, explain, analyze, profile, workers, agg, nulls, limit,
+                output_format, output):
     """
     Select records from a JSON table with options to filter, group, and order the data.
     e.g. python main.py select-jval --db=test-db --table=t --where='{"id" : {"operation": "<", "value": 4}}' --groupby=column1 --orderby=column2
@@ -671,59 +1229,102 @@ def select_jval(db, table, where, groupby, orderby):
         click.echo("Database does not exist.")
         sys.exit(1)
 
-    table_path_json = os.path.join(db_path, f"{table}.json")
     split_path = split_json_file(db, table)
 
-    if split_path.endswith('.json'):
-        with open(split_path, 'r') as file:
-            try:
-                data = json.load(file)
-                if not isinstance(data, list):
-                    click.echo("Invalid table format.")
-                    sys.exit(1)
-
-                # Apply where
-                if where:
-                    criteria = json.loads(where)
-                    data = filter_data(data, criteria)
-
-                # Apply groupby
-                if groupby:
-                    data = group_by(data, groupby)
-                    # If grouped, ordering within groups isn't handled in this implementation
-                elif orderby:  # Apply orderby only if not grouped
-                    order_fields = [field.strip() for field in orderby.split(',')]
-                    data = order_by(data, order_fields)
-
-                click.echo(json.dumps(data, indent=4))
-            except json.JSONDecodeError:
-                click.echo("Invalid JSON format.")
-                sys.exit(1)
-    else:
-         for file_name in sorted(os.listdir(split_path)):
-            click.echo(f"####{file_name}####")
-            if file_name.endswith('.json'):
-                with open(os.path.join(split_path, file_name), 'r') as file:
-                    try:
-                        data = json.load(file)
-                        if not isinstance(data, list):
-                            click.echo("Invalid table format.")
-                            sys.exit(1)
+    try:
+        criteria = json.loads(where) if where else {}
+    except json.JSONDecodeError:
+        click.echo("Invalid JSON format.")
+        sys.exit(1)
 
-                        # Apply where
-                        if where:
-                            criteria = json.loads(where)
-                            data = filter_data(data, criteria)
+    try:
+        specs = aggregates.parse_specs(agg)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
+    if specs and not groupby:
+        click.echo("--agg needs --groupby.")
+        sys.exit(1)
+    if limit and groupby:
+        click.echo("--limit cannot be combined with --groupby.")
+        sys.exit(1)
+    try:
+        ordering.parse_order(orderby)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
 
-                        # Apply groupby
-                        if groupby:
-                            data = group_by(data, groupby)
-                            # If grouped, ordering within groups isn't handled in this implementation
-                        elif orderby:  # Apply orderby only if not grouped
-                            order_fields = [field.strip() for field in orderby.split(',')]
-                            data = order_by(data, order_fields)
+    parallel = workers != 1 and os.path.isdir(split_path)
+    # equality, =/>/< and the contains/match text operations are answered by the field indexes when there are some
+    indexed = isinstance(criteria, dict) and criteria
+    if explain:
+        indexes = field_index.plan(os.path.join(db_path, table), criteria, operations=True) if indexed else ()
+        click.echo(profiler.format_plan(table, select_plan(split_path, criteria, groupby, orderby,
+                                                           workers if parallel else None, specs, limit, indexes)))
+        return
+
+    stages = profiler.start_analyze(analyze)
+    # without --analyze or --groupby the records stream from the parts to the output
+    streaming = not analyze and not groupby
+    try:
+        with profiler.cprofile(profile):
+            locations = index_candidates(db, table, split_path, criteria, operations=True) if indexed else None
+            single = single_output(output_format, output)
+            # --workers, --agg, --orderby, --limit, --output-format and --output give one merged result for all
+            # parts of a split table (groups combined, one global sort), otherwise each part is printed on its own
+            if specs or (os.path.isdir(split_path) and (single or merges_parts(parallel, specs, groupby, orderby, limit))):
+                paths = table_files(split_path)
+                if parallel:
+                    worker_results = map_parts(select_part_worker, paths, workers,
+                                               criteria, groupby, orderby, analyze, specs, nulls, limit, locations)
+                    results = [data for data, _ in worker_results]
+                    if stages is not None:
+                        # worker stages in part order
+                        stages.extend(stage for _, part_stages in worker_results for stage in part_stages)
+                elif streaming:
+                    results = [stream_part(path, criteria, orderby, nulls, limit,
+                                           None if locations is None else locations[path]) for path in paths]
+                else:
+                    # aggregates, sorts and limits always give one result for the whole table
+                    results = [select_part(path, criteria, groupby, orderby, stages, specs, nulls, limit,
+                                           None if locations is None else locations[path]) for path in paths]
+                if stages is None:
+                    data = merge_selects(results, groupby, orderby, specs, nulls, limit)
+                else:
+                    with profiler.stage(stages, "merge parts", rows_in=sum(len(data) for data in results)) as stats:
+                        data = merge_selects(results, groupby, orderby, specs, nulls, limit)
+                        if not isinstance(data, dict):
+                            data = list(data)
+                        stats["rows_out"] = len(data)
+                if not analyze:
+                    emit_select(data, groupby, specs, output_format, output)
+            elif os.path.isfile(split_path):
+                offsets = None if locations is None else locations[split_path]
+                if streaming:
+                    data = stream_part(split_path, criteria, orderby, nulls, limit, offsets)
+                else:
+                    data = select_part(split_path, criteria, groupby, orderby, stages, nulls=nulls, limit=limit,
+                                       offsets=offsets)
+                if not analyze:
+                    emit_select(data, groupby, specs, output_format, output)
+            else:
+                for file_name in list_parts(split_path):
+                    if not analyze:
+                        click.echo(f"####{file_name}####")
+                    if file_name.endswith(('.json', '.jsonl')):
+                        path = os.path.join(split_path, file_name)
+                        offsets = None if locations is None else locations.get(path)
+                        if streaming:
+                            emit_records(stream_part(path, criteria, orderby, offsets=offsets))
+                        else:
+                            data = select_part(path, criteria, groupby, orderby, stages, offsets=offsets)
+                            if not analyze:
+                                click.echo(json.dumps(data, indent=4))
+    except json.JSONDecodeError:
+        click.echo("Invalid JSON format.")
+        sys.exit(1)
 
-                        click.echo(json.dumps(data, indent=4))
-                    except json.JSONDecodeError:
-                        click.echo("Invalid JSON format.")
-                        sys.exit(1)
+    if analyze:
+        click.echo(profiler.format_stages(stages))
+    if profile:
+        click.echo(f"cProfile dump written to {profile}")
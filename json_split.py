@@ -0,0 +1,345 @@
+'''
+streaming splitter for JSON tables: an incremental JSON array parser, a writer emitting
+size-balanced part_N files, and the split manifest (table/.split_manifest) recording the
+source file and, per part, its record count, id range and size. Memory stays bounded by
+one record plus one read block, whatever the size of the table.
+'''
+import os
+import json
+import hashlib
+
+BLOCK_SIZE = 1 << 20
+MANIFEST = '.split_manifest'
+# a part is re-split once its records take this many times the part size
+GROWTH = 2
+
+
+def iter_array(path, block_size=BLOCK_SIZE):
+    '''
+    records of a JSON array file, decoded one at a time from blocks of the file.
+    an empty file (a fresh cre-tb table) has no records
+    '''
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buffer, pos, eof = '', 0, False
+        state = 'start'
+        while True:
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    break
+                buffer, pos = f.read(block_size), 0
+                eof = not buffer
+
+            if pos >= len(buffer):
+                if state == 'start':
+                    return
+                raise json.JSONDecodeError("Unterminated array", buffer, pos)
+
+            char = buffer[pos]
+            if state == 'start':
+                if char != '[':
+                    raise json.JSONDecodeError("Expecting '['", buffer, pos)
+                pos += 1
+                state = 'first'
+                continue
+            if char == ']' and state in ('first', 'after'):
+                return
+            if state == 'after':
+                if char != ',':
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+                pos += 1
+                state = 'value'
+                continue
+
+            while True:
+                try:
+                    record, end = decoder.raw_decode(buffer, pos)
+                    # a value touching the end of the block may continue in the next one
+                    if end < len(buffer) or eof:
+                        break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                # read geometrically more so a huge record is not re-parsed once per block
+                chunk = f.read(max(block_size, len(buffer) - pos))
+                buffer, pos = buffer[pos:] + chunk, 0
+                eof = not chunk
+            yield record
+            pos = end
+            state = 'after'
+
+
+def iter_lines(path):
+    ''' records of a JSON Lines file '''
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_file(path):
+    return iter_lines(path) if path.endswith('.jsonl') else iter_array(path)
+
+
+class PartWriter:
+    '''
+    writes records to {prefix}{i}{extension} files in output_dir, starting the next file once the
+    current one holds max_bytes of serialized records; keeps a manifest entry per file
+    '''
+
+    def __init__(self, output_dir, extension, max_bytes, prefix='part_'):
+        self.output_dir = output_dir
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.entries = []
+        self.file = None
+
+    def write(self, record):
+        text = json.dumps(record)
+        if self.file is None:
+            name = f"{self.prefix}{len(self.entries)}{self.extension}"
+            self.file = open(os.path.join(self.output_dir, name), 'w')
+            self.entries.append(new_entry(name))
+            if self.extension == '.json':
+                self.file.write('[')
+        elif self.extension == '.json':
+            self.file.write(', ')
+        self.file.write(text + '\n' if self.extension == '.jsonl' else text)
+        entry = self.entries[-1]
+        count_record(entry, record, len(text))
+        if entry["bytes"] >= self.max_bytes:
+            self._close_file()
+
+    def close(self):
+        if self.file is not None:
+            self._close_file()
+        return self.entries
+
+    def _close_file(self):
+        if self.extension == '.json':
+            self.file.write(']')
+        self.file.close()
+        self.file = None
+        stamp_entry(self.entries[-1], self.output_dir)
+
+
+def new_entry(name):
+    return {"file": name, "records": 0, "min_id": None, "max_id": None, "bytes": 0, "stamp": None}
+
+
+def count_record(entry, record, size):
+    entry["records"] += 1
+    entry["bytes"] += size
+    record_id = record.get('id') if isinstance(record, dict) else None
+    if isinstance(record_id, (int, float)) and not isinstance(record_id, bool):
+        entry["min_id"] = record_id if entry["min_id"] is None else min(entry["min_id"], record_id)
+        entry["max_id"] = record_id if entry["max_id"] is None else max(entry["max_id"], record_id)
+
+
+def stamp_entry(entry, output_dir):
+    stat = os.stat(os.path.join(output_dir, entry["file"]))
+    entry["stamp"] = [stat.st_size, stat.st_mtime_ns]
+
+
+def scan_entry(output_dir, name):
+    ''' manifest entry of an existing part, computed by streaming through it '''
+    entry = new_entry(name)
+    for record in iter_file(os.path.join(output_dir, name)):
+        count_record(entry, record, len(json.dumps(record)))
+    stamp_entry(entry, output_dir)
+    return entry
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def file_hash(path):
+    ''' sha256 of the content of a file, read a block at a time '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def split_file(source, output_dir, max_bytes):
+    ''' stream source into size-balanced parts of the same format; returns their manifest entries '''
+    os.makedirs(output_dir, exist_ok=True)
+    extension = '.jsonl' if source.endswith('.jsonl') else '.json'
+    writer = PartWriter(output_dir, extension, max_bytes)
+    for record in iter_file(source):
+        writer.write(record)
+    return writer.close()
+
+
+def manifest_path(table_dir):
+    return os.path.join(table_dir, MANIFEST)
+
+
+def load_manifest(table_dir):
+    path = manifest_path(table_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(table_dir, manifest):
+    path = manifest_path(table_dir)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+def remove_manifest(table_dir):
+    if os.path.exists(manifest_path(table_dir)):
+        os.remove(manifest_path(table_dir))
+
+
+def part_names(output_dir):
+    names = [f for f in os.listdir(output_dir) if f.startswith('part_') and f.endswith(('.json', '.jsonl'))]
+    return sorted(names, key=lambda name: int(name.split('_')[-1].split('.')[0]))
+
+
+def split_table(source, table_dir, output_dir, max_bytes):
+    ''' split source from scratch and record it in the manifest '''
+    parts = split_file(source, output_dir, max_bytes)
+    save_manifest(table_dir, {"source": os.path.basename(source), "source_stamp": file_stamp(source),
+                              "source_hash": file_hash(source), "max_bytes": max_bytes, "parts": parts})
+    return parts
+
+
+def resplit_table(source, table_dir, output_dir, max_bytes):
+    ''' discard the parts (and every change made to them) and split source again '''
+    for name in os.listdir(output_dir):
+        os.remove(os.path.join(output_dir, name))
+    return split_table(source, table_dir, output_dir, max_bytes)
+
+
+def source_replaced(source, table_dir):
+    '''
+    True when the source file holds other data than the one the parts were split from. Inserts,
+    updates and deletes go to the parts only, so a changed (size, mtime) of the source alone (touch,
+    a copy, a checkout) is checked against the content hash of the manifest: when the content is the
+    same only the new stamp is recorded. A replaced source is never split again implicitly, the
+    parts stay the table until split-jval --resplit
+    '''
+    manifest = load_manifest(table_dir)
+    if manifest is None:
+        return False
+    stamp = file_stamp(source)
+    same_name = manifest["source"] == os.path.basename(source)
+    if same_name and manifest["source_stamp"] == stamp:
+        return False
+    if manifest.get("replaced_stamp") == stamp:
+        return True
+    digest = file_hash(source)
+    # a manifest from before hashes were recorded adopts the current content
+    if same_name and manifest.get("source_hash", digest) == digest:
+        manifest["source_stamp"], manifest["source_hash"] = stamp, digest
+        manifest.pop("replaced_stamp", None)
+        save_manifest(table_dir, manifest)
+        return False
+    manifest["replaced_stamp"] = stamp
+    save_manifest(table_dir, manifest)
+    return True
+
+
+def maintain(source, table_dir, output_dir, max_bytes):
+    '''
+    keep an existing split current:
+    - a split without manifest (made before manifests existed) gets one, by scanning its parts
+    - parts that grew past GROWTH times the part size are re-split in place, later parts renumbered
+    the parts are never rebuilt from the source here, see source_replaced and resplit_table.
+    returns True when the split directory changed
+    '''
+    manifest = load_manifest(table_dir)
+    if manifest is None:
+        manifest = {"source": os.path.basename(source), "source_stamp": file_stamp(source),
+                    "source_hash": file_hash(source), "max_bytes": max_bytes,
+                    "parts": [scan_entry(output_dir, name) for name in part_names(output_dir)]}
+        save_manifest(table_dir, manifest)
+
+    changed = False
+    position = 0
+    while position < len(manifest["parts"]):
+        entry = manifest["parts"][position]
+        path = os.path.join(output_dir, entry["file"])
+        # the file size bounds the serialized records from above, so only big parts are read
+        if os.path.getsize(path) < GROWTH * max_bytes or file_stamp(path) == entry["stamp"]:
+            position += 1
+            continue
+        pieces = resplit_part(manifest, position, output_dir, max_bytes)
+        changed = changed or pieces > 1
+        position += pieces
+
+    if changed or any(entry["stamp"] is None for entry in manifest["parts"]):
+        save_manifest(table_dir, manifest)
+    return changed
+
+
+def resplit_part(manifest, position, output_dir, max_bytes):
+    '''
+    split manifest part `position` into size-balanced pieces, renumbering the parts after it;
+    returns the number of pieces
+    '''
+    entry = manifest["parts"][position]
+    path = os.path.join(output_dir, entry["file"])
+    extension = '.jsonl' if path.endswith('.jsonl') else '.json'
+    writer = PartWriter(output_dir, extension, max_bytes, prefix=f"resplit_{position}_")
+    for record in iter_file(path):
+        writer.write(record)
+    pieces = writer.close()
+
+    if len(pieces) <= 1:
+        for piece in pieces:
+            os.remove(os.path.join(output_dir, piece["file"]))
+        manifest["parts"][position] = scan_entry(output_dir, entry["file"])
+        return 1
+
+    shift = len(pieces) - 1
+    later = manifest["parts"][position + 1:]
+    for later_entry in reversed(later):
+        number = int(later_entry["file"].split('_')[-1].split('.')[0])
+        renamed = f"part_{number + shift}{extension}"
+        os.replace(os.path.join(output_dir, later_entry["file"]), os.path.join(output_dir, renamed))
+        later_entry["file"] = renamed
+        stamp_entry(later_entry, output_dir)
+
+    os.remove(path)
+    number = int(entry["file"].split('_')[-1].split('.')[0])
+    for offset, piece in enumerate(pieces):
+        name = f"part_{number + offset}{extension}"
+        os.replace(os.path.join(output_dir, piece["file"]), os.path.join(output_dir, name))
+        piece["file"] = name
+        stamp_entry(piece, output_dir)
+
+    manifest["parts"][position:position + 1] = pieces
+    return len(pieces)
+
+
+def refresh_manifest(table_dir, output_dir):
+    '''
+    the manifest with the entries of parts changed since they were recorded recomputed
+    (record counts and id ranges stay exact after inserts, updates and deletes)
+    '''
+    manifest = load_manifest(table_dir)
+    if manifest is None:
+        return None
+    names = part_names(output_dir)
+    entries = {entry["file"]: entry for entry in manifest["parts"]}
+    parts = []
+    for name in names:
+        entry = entries.get(name)
+        if entry is None or entry["stamp"] != file_stamp(os.path.join(output_dir, name)):
+            entry = scan_entry(output_dir, name)
+        parts.append(entry)
+    if parts != manifest["parts"]:
+        manifest["parts"] = parts
+        save_manifest(table_dir, manifest)
+    return manifest
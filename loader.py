@@ -0,0 +1,224 @@
+'''
+bulk loading of a csv file into a chunked table (load-tb). The source is cut into byte ranges of about
+--chunk-size that start and end on row boundaries: the ranges are found by counting quotes, so a
+newline inside a quoted field never ends a range, and each range is handed to a worker process as soon
+as its end is found. A worker reads and parses its range, writes it as chunk_N.csv with its row-offset
+index (row_index), and returns its column statistics and the postings of the text-indexed columns;
+the parent then writes the table's stats and schema (chunk_stats) and its text indexes from those,
+so the chunks are never read back. Chunks are loaded into table/.loading and only replace the
+table's chunks once every range was loaded.
+'''
+import click
+import os
+import io
+import sys
+import csv
+import mmap
+import shutil
+import itertools
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import spill
+import row_index
+import text_index
+import chunk_stats
+
+STAGING_DIR = '.loading'
+
+
+def read_header(mm):
+    ''' (header columns, byte offset of the first row) of a csv file '''
+    end = row_end(mm, 0)
+    text = mm[:end].decode('utf-8-sig')
+    return next(csv.reader(io.StringIO(text, newline='')), []), end
+
+
+def row_end(mm, position, odd=False):
+    '''
+    the end of the row running at position: the first newline after it outside quotes, odd being
+    whether position itself is inside a quoted field
+    '''
+    size = len(mm)
+    while position < size:
+        newline = mm.find(b'\n', position)
+        end = size if newline == -1 else newline + 1
+        odd ^= mm[position:end].count(b'"') % 2 == 1
+        position = end
+        if not odd:
+            break
+    return position
+
+
+def byte_ranges(mm, start, chunk_size):
+    ''' (start, end) ranges of about chunk_size bytes from start to the end of the file, on row boundaries '''
+    size = len(mm)
+    while start < size:
+        target = start + chunk_size
+        if target >= size:
+            yield start, size
+            return
+        end = row_end(mm, target, mm[start:target].count(b'"') % 2 == 1)
+        yield start, end
+        start = end
+
+
+class ByteSink:
+    ''' file-like target of csv.writer appending the encoded rows to a bytearray '''
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, text):
+        self.data.extend(text.encode('utf-8'))
+
+
+def load_range(source, byte_range, chunk_path, header, index_columns):
+    '''
+    write the rows of byte_range of source as the chunk at chunk_path, with its row index;
+    returns (row count, [column stats], {column: {value: [positions]}})
+    '''
+    start, end = byte_range
+    with open(source, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8')
+
+    width = len(header)
+    rows = []
+    for row in csv.reader(io.StringIO(text, newline='')):
+        if not row:
+            continue
+        if len(row) > width:
+            raise ValueError(f"A row near byte {start} of {source} has {len(row)} fields, the header {width}.")
+        rows.append(row + [''] * (width - len(row)))
+
+    sink = ByteSink()
+    writer = csv.writer(sink)
+    offsets = array('Q')
+    writer.writerow(header)
+    offsets.append(len(sink.data))
+    for row in rows:
+        writer.writerow(row)
+        offsets.append(len(sink.data))
+    with open(chunk_path, 'wb') as f:
+        f.write(sink.data)
+    row_index.write(chunk_path, offsets)
+
+    columns = list(zip(*rows)) if rows else [() for _ in header]
+    postings = {}
+    for column in index_columns:
+        by_value = postings[column] = {}
+        for position, value in enumerate(columns[header.index(column)]):
+            by_value.setdefault(value, []).append(position)
+    return len(rows), [chunk_stats.column_stats(values) for values in columns], postings
+
+
+def publish(staging, table_path, count):
+    '''
+    move chunk_1..count and their row indexes from staging into the table, in place of its chunks;
+    returns the chunk paths. renaming keeps the size and mtime the row indexes are stamped with
+    '''
+    clear_table(table_path)
+    chunk_paths = []
+    for number in range(1, count + 1):
+        staged = os.path.join(staging, f'chunk_{number}.csv')
+        chunk_path = os.path.join(table_path, f'chunk_{number}.csv')
+        os.makedirs(os.path.dirname(row_index.index_path(chunk_path)), exist_ok=True)
+        os.replace(row_index.index_path(staged), row_index.index_path(chunk_path))
+        os.replace(staged, chunk_path)
+        chunk_paths.append(chunk_path)
+    shutil.rmtree(staging)
+    return chunk_paths
+
+
+def clear_table(table_path):
+    ''' remove the chunks of a table with their row indexes and stats; declared text indexes stay '''
+    for name in os.listdir(table_path):
+        if name.startswith('chunk_') and name.endswith('.csv'):
+            os.remove(os.path.join(table_path, name))
+            if os.path.exists(row_index.index_path(os.path.join(table_path, name))):
+                os.remove(row_index.index_path(os.path.join(table_path, name)))
+    chunk_stats.drop(table_path)
+
+
+@click.command()
+@click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
+@click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
+@click.option("--source", prompt="Enter the csv file to load", help="The csv file to load", required=True)
+@click.option("--chunk-size", default='1MB', help="Size of a chunk of the table, e.g. 1MB or 512k")
+@click.option("--index", "indexes", multiple=True, help="A column to build a text index on, repeat for each column")
+@click.option("--workers", default=0, type=click.IntRange(min=0), help="Parse and write chunks on this many processes (0 = one per core)")
+@click.option("--replace", is_flag=True, help="Replace the chunks of a table that already has some")
+def load_tb(db, table, source, chunk_size, indexes, workers, replace):
+    '''
+    Load a csv file into a table as chunk_N.csv files, parsed and written in parallel
+    python3 main.py load-tb --db=ev --table=ev_data --source=ev_data.csv --index="Electric Utility"
+    the row indexes, per-chunk stats, the schema and the text indexes (--index, and those the table
+    already declares) are built in the same pass
+    '''
+    db_path = os.path.join('database', db)
+    if not os.path.exists(db_path):
+        click.echo("Database does not exist.")
+        sys.exit(1)
+    if not os.path.isfile(source):
+        click.echo(f"Source file {source} does not exist.")
+        sys.exit(1)
+    try:
+        chunk_bytes = spill.parse_size(chunk_size)
+    except ValueError:
+        click.echo(f"Invalid chunk size '{chunk_size}'.")
+        sys.exit(1)
+    if chunk_bytes <= 0:
+        click.echo("The chunk size must be positive.")
+        sys.exit(1)
+
+    table_path = os.path.join(db_path, table)
+    os.makedirs(table_path, exist_ok=True)
+    if not replace and any(name.startswith('chunk_') and name.endswith('.csv') for name in os.listdir(table_path)):
+        click.echo("Table already has chunks, pass --replace to load it anew.")
+        sys.exit(1)
+    if os.path.getsize(source) == 0:
+        click.echo(f"Source file {source} is empty.")
+        sys.exit(1)
+    with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header, data_start = read_header(mm)
+        index_columns = list(dict.fromkeys(list(text_index.declared(table_path)) + list(indexes)))
+        missing = [column for column in index_columns if column not in header]
+        if missing:
+            click.echo(f"Column(s) {', '.join(missing)} not found in {source}.")
+            sys.exit(1)
+
+        # chunks are written to a staging directory and only moved into the table once all of them
+        # were loaded, so a failed load (--replace included) leaves the table as it was
+        staging = os.path.join(table_path, STAGING_DIR)
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        chunk_paths = (os.path.join(staging, f'chunk_{number}.csv') for number in itertools.count(1))
+        args = (itertools.repeat(source), byte_ranges(mm, data_start, chunk_bytes), chunk_paths,
+                itertools.repeat(header), itertools.repeat(index_columns))
+        try:
+            if workers == 1:
+                results = list(map(load_range, *args))
+            else:
+                # ranges are submitted while the following boundaries are still being found
+                with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+                    results = list(pool.map(load_range, *args))
+            if not results:
+                # a source with only a header still makes a table with its columns
+                results.append(load_range(source, (data_start, data_start), os.path.join(staging, 'chunk_1.csv'),
+                                          header, index_columns))
+        except (ValueError, UnicodeDecodeError) as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            click.echo(f"Could not load {source}: {e}")
+            sys.exit(1)
+
+    chunk_paths = publish(staging, table_path, len(results))
+    chunk_stats.write(table_path, header, [(path, rows, columns)
+                                           for path, (rows, columns, _) in zip(chunk_paths, results)])
+    for column in index_columns:
+        text_index.drop(table_path, column)
+        text_index.TextIndex(table_path, chunk_paths, column, row_index.scan, lambda row: row.get(column),
+                             postings=[postings[column] for _, _, postings in results]).save()
+
+    rows = sum(count for count, _, _ in results)
+    click.echo(f"Loaded {rows} rows into {len(chunk_paths)} chunks of table {table} in database {db}.")
@@ -1,15 +1,128 @@
+import time
+STARTED_AT = time.perf_counter()
+
 import click
 import os
 import sys
-import csv_file as cf
-import json_file as jf
+import importlib
 import shutil
-import csv
 
+# commands living in csv_file / json_file, imported only when invoked
+LAZY_COMMANDS = {
+    "ins-cval": "csv_file:ins_cval",
+    "del-rows": "csv_file:del_rows",
+    "update-rows": "csv_file:update_rows",
+    "project-col": "csv_file:project_col",
+    "filter-tb": "csv_file:filter_tb",
+    "order-tb": "csv_file:order_tb",
+    "groupby": "csv_file:groupby",
+    "join-tb": "csv_file:join_tb",
+    "query": "csv_file:query",
+    "get-rows": "csv_file:get_rows",
+    "create-index-tb": "csv_file:create_index_tb",
+    "load-tb": "loader:load_tb",
+
+    "ins-jval": "json_file:ins_jval",
+    "del-rows-jval": "json_file:del_rows_jval",
+    "project-col-jval": "json_file:project_col_jval",
+    "update-jval": "json_file:update_jval",
+    "filter-jval": "json_file:filter_jval",
+    "order-jval": "json_file:order_jval",
+    "group-by-jval": "json_file:group_by_jval",
+    "join-jval": "json_file:join_jval",
+    "select-jval": "json_file:select_jval",
+    "convert-jval": "json_file:convert_jval",
+    "split-jval": "json_file:split_jval",
+    "get-jval": "json_file:get_jval",
+    "create-index-jval": "json_file:create_index_jval",
+
+    "prepare": "prepared:prepare",
+    "execute": "prepared:execute",
+
+    "serve": "server:serve",
+}
+
+
+class LazyGroup(click.Group):
+    """
+    click group resolving LAZY_COMMANDS on first use, so a one-row ins-cval
+    never pays for importing json_file (and the other way around)
+    """
 
-@click.group()
-def cli():
-    pass
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+        self.import_time = 0.0
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.lazy_commands:
+            return super().get_command(ctx, cmd_name)
+
+        module_name, attr = self.lazy_commands[cmd_name].split(':')
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        self.import_time += time.perf_counter() - start
+        return getattr(module, attr)
+
+    def invoke(self, ctx):
+        socket_path = ctx.params.get("socket")
+        args = ctx.protected_args + ctx.args
+        if socket_path and args and args[0] != "serve":
+            import server
+            memory_limit = ctx.params.get("memory_limit")
+            snapshot_limit = ctx.params.get("snapshot_limit")
+            exit_code = server.forward(socket_path, (["--memory-limit", memory_limit] if memory_limit else [])
+                                       + (["--snapshot-limit", snapshot_limit] if snapshot_limit else []) + args)
+            if exit_code is not None:
+                ctx.exit(exit_code)
+        return super().invoke(ctx)
+
+
+def report_timing(group, executed_at):
+    finished_at = time.perf_counter()
+    startup = executed_at - STARTED_AT - group.import_time
+    click.echo(f"startup: {startup * 1000:.2f} ms, "
+               f"import: {group.import_time * 1000:.2f} ms, "
+               f"execution: {(finished_at - executed_at) * 1000:.2f} ms", err=True)
+
+
+def check_size(ctx, param, value):
+    """ A size option as spill.parse_size reads it (512MB, 1g, 64k, a number of MB), a usage error otherwise """
+    if value is None:
+        return value
+    import spill
+    try:
+        size = spill.parse_size(value)
+    except ValueError:
+        raise click.BadParameter(f"'{value}' is not a size such as 512MB, 1g or 64k.")
+    if size < 0:
+        raise click.BadParameter("The size must not be negative.")
+    return value
+
+
+@click.group(cls=LazyGroup, lazy_commands=LAZY_COMMANDS)
+@click.option("--timing", is_flag=True, help="Report import versus execution time on stderr")
+@click.option("--socket", envvar="SYNTHQUERY_SOCKET", default=None, help="Send the command to a daemon started with `serve`")
+@click.option("--memory-limit", envvar="SYNTHQUERY_MEMORY_LIMIT", default=None, callback=check_size,
+              help="Memory budget for group-by hash tables (e.g. 512MB, 1g), larger ones spill to temp files")
+@click.option("--snapshot-limit", envvar="SYNTHQUERY_SNAPSHOT_LIMIT", default=None, callback=check_size,
+              help="Disk budget for parsed JSON table snapshots in database/.snapshots (default 256MB, 0 = off)")
+@click.pass_context
+def cli(ctx, timing, socket, memory_limit, snapshot_limit):
+    # set whenever the module is loaded, so a daemon request without the option does not inherit the
+    # previous one's; a module that is not loaded yet starts from its default when a command imports it
+    if memory_limit is not None or 'spill' in sys.modules:
+        import spill
+        spill.set_memory_limit(memory_limit)
+    if snapshot_limit is not None or 'snapshot' in sys.modules:
+        import snapshot
+        snapshot.set_limit(snapshot_limit)
+    if timing:
+        executed_at = time.perf_counter()
+        ctx.call_on_close(lambda: report_timing(ctx.command, executed_at))
 
 
 @click.command()
@@ -45,17 +158,18 @@ def del_db(db):
 @click.command()
 @click.option("--db", prompt="Enter the name of the database", help="The name of the database", required=True)
 @click.option("--table", prompt="Enter the name of the table", help="The name of the table", required=True)
-@click.option("--format", prompt="Enter the format of the table (csv/json)", type=click.Choice(['csv', 'json'], case_sensitive=False), required=True)
+@click.option("--format", prompt="Enter the format of the table (csv/json/jsonl)", type=click.Choice(['csv', 'json', 'jsonl'], case_sensitive=False), required=True)
 def cre_tb(db, table, format):
     """
     Create a table in the specified database
+    jsonl stores one JSON record per line, so inserts append and scans stream
     """
     db_path = os.path.join('database', db)
     if not os.path.exists(db_path):
         click.echo("Database does not exist.")
         sys.exit(1)
 
-    if format == 'json':
+    if format in ('json', 'jsonl'):
         table_dir = os.path.join(db_path, table)
         table_path = os.path.join(table_dir, f"{table}.{format}")
         os.makedirs(table_dir)
@@ -74,55 +188,6 @@ cli.add_command(cre_db)
 cli.add_command(del_db)
 cli.add_command(cre_tb)
 
-cli.add_command(cf.ins_cval)
-cli.add_command(jf.ins_jval)
-cli.add_command(cf.del_rows)
-cli.add_command(cf.update_rows)
-cli.add_command(cf.project_col)
-cli.add_command(cf.filter_tb)
-cli.add_command(cf.order_tb)
-cli.add_command(cf.groupby)
-cli.add_command(cf.join_tb)
-cli.add_command(cf.query)
-
-cli.add_command(jf.del_rows_jval)
-cli.add_command(jf.project_col_jval)
-cli.add_command(jf.update_jval)
-cli.add_command(jf.filter_jval)
-cli.add_command(jf.order_jval)
-cli.add_command(jf.group_by_jval)
-cli.add_command(jf.join_jval)
-cli.add_command(jf.select_jval)
-
-
-def split_chunks(input_file, output_dir, chunk_size=5000):
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-
-    with open(input_file, 'r', newline='') as file:
-        reader = csv.DictReader(file)
-        headers = reader.fieldnames
-
-        chunk = []
-        for i, row in enumerate(reader, 1):
-            chunk.append(row)
-            if i % chunk_size == 0:
-                write_chunk(chunk, headers, output_dir, i // chunk_size)
-                chunk = []
-        if chunk:
-            write_chunk(chunk, headers, output_dir, (i // chunk_size) + 1)
-
-
-def write_chunk(chunk, headers, output_dir, chunk_number):
-    output_file = os.path.join(output_dir, f'chunk_{chunk_number}.csv')
-    with open(output_file, 'w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=headers)
-        writer.writeheader()
-        writer.writerows(chunk)
-
 
 if __name__ == '__main__':
-    # input_file = '/Users/shawnpan/Downloads/ev_data.csv'
-    # output_dir = 'database/ev/ev_data'
-    # split_chunks(input_file, output_dir, chunk_size=5000)
     cli()
@@ -0,0 +1,142 @@
+'''
+typed sort keys shared by the sorting commands: "salary_in_usd desc, work_year" orders numbers
+(and numeric strings) by value, then other strings, then anything else by its JSON text;
+every field sorts ascending or descending on its own and nulls go first or last regardless
+'''
+import json
+import math
+from functools import total_ordering
+
+NULLS = ("first", "last")
+
+
+def parse_order(text, descending=False):
+    '''
+    "a desc, b" -> [("a", True), ("b", False)]; a field may also be written a:desc, a field without
+    a direction sorts descending when descending is set. raises ValueError for a direction other than asc / desc
+    '''
+    order = []
+    for item in (part.strip() for part in text.split(',')):
+        if not item:
+            continue
+        field, direction = item, "desc" if descending else "asc"
+        words = item.rsplit(None, 1) if ':' not in item else item.rsplit(':', 1)
+        if len(words) == 2 and words[1].strip().lower() in ("asc", "desc"):
+            field, direction = words[0].strip(), words[1].strip().lower()
+        elif ':' in item:
+            raise ValueError(f"Unknown sort direction '{words[1]}'")
+        order.append((field, direction == "desc"))
+    return order
+
+
+def value_key(value):
+    ''' a comparable key for any record value (None is handled by the caller) '''
+    if isinstance(value, bool):
+        return (2, json.dumps(value))
+    if isinstance(value, (int, float)):
+        return (0, value) if not (isinstance(value, float) and math.isnan(value)) else (1, 'nan')
+    if isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return (1, value)
+        return (0, number) if not math.isnan(number) else (1, value)
+    return (2, json.dumps(value, sort_keys=True))
+
+
+@total_ordering
+class Descending:
+    ''' wraps a key so it sorts in reverse inside an otherwise ascending tuple '''
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def key_func(order, nulls="last", get=None):
+    '''
+    key(record) for parse_order order; get(record, field) reads a value (default record.get(field)).
+    a null (or missing) value sorts before or after every value of its field, as nulls says
+    '''
+    get = get or (lambda record, field: record.get(field))
+    null_rank, value_rank = (0, 1) if nulls == "first" else (1, 0)
+    null_key = (null_rank, (0, 0))
+
+    def key(record):
+        parts = []
+        for field, descending in order:
+            value = get(record, field)
+            if value is None:
+                parts.append(null_key)
+            elif descending:
+                parts.append((value_rank, Descending(value_key(value))))
+            else:
+                parts.append((value_rank, value_key(value)))
+        return tuple(parts)
+
+    return key
+
+
+def encode_func(order, nulls="last", types=None, get=None):
+    '''
+    key(record) for parse_order order in the same order as key_func, encoded as one flat tuple of plain
+    values (a rank and a value per field) so it can be computed once per record and compared, kept in
+    sorted runs and merged without calling back into Python: descending numbers are negated and
+    descending strings stored as their inverted UTF-8 bytes. types {field: "number" | "text"} (from
+    a schema or inferred) makes a "text" field compare every value as a string; other fields type
+    each value as value_key does
+    '''
+    get = get or (lambda record, field: record.get(field))
+    types = types or {}
+    encoders = [(field, field_encoder(descending, nulls, types.get(field))) for field, descending in order]
+
+    def key(record):
+        encoded = ()
+        for field, encode in encoders:
+            encoded += encode(get(record, field))
+        return encoded
+
+    return key
+
+
+def field_encoder(descending, nulls="last", kind=None):
+    ''' value -> (rank, value) of one field for encode_func '''
+    null = (0, 0) if nulls == "first" else (4, 0)
+    # numbers, then strings, then anything else (reversed when descending); nulls at either end
+    number_rank, text_rank, other_rank = (3, 2, 1) if descending else (1, 2, 3)
+
+    def text(value):
+        if descending:
+            return (text_rank, bytes(255 - byte for byte in value.encode('utf-8')) + b'\xff')
+        return (text_rank, value)
+
+    def number(value):
+        return (number_rank, -value if descending else value)
+
+    def encode(value):
+        if value is None:
+            return null
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            encoded = json.dumps(value, sort_keys=True)
+            if descending:
+                return (other_rank, bytes(255 - byte for byte in encoded.encode('utf-8')) + b'\xff')
+            return (other_rank, encoded)
+        if isinstance(value, str):
+            if kind == "text":
+                return text(value)
+            try:
+                parsed = float(value)
+            except ValueError:
+                return text(value)
+            return number(parsed) if not math.isnan(parsed) else text(value)
+        if isinstance(value, float) and math.isnan(value):
+            return text('nan')
+        return number(value)
+
+    return encode
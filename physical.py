@@ -0,0 +1,250 @@
+'''
+physical operators shared by the CSV and JSON engines. An operator is an iterable of batches
+(lists of up to BATCH_ROWS records, as dicts) pulled from its child, so a plan is a chain such as
+Limit(ExternalSort(Filter(Scan(source), predicate), key), 10) and records() streams the result.
+CSV chunk tables (CsvSource) and JSON part tables (JsonSource) are the scan sources, so joining a
+CSV table with a JSON table is just another HashJoin. Memory-bound work goes through spill
+(--memory-limit): HashAggregate and HashJoin partition to disk, ExternalSort writes sorted runs.
+the engines behind the operators are imported when an operator first runs, so a command that only
+builds a CSV filter does not load the JSON, snapshot or spill modules.
+'''
+import os
+import sys
+import csv
+import json
+import contextlib
+import heapq
+import itertools
+
+import ordering
+
+BATCH_ROWS = 4096
+
+
+def batched(records, size=BATCH_ROWS):
+    iterator = iter(records)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class CsvSource:
+    ''' the rows of CSV chunk files (chunk_N.csv in N order), as dicts of strings '''
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+
+    def records(self):
+        for path in self.paths:
+            with open(path, 'r', newline='') as f:
+                yield from csv.DictReader(f)
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in self.paths)
+
+
+class JsonSource:
+    '''
+    the records of JSON table files or parts in part order: JSON Lines streamed line by line,
+    JSON arrays from their snapshot (see snapshot) or streamed through json_split.iter_array
+    '''
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+
+    def records(self):
+        import compact
+        import json_split
+        import snapshot
+        for path in self.paths:
+            if path.endswith('.jsonl') or not snapshot.enabled():
+                yield from json_split.iter_file(path)
+            else:
+                yield from compact.cached(path)
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in self.paths)
+
+
+def table_source(db, table):
+    '''
+    the scan source of a table of either engine: a CsvSource over its chunks, or a JsonSource over its
+    file or parts (split first, as every *-jval command does, with the split messages kept off stdout
+    where the result goes); None when the table does not exist
+    '''
+    table_path = os.path.join('database', db, table)
+    if not os.path.isdir(table_path):
+        return None
+    if any(os.path.exists(os.path.join(table_path, f"{table}{extension}")) for extension in ('.json', '.jsonl')):
+        import json_file
+        with contextlib.redirect_stdout(sys.stderr):
+            split_path = json_file.split_json_file(db, table)
+        return JsonSource(json_file.table_files(split_path))
+    import csv_file
+    chunks = csv_file.get_ordered_chunk_files(table_path)
+    if not chunks:
+        return None
+    return CsvSource(os.path.join(table_path, chunk) for chunk in chunks)
+
+
+class Operator:
+    def __iter__(self):
+        return self.batches()
+
+    def batches(self):
+        raise NotImplementedError
+
+    def records(self):
+        for batch in self:
+            yield from batch
+
+
+class Scan(Operator):
+    ''' batches of a source (CsvSource, JsonSource) or of any iterable of records '''
+
+    def __init__(self, source):
+        self.source = source
+
+    def batches(self):
+        records = self.source.records() if hasattr(self.source, 'records') else self.source
+        return batched(records)
+
+
+class Filter(Operator):
+    def __init__(self, child, predicate):
+        self.child = child
+        self.predicate = predicate
+
+    def batches(self):
+        predicate = self.predicate
+        for batch in self.child:
+            batch = [record for record in batch if predicate(record)]
+            if batch:
+                yield batch
+
+
+class Project(Operator):
+    ''' records cut down to the columns they have of columns, keeping their own field order '''
+
+    def __init__(self, child, columns):
+        self.child = child
+        self.columns = set(columns)
+
+    def batches(self):
+        columns = self.columns
+        for batch in self.child:
+            yield [{key: value for key, value in record.items() if key in columns} for record in batch]
+
+
+class HashAggregate(Operator):
+    '''
+    one group per distinct value of fields (a tuple of values for several fields), folding the
+    aggregates.parse_specs specs of its records into one accumulator each; records out are
+    {field: value, ..., label: result, ...} in first-seen group order
+    '''
+
+    def __init__(self, child, fields, specs):
+        self.child = child
+        self.fields = list(fields)
+        self.specs = specs
+
+    def key(self, record):
+        if len(self.fields) == 1:
+            return record.get(self.fields[0])
+        return tuple(record.get(field) for field in self.fields)
+
+    def groups(self):
+        ''' (key, {label: result}) per group '''
+        import aggregates
+        import spill
+        specs = self.specs
+        pairs = ((self.key(record), record) for record in self.child.records())
+        for key, accs in spill.hash_aggregate(pairs, lambda: aggregates.new_accs(specs),
+                                              lambda accs, record: aggregates.add_record(accs, record, specs)):
+            yield key, aggregates.results(accs, specs)
+
+    def batches(self):
+        single = len(self.fields) == 1
+        records = ({**dict(zip(self.fields, (key,) if single else key)), **results}
+                   for key, results in self.groups())
+        return batched(records)
+
+
+class ExternalSort(Operator):
+    ''' records in key order: the first limit through a heap when limit is set, else spill.external_sort '''
+
+    def __init__(self, child, key, limit=0):
+        self.child = child
+        self.key = key
+        self.limit = limit
+
+    def batches(self):
+        if self.limit:
+            return batched(heapq.nsmallest(self.limit, self.child.records(), key=self.key))
+        import spill
+        return batched(spill.external_sort(self.child.records(), self.key))
+
+
+class HashJoin(Operator):
+    '''
+    equi-join of left and right on left_key / right_key (a None key never matches), records out
+    are {**left_record, **right_record}; how='left' keeps left records without a match.
+    build is the side held in the hash table ('left' or 'right'), the other one is streamed past it
+    '''
+
+    def __init__(self, left, right, left_key, right_key, how='inner', build='right'):
+        self.left = left
+        self.right = right
+        self.left_key = left_key
+        self.right_key = right_key
+        self.how = how
+        self.build = build
+
+    def batches(self):
+        import spill
+        outer = self.how == 'left'
+        if self.build == 'right':
+            joined = spill.hash_join(self.right.records(), self.left.records(), self.right_key, self.left_key,
+                                     lambda right, left: {**left, **(right or {})},
+                                     outer='probe' if outer else None)
+        else:
+            joined = spill.hash_join(self.left.records(), self.right.records(), self.left_key, self.right_key,
+                                     lambda left, right: {**left, **(right or {})},
+                                     outer='build' if outer else None)
+        return batched(joined)
+
+
+class Limit(Operator):
+    def __init__(self, child, count):
+        self.child = child
+        self.count = count
+
+    def batches(self):
+        remaining = self.count
+        for batch in self.child:
+            if remaining <= 0:
+                return
+            yield batch[:remaining]
+            remaining -= len(batch)
+
+
+def join_key(record, fields, typed=False):
+    '''
+    hashable join key of a record, None (never matches) when a join field is missing or null;
+    lists and objects compare by their JSON text. typed keys compare numbers and numeric strings by
+    value (see ordering.value_key), so "2019" from a CSV table meets 2019 from a JSON table
+    '''
+    key = []
+    for field in fields:
+        value = record.get(field)
+        if value is None:
+            return None
+        key.append(ordering.value_key(value) if typed else
+                   json_text(value) if isinstance(value, (list, dict)) else value)
+    return tuple(key)
+
+
+def json_text(value):
+    return json.dumps(value, sort_keys=True)
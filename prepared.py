@@ -0,0 +1,277 @@
+'''
+named prepared queries: a command line with $name placeholders is registered once and run again and
+again with bound values, e.g.
+    python main.py prepare --name=top select-jval --db=test-db --table=salaries --where='{"job_title": "$title"}' --groupby='' --orderby='salary_in_usd desc' --limit='$n'
+    python main.py execute --name=top --param title="Data Scientist" --param n=5
+"$name" (quoted, as in JSON) is replaced by the value as a JSON string, a bare $name by the value as a
+JSON scalar (so {"value": $n} gets a number), and a bare value other than a number, true, false or null
+is refused. An option the command would prompt for gets its default when the query leaves it out, and
+a query without one that has no default (--db, --table, ...) is refused.
+Statements are kept in database/.prepared.json, where the web app (POST /prepare, /execute/<name>)
+finds them too.
+A process keeps the compiled statements it ran in a plan cache: the tokenized command line with its
+placeholder positions, the resolved command and, per distinct binding, the parsed command parameters,
+so a statement executed again in the serve daemon goes straight to the command. What the engines derive
+from the bound options is cached on their side (json_file.compile_criteria, field_index.plan).
+'''
+import click
+import os
+import sys
+import re
+import json
+import math
+import shlex
+from collections import OrderedDict
+
+import table_cache
+
+STORE = os.path.join('database', '.prepared.json')
+PLACEHOLDER = re.compile(r'"\$([A-Za-z_]\w*)"|\$([A-Za-z_]\w*)')
+NOT_PREPARABLE = ("prepare", "execute", "serve")
+MAX_PLANS = 64
+MAX_BINDINGS = 32
+
+# name -> Statement, least recently executed first
+_plans = OrderedDict()
+
+
+def compile_text(text):
+    '''
+    text split at its placeholders: a list of literal strings and (name, quoted) pairs,
+    or the text itself when it has none
+    '''
+    segments, position = [], 0
+    for found in PLACEHOLDER.finditer(text):
+        segments.append(text[position:found.start()])
+        segments.append((found.group(1), True) if found.group(1) else (found.group(2), False))
+        position = found.end()
+    if not segments:
+        return text
+    segments.append(text[position:])
+    return segments
+
+
+def bare_value(name, text):
+    ''' the JSON text of a value bound to a bare $name: a number, true, false or null, ValueError for anything else '''
+    try:
+        value = json.loads(text)
+    except ValueError:
+        value = text
+    if isinstance(value, (str, list, dict)) or isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f"${name} is a bare placeholder and takes a number, true, false or null, not {text!r}.")
+    return json.dumps(value)
+
+
+def bind_text(segments, values):
+    if isinstance(segments, str):
+        return segments
+    return ''.join(segment if isinstance(segment, str) else
+                   json.dumps(values[segment[0]]) if segment[1] else bare_value(segment[0], values[segment[0]])
+                   for segment in segments)
+
+
+def command_tokens(query):
+    ''' the tokens of a command line, without a leading python main.py '''
+    tokens = shlex.split(query)
+    while tokens and (tokens[0] in ('python', 'python3') or tokens[0].endswith('main.py')):
+        tokens.pop(0)
+    return tokens
+
+
+def prompt_defaults(command, tokens):
+    '''
+    --option=default for every option of command that would prompt because tokens do not set it, so an
+    execution never waits for input; ValueError for such an option without a default
+    '''
+    filled = []
+    for param in command.params:
+        if not isinstance(param, click.Option) or not param.prompt:
+            continue
+        if any(token == opt or token.startswith(opt + '=') for opt in param.opts for token in tokens):
+            continue
+        option = max(param.opts, key=len)
+        default = param.get_default(click.Context(command))
+        if default is None:
+            raise ValueError(f"The query does not set {option}, which {command.name} would prompt for.")
+        filled.append(f"{option}={default}")
+    return filled
+
+
+class Statement:
+    '''
+    a compiled prepared query: the command to run and its arguments split at the placeholders, with
+    the defaults of the prompting options the query leaves out
+    '''
+
+    def __init__(self, group, name, query):
+        self.name = name
+        self.query = query
+        try:
+            tokens = command_tokens(query)
+        except ValueError as e:
+            raise ValueError(f"Invalid query: {e}")
+        if not tokens:
+            raise ValueError("Empty query.")
+        self.command_name = tokens[0]
+        self.command = None if self.command_name in NOT_PREPARABLE else group.get_command(None, self.command_name)
+        if self.command is None:
+            raise ValueError(f"'{self.command_name}' cannot be prepared.")
+        self.args = [compile_text(token) for token in tokens[1:]] + prompt_defaults(self.command, tokens[1:])
+        self.params = sorted({segment[0] for segments in self.args if not isinstance(segments, str)
+                              for segment in segments if not isinstance(segment, str)})
+        # binding -> parsed command parameters
+        self.bindings = OrderedDict()
+
+    def check(self, values):
+        ''' ValueError for a missing or unknown parameter, or a bare one whose value is not a JSON scalar '''
+        missing = [name for name in self.params if name not in values]
+        if missing:
+            raise ValueError(f"Missing value for {', '.join('$' + name for name in missing)}.")
+        unknown = [name for name in values if name not in self.params]
+        if unknown:
+            raise ValueError(f"Unknown parameter {', '.join('$' + name for name in unknown)}.")
+        for segments in self.args:
+            bind_text(segments, values)
+
+    def bind(self, values):
+        ''' the command arguments with values put in '''
+        self.check(values)
+        return [bind_text(segments, values) for segments in self.args]
+
+    def execute(self, values, parent=None):
+        key = tuple(sorted(values.items()))
+        params = self.bindings.get(key)
+        if params is None:
+            with self.command.make_context(self.command_name, self.bind(values), parent=parent) as ctx:
+                params = dict(ctx.params)
+            self.bindings[key] = params
+            if len(self.bindings) > MAX_BINDINGS:
+                self.bindings.popitem(last=False)
+        else:
+            self.bindings.move_to_end(key)
+        ctx = click.Context(self.command, info_name=self.command_name, parent=parent)
+        ctx.params = dict(params)
+        with ctx:
+            return self.command.invoke(ctx)
+
+
+def read_store(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def statements():
+    ''' {name: query} of the registered statements '''
+    if not os.path.exists(STORE):
+        return {}
+    return table_cache.get(STORE, read_store)
+
+
+def write_statements(registered):
+    os.makedirs(os.path.dirname(STORE), exist_ok=True)
+    temp_path = STORE + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(registered, f, indent=4)
+    os.replace(temp_path, STORE)
+
+
+def lookup(group, name):
+    '''
+    the compiled statement of name from the plan cache, compiled again when it was registered anew;
+    None when there is no such statement
+    '''
+    query = statements().get(name)
+    if query is None:
+        return None
+    statement = _plans.get(name)
+    if statement is None or statement.query != query:
+        statement = Statement(group, name, query)
+        _plans[name] = statement
+        if len(_plans) > MAX_PLANS:
+            _plans.popitem(last=False)
+    _plans.move_to_end(name)
+    return statement
+
+
+def parse_params(params):
+    ''' {name: value} of name=value strings '''
+    values = {}
+    for param in params:
+        name, sep, value = param.partition('=')
+        if not sep or not name:
+            raise ValueError(f"Parameter '{param}' is not name=value.")
+        values[name.lstrip('$')] = value
+    return values
+
+
+@click.command(context_settings={"ignore_unknown_options": True, "allow_interspersed_args": False})
+@click.option("--name", default='', help="The name of the statement")
+@click.option("--drop", is_flag=True, help="Remove the statement instead of registering it")
+@click.option("--list", "list_all", is_flag=True, help="Print the registered statements")
+@click.argument("query", nargs=-1, type=click.UNPROCESSED)
+@click.pass_context
+def prepare(ctx, name, drop, list_all, query):
+    '''
+    Register a named query with $name placeholders to run with execute; the query follows the options.
+    e.g. python main.py prepare --name=by_title filter-jval --db=test-db --table=salaries --criteria='{"job_title": "$title"}'
+    "$title" becomes the value as a JSON string, a bare $n the value as a number, true, false or null (quote it from the shell: '$n');
+    --drop removes a statement, --list shows them all
+    '''
+    registered = dict(statements())
+    if list_all:
+        for statement_name, statement_query in sorted(registered.items()):
+            click.echo(f"{statement_name}: {statement_query}")
+        return
+    if not name:
+        click.echo("No statement name given.")
+        sys.exit(1)
+
+    if drop:
+        if registered.pop(name, None) is None:
+            click.echo(f"No statement named '{name}'.")
+            sys.exit(1)
+        write_statements(registered)
+        _plans.pop(name, None)
+        click.echo(f"Dropped statement '{name}'.")
+        return
+
+    # one argument is a whole command line, several are its tokens as the shell split them
+    query = shlex.join(query) if len(query) > 1 else ''.join(query)
+    try:
+        statement = Statement(ctx.find_root().command, name, query)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
+    registered[name] = query
+    write_statements(registered)
+    _plans[name] = statement
+    params = ', '.join('$' + param for param in statement.params) or 'no parameters'
+    click.echo(f"Prepared statement '{name}' ({statement.command_name}, {params}).")
+
+
+@click.command()
+@click.option("--name", prompt="Enter the name of the statement", help="The name of the statement", required=True)
+@click.option("--param", "-p", "params", multiple=True, help="A parameter value as name=value, repeat for each parameter")
+@click.pass_context
+def execute(ctx, name, params):
+    '''
+    Run a statement registered with prepare, with values for its placeholders.
+    e.g. python main.py execute --name=by_title --param title="Data Scientist"
+    run through the serve daemon (--socket) the compiled statement is reused between executions
+    '''
+    try:
+        values = parse_params(params)
+        statement = lookup(ctx.find_root().command, name)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
+    if statement is None:
+        click.echo(f"No statement named '{name}'.")
+        sys.exit(1)
+
+    try:
+        statement.check(values)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
+    statement.execute(values, parent=ctx)
@@ -0,0 +1,102 @@
+import cProfile
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+STAGE_COLUMNS = [
+    ("stage", "stage"),
+    ("rows_in", "rows in"),
+    ("rows_out", "rows out"),
+    ("bytes_read", "bytes read"),
+    ("chunks_scanned", "chunks"),
+    ("chunks_pruned", "pruned"),
+    ("time_ms", "time ms"),
+    ("peak_kb", "peak KB"),
+]
+
+
+def start_analyze(analyze):
+    '''
+    returns the list the stages are recorded into, or None when --analyze is off
+    '''
+    if not analyze:
+        return None
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return []
+
+
+@contextmanager
+def stage(stages, name, rows_in=0):
+    '''
+    record one operator of the query: the caller fills in rows_out, bytes_read, chunks...
+    when stages is None (no --analyze) a throwaway dict is handed out so callers never branch
+    '''
+    stats = {"stage": name, "rows_in": rows_in, "rows_out": 0, "bytes_read": 0,
+             "chunks_scanned": 0, "chunks_pruned": 0, "time_ms": 0.0, "peak_kb": 0.0}
+    if stages is None:
+        yield stats
+        return
+
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats["time_ms"] = (time.perf_counter() - start) * 1000
+        stats["peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+        stages.append(stats)
+
+
+def scan_file(stats, path):
+    '''
+    account one chunk / part file as scanned by the stage
+    '''
+    stats["chunks_scanned"] += 1
+    stats["bytes_read"] += os.path.getsize(path)
+
+
+def format_plan(title, steps):
+    lines = [f"QUERY PLAN ({title})"]
+    for depth, step in enumerate(steps):
+        lines.append("  " * depth + "-> " + step)
+    return "\n".join(lines)
+
+
+def format_stages(stages):
+    rows = [[_format_value(s[key]) for key, _ in STAGE_COLUMNS] for s in stages]
+    header = [label for _, label in STAGE_COLUMNS]
+    widths = [max(len(str(r[i])) for r in rows + [header])
+              for i in range(len(header))]
+
+    lines = ["  ".join(h.ljust(w) for h, w in zip(header, widths))]
+    lines.append("  ".join("-" * w for w in widths))
+    for row in rows:
+        lines.append("  ".join(str(v).ljust(w) for v, w in zip(row, widths)))
+    return "\n".join(lines)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return value
+
+
+@contextmanager
+def cprofile(path):
+    '''
+    write a cProfile dump of the wrapped block to path (no-op when path is empty)
+    inspect it with: python -m pstats <path>
+    '''
+    if not path:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
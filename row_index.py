@@ -0,0 +1,176 @@
+'''
+persisted row-offset index per csv chunk, so rows can be fetched by position through mmap
+instead of re-reading the chunk from the start.
+table/.rowidx/chunk_N.csv.idx holds the chunk's (size, mtime_ns) followed by the byte offset
+of every data row plus the end offset; a stale index is rebuilt on first use
+'''
+import os
+import io
+import csv
+import mmap
+import struct
+from array import array
+
+import table_cache
+
+INDEX_DIR = '.rowidx'
+HEADER = struct.Struct('<QQ')
+
+
+def index_path(chunk_path):
+    directory, name = os.path.split(chunk_path)
+    return os.path.join(directory, INDEX_DIR, name + '.idx')
+
+
+def scan_offsets(chunk_path):
+    '''
+    byte offsets of the data rows of a chunk (header skipped) plus the end offset;
+    a newline inside a quoted field does not end a row
+    '''
+    offsets = array('Q')
+    size = os.path.getsize(chunk_path)
+    if size == 0:
+        return offsets
+
+    with open(chunk_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position, quoted = 0, False
+        while position < size:
+            end = mm.find(b'\n', position)
+            end = size if end == -1 else end + 1
+            quoted ^= mm[position:end].count(b'"') % 2 == 1
+            position = end
+            if not quoted:
+                offsets.append(position)
+    # the first recorded offset is the end of the header, the last one the end of the data
+    return offsets
+
+
+def build(chunk_path):
+    '''
+    (re)write the index of a chunk, called after a chunk is loaded or rewritten
+    '''
+    offsets = scan_offsets(chunk_path)
+    _write(chunk_path, offsets)
+    return offsets
+
+
+def write(chunk_path, offsets):
+    '''
+    save offsets taken while the chunk was written (header end, every row end), instead of scanning it
+    '''
+    _write(chunk_path, offsets)
+
+
+def append(chunk_path, row_start):
+    '''
+    record one row appended at byte row_start, without rescanning the chunk when its index was current
+    '''
+    path = index_path(chunk_path)
+    stat = os.stat(chunk_path)
+    current = False
+    if row_start > 0 and os.path.exists(path):
+        with open(path, 'rb') as f:
+            size, _ = HEADER.unpack(f.read(HEADER.size))
+        current = size == row_start
+    if not current:
+        build(chunk_path)
+        return
+
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        f.write(array('Q', [stat.st_size]).tobytes())
+        f.seek(0)
+        f.write(HEADER.pack(stat.st_size, stat.st_mtime_ns))
+
+
+def load(chunk_path):
+    '''
+    offsets of a chunk, rebuilding the index when the chunk changed since it was written
+    '''
+    path = index_path(chunk_path)
+    stat = os.stat(chunk_path)
+    if os.path.exists(path):
+        offsets, size, mtime_ns = table_cache.get(path, _read)
+        if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            return offsets
+    return build(chunk_path)
+
+
+def row_count(chunk_path):
+    return max(len(load(chunk_path)) - 1, 0)
+
+
+def read_rows(chunk_path, start, stop=None):
+    '''
+    rows start..stop (exclusive) of a chunk as dicts, read straight from their byte range
+    '''
+    offsets = load(chunk_path)
+    count = max(len(offsets) - 1, 0)
+    stop = count if stop is None else min(stop, count)
+    if start >= stop:
+        return []
+
+    with open(chunk_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        fieldnames = next(csv.reader(io.StringIO(mm[:offsets[0]].decode('utf-8'))))
+        text = mm[offsets[start]:offsets[stop]].decode('utf-8')
+    return list(csv.DictReader(io.StringIO(text, newline=''), fieldnames=fieldnames))
+
+
+def read_positions(chunk_path, positions):
+    '''
+    the rows at the given positions of a chunk (ascending), each decoded from its own byte range
+    '''
+    offsets = load(chunk_path)
+    count = max(len(offsets) - 1, 0)
+    positions = [position for position in positions if 0 <= position < count]
+    if not positions:
+        return []
+
+    with open(chunk_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        fieldnames = next(csv.reader(io.StringIO(mm[:offsets[0]].decode('utf-8'))))
+        text = ''.join(mm[offsets[position]:offsets[position + 1]].decode('utf-8') for position in positions)
+    return list(csv.DictReader(io.StringIO(text, newline=''), fieldnames=fieldnames))
+
+
+def scan(chunk_path):
+    '''
+    (position, row) for every data row of a chunk, positions as used by the index
+    '''
+    with open(chunk_path, 'r', newline='') as f:
+        yield from enumerate(csv.DictReader(f))
+
+
+def iter_table_rows(chunk_paths, start, stop):
+    '''
+    rows start..stop of the concatenation of chunk_paths, skipping whole chunks by their row counts
+    yields (chunk_path, position in chunk, row)
+    '''
+    for chunk_path in chunk_paths:
+        if start >= stop:
+            break
+        count = row_count(chunk_path)
+        if start >= count:
+            start, stop = start - count, stop - count
+            continue
+        for position, row in enumerate(read_rows(chunk_path, start, stop), start):
+            yield chunk_path, position, row
+        start, stop = 0, stop - count
+
+
+def _write(chunk_path, offsets):
+    path = index_path(chunk_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    stat = os.stat(chunk_path)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(stat.st_size, stat.st_mtime_ns))
+        f.write(offsets.tobytes())
+    os.replace(temp_path, path)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        size, mtime_ns = HEADER.unpack(f.read(HEADER.size))
+        offsets = array('Q')
+        offsets.frombytes(f.read())
+    return offsets, size, mtime_ns
@@ -0,0 +1,209 @@
+import click
+import os
+import sys
+import io
+import json
+import signal
+import socket
+import socketserver
+from contextlib import redirect_stdout, redirect_stderr
+
+import table_cache
+
+DEFAULT_SOCKET = os.path.join('database', '.synthquery.sock')
+
+
+# characters of output collected before they are sent to the client as one message
+CHUNK_CHARS = 64 * 1024
+
+
+class MessageStream(io.TextIOBase):
+    '''
+    a text stream sent to the client as {name: text} messages, one JSON document per line, once
+    chunk_chars characters are collected (at every write with 0) and on flush
+    '''
+
+    def __init__(self, sock, name, chunk_chars=CHUNK_CHARS):
+        self.sock = sock
+        self.name = name
+        self.chunk_chars = chunk_chars
+        self.parts = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not isinstance(text, str):
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.chunk_chars:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.parts:
+            text, self.parts, self.size = ''.join(self.parts), [], 0
+            send_message(self.sock, {self.name: text})
+
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def with_prompt_defaults(group, args):
+    '''
+    args with the options the command would prompt for set to their defaults, since the daemon cannot
+    ask for them; ValueError when one of them has no default
+    '''
+    import prepared
+    with group.make_context('main.py', list(args), resilient_parsing=True) as ctx:
+        rest = ctx.protected_args + ctx.args
+        command = group.get_command(ctx, rest[0]) if rest else None
+    if command is None or '--help' in rest:
+        return args
+    return list(args) + prepared.prompt_defaults(command, rest[1:])
+
+
+def run_command(group, args, cwd, stdout, stderr):
+    '''
+    run one CLI invocation inside the daemon with its output going to stdout and stderr; returns the exit code
+    '''
+    if args[:1] == ['serve']:
+        stderr.write("Cannot start a daemon from inside the daemon.\n")
+        return 1
+
+    previous_cwd = os.getcwd()
+    previous_stdin = sys.stdin
+    # a prompt the command makes after all must fail rather than block the daemon
+    sys.stdin = io.StringIO('')
+    exit_code = 0
+    try:
+        os.chdir(cwd)
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                group.main(args=args, prog_name='main.py', standalone_mode=False)
+            except click.exceptions.Exit as e:
+                exit_code = e.exit_code
+            except click.ClickException as e:
+                e.show()
+                exit_code = e.exit_code
+            except click.Abort:
+                click.echo("Aborted!", err=True)
+                exit_code = 1
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except ConnectionError:
+                raise  # the client went away, nothing left to report to
+            except Exception as e:
+                click.echo(f"Error: {e!r}", err=True)
+                exit_code = 1
+    finally:
+        sys.stdin = previous_stdin
+        os.chdir(previous_cwd)
+    return exit_code
+
+
+def read_message(sock):
+    buffer = b''
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        buffer += data
+    return json.loads(buffer.decode('utf-8'))
+
+
+class CommandHandler(socketserver.BaseRequestHandler):
+    '''
+    one request per connection: {"cwd": ..., "args": [...]} in; out, one JSON message per line,
+    {"stdout": text} and {"stderr": text} chunks as the command writes them, then {"exit_code": n},
+    or only {"local": reason} for a command that has to prompt and so runs in the client
+    '''
+
+    def handle(self):
+        try:
+            request = read_message(self.request)
+        except (ValueError, UnicodeDecodeError):
+            return
+        try:
+            try:
+                args = with_prompt_defaults(self.server.group, request["args"])
+            except ValueError as e:
+                send_message(self.request, {"local": str(e)})
+                return
+            except click.ClickException:
+                args = request["args"]  # reported when the command runs
+            stdout = MessageStream(self.request, "stdout")
+            stderr = MessageStream(self.request, "stderr", chunk_chars=0)
+            exit_code = run_command(self.server.group, args, request["cwd"], stdout, stderr)
+            stdout.flush()
+            send_message(self.request, {"exit_code": exit_code})
+        except ConnectionError:
+            pass  # the client went away
+
+
+def forward(socket_path, args):
+    '''
+    thin client: send the command line to a running daemon and replay its output as it arrives
+    returns the exit code, or None when the command has to run locally (no daemon listening on
+    socket_path, or an option to prompt for)
+    '''
+    if not os.path.exists(socket_path):
+        click.echo(f"No daemon listening on {socket_path}, running locally.", err=True)
+        return None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            click.echo(f"No daemon listening on {socket_path}, running locally.", err=True)
+            return None
+        sock.sendall(json.dumps({"cwd": os.getcwd(), "args": args}).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as replies:
+            for line in replies:
+                message = json.loads(line)
+                if "local" in message:
+                    click.echo(f"{message['local']} Running locally.", err=True)
+                    return None
+                if "exit_code" in message:
+                    return message["exit_code"]
+                for name, stream in (("stdout", sys.stdout), ("stderr", sys.stderr)):
+                    if name in message:
+                        stream.write(message[name])
+                        stream.flush()
+    click.echo("The daemon closed the connection.", err=True)
+    return 1
+
+
+@click.command()
+@click.option("--socket", "socket_path", default=DEFAULT_SOCKET, help="Unix socket to listen on")
+@click.option("--cache-mb", default=256, type=float, help="Memory budget for parsed tables, part listings and indexes")
+@click.pass_context
+def serve(ctx, socket_path, cache_mb):
+    '''
+    Run a persistent query engine on a Unix socket, keeping parsed tables hot between commands.
+    python main.py serve --socket=/tmp/synthquery.sock
+    then: SYNTHQUERY_SOCKET=/tmp/synthquery.sock python main.py select-jval --db=test-db --table=t ...
+    '''
+    if os.path.exists(socket_path):
+        click.echo(f"{socket_path} already exists, is another daemon running?")
+        sys.exit(1)
+
+    # requests run in this process, they must never be forwarded back to it
+    os.environ.pop("SYNTHQUERY_SOCKET", None)
+    table_cache.enable(cache_mb)
+
+    server = socketserver.UnixStreamServer(socket_path, CommandHandler)
+    server.group = ctx.find_root().command
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    click.echo(f"Serving on {socket_path} (cache {cache_mb} MB), Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
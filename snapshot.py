@@ -0,0 +1,105 @@
+'''
+on-disk snapshots of parsed JSON array table files (t.json, part_N.json), so a later command
+reloads the records with marshal instead of parsing the JSON text again. A snapshot holds the
+compact.Records layout (shared key tuple, value tuples) together with the path and the
+(size, mtime_ns) stamp of the file it was made from, and is only used while the file still has
+that stamp. Snapshots live in database/.snapshots; the directory is capped (--snapshot-limit,
+0 turns snapshots off) and the least recently used snapshots are removed first.
+'''
+import os
+import marshal
+import hashlib
+
+import spill
+
+SNAPSHOT_DIR = os.path.join('database', '.snapshots')
+VERSION = 1
+DEFAULT_LIMIT = 256 * 1024 ** 2
+
+_settings = {"limit": DEFAULT_LIMIT}
+
+
+def set_limit(limit):
+    ''' cap of the snapshot directory, "512MB" / "1g" like --memory-limit; None for the default '''
+    _settings["limit"] = spill.parse_size(limit) if limit is not None else DEFAULT_LIMIT
+
+
+def enabled():
+    return _settings["limit"] > 0
+
+
+def snapshot_path(path):
+    name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(SNAPSHOT_DIR, name + '.snap')
+
+
+def stamp(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def load(path):
+    ''' (keys, rows) of the snapshot of path, None when there is none or the file changed since '''
+    if not enabled():
+        return None
+    snap = snapshot_path(path)
+    try:
+        # marshal.load on a file object reads it piecemeal, loads on the whole file is much faster
+        with open(snap, 'rb') as f:
+            version, source, source_stamp, keys, rows = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != VERSION or source != os.path.abspath(path) or source_stamp != stamp(path):
+        return None
+    # the modification time of a snapshot is its last use, for eviction
+    os.utime(snap)
+    return keys, rows
+
+
+def save(path, source_stamp, keys, rows):
+    '''
+    snapshot the records of path as parsed from the file with source_stamp (taken before reading it,
+    so a file changed while it was parsed gets no usable snapshot)
+    '''
+    if not enabled():
+        return
+    data = marshal.dumps((VERSION, os.path.abspath(path), source_stamp, keys, rows))
+    if len(data) > _settings["limit"]:
+        return
+    snap = snapshot_path(path)
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        temp_path = f"{snap}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, snap)
+    except OSError:
+        return  # snapshots are an optimization, a read-only or full disk just goes without
+    evict(keep=snap)
+
+
+def evict(keep=None):
+    ''' remove least recently used snapshots until the directory fits the limit '''
+    try:
+        names = [name for name in os.listdir(SNAPSHOT_DIR) if name.endswith('.snap')]
+    except OSError:
+        return
+    entries = []
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(SNAPSHOT_DIR, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(SNAPSHOT_DIR, name)))
+    used = sum(size for _, size, _ in entries)
+    for _, size, snap in sorted(entries):
+        if used <= _settings["limit"]:
+            break
+        if snap == keep:
+            continue
+        try:
+            os.remove(snap)
+        except OSError:
+            pass
+        used -= size
+
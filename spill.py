@@ -0,0 +1,267 @@
+'''
+memory budget shared by the engines (--memory-limit) and hash partitioning to temp files
+for operators whose hash table would not fit in it
+'''
+import os
+import sys
+import heapq
+import pickle
+import tempfile
+
+PARTITIONS = 16
+MAX_DEPTH = 4
+# run size of external_sort when no --memory-limit is set
+SORT_RUN_BYTES = 64 * 1024 ** 2
+# runs merged at once; more runs are first merged in groups of this many
+MERGE_FANIN = 64
+# rough per-entry overhead of a dict slot plus a small accumulator list
+ENTRY_BYTES = 200
+
+_settings = {"memory_limit": None}
+
+UNITS = {"k": 1024, "kb": 1024, "m": 1024 ** 2, "mb": 1024 ** 2, "g": 1024 ** 3, "gb": 1024 ** 3}
+
+
+def parse_size(text):
+    '''
+    "512MB", "1g", "64k" -> bytes; a plain number is taken as MB
+    '''
+    text = str(text).strip().lower()
+    for unit in sorted(UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * UNITS[unit])
+    return int(float(text) * UNITS["mb"])
+
+
+def set_memory_limit(limit):
+    _settings["memory_limit"] = parse_size(limit) if limit else None
+
+
+def memory_limit():
+    return _settings["memory_limit"]
+
+
+def approx_size(value):
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class Partitions:
+    '''
+    PARTITIONS temp files receiving (key, value) pairs routed by the hash of key;
+    partitions of the same depth route equal keys to the same index, whatever their name
+    '''
+
+    def __init__(self, directory, depth, name=''):
+        self.depth = depth
+        self.paths = [os.path.join(directory, f"{name}d{depth}_p{i}.spill") for i in range(PARTITIONS)]
+        self.files = [open(path, 'wb') for path in self.paths]
+
+    def write(self, key, value):
+        index = hash((self.depth, key)) % PARTITIONS
+        pickle.dump((key, value), self.files[index], pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def read(self, index):
+        with open(self.paths[index], 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+        os.remove(self.paths[index])
+
+
+def hash_aggregate(pairs, init, update, limit=None, directory=None, depth=0):
+    '''
+    group (key, value) pairs into init() states folded with update(state, value); yields (key, state).
+    once the table holds `limit` bytes its groups keep aggregating in memory while pairs of new
+    keys are hash-partitioned to disk, each partition is then aggregated on its own (recursively)
+    '''
+    limit = limit if limit is not None else memory_limit()
+    table = {}
+    used = 0
+    partitions = None
+
+    with tempfile.TemporaryDirectory(prefix='synthquery_spill_', dir=directory) as tmpdir:
+        for key, value in pairs:
+            state = table.get(key)
+            if state is None:
+                if partitions is not None:
+                    partitions.write(key, value)
+                    continue
+                state = table[key] = init()
+                used += sys.getsizeof(key) + ENTRY_BYTES
+                if limit and used > limit and depth < MAX_DEPTH:
+                    partitions = Partitions(tmpdir, depth)
+            table[key] = update(state, value)
+
+        yield from table.items()
+        table.clear()
+
+        if partitions is not None:
+            partitions.close()
+            for index in range(PARTITIONS):
+                yield from hash_aggregate(partitions.read(index), init, update,
+                                          limit, tmpdir, depth + 1)
+
+
+def hash_group(items, key_func, limit=None, directory=None, depth=0):
+    '''
+    bucket whole items by key_func(item); yields (key, [items]) in first-seen order while everything fits.
+    past `limit` bytes, the buffered and remaining items are hash-partitioned to disk and every
+    partition is grouped on its own, so memory is bounded by the largest partition
+    '''
+    limit = limit if limit is not None else memory_limit()
+    groups = {}
+    used = 0
+    partitions = None
+
+    with tempfile.TemporaryDirectory(prefix='synthquery_spill_', dir=directory) as tmpdir:
+        for item in items:
+            key = key_func(item)
+            if partitions is not None:
+                partitions.write(key, item)
+                continue
+            groups.setdefault(key, []).append(item)
+            used += approx_size(item)
+            if limit and used > limit and depth < MAX_DEPTH:
+                partitions = Partitions(tmpdir, depth)
+                for buffered_key, buffered in groups.items():
+                    for buffered_item in buffered:
+                        partitions.write(buffered_key, buffered_item)
+                groups = {}
+
+        if partitions is None:
+            yield from groups.items()
+            return
+
+        partitions.close()
+        for index in range(PARTITIONS):
+            yield from hash_group((item for _, item in partitions.read(index)), key_func,
+                                  limit, tmpdir, depth + 1)
+
+
+def hash_join(build, probe, build_key, probe_key, combine, outer=None, limit=None, directory=None, depth=0):
+    '''
+    equi-join: build items are hashed by build_key(item), probe items are streamed and looked up by
+    probe_key(item); yields combine(build_item, probe_item) for every match, in probe order.
+    outer='probe' also yields combine(None, item) for probe items without a match, outer='build'
+    yields combine(item, None) for unmatched build items once the probe side is done.
+    a key of None never matches. past `limit` bytes of build items both sides are hash-partitioned
+    to disk and every partition pair is joined on its own (grace hash join), so output order may change
+    '''
+    limit = limit if limit is not None else memory_limit()
+    table = {}
+    used = 0
+    partitions = None
+
+    with tempfile.TemporaryDirectory(prefix='synthquery_spill_', dir=directory) as tmpdir:
+        for item in build:
+            key = build_key(item)
+            if partitions is not None:
+                partitions.write(key, item)
+                continue
+            table.setdefault(key, []).append(item)
+            used += approx_size(item)
+            if limit and used > limit and depth < MAX_DEPTH:
+                partitions = Partitions(tmpdir, depth, 'build_')
+                for buffered_key, buffered in table.items():
+                    for buffered_item in buffered:
+                        partitions.write(buffered_key, buffered_item)
+                table = {}
+
+        if partitions is not None:
+            partitions.close()
+            probe_partitions = Partitions(tmpdir, depth, 'probe_')
+            for item in probe:
+                probe_partitions.write(probe_key(item), item)
+            probe_partitions.close()
+            for index in range(PARTITIONS):
+                yield from hash_join((item for _, item in partitions.read(index)),
+                                     (item for _, item in probe_partitions.read(index)),
+                                     build_key, probe_key, combine, outer, limit, tmpdir, depth + 1)
+            return
+
+        matched = set()
+        for item in probe:
+            key = probe_key(item)
+            matches = table.get(key) if key is not None else None
+            if not matches:
+                if outer == 'probe':
+                    yield combine(None, item)
+                continue
+            for build_item in matches:
+                if outer == 'build':
+                    matched.add(id(build_item))
+                yield combine(build_item, item)
+
+        if outer == 'build':
+            for key, items in table.items():
+                for build_item in items:
+                    if id(build_item) not in matched:
+                        yield combine(build_item, None)
+
+
+def write_run(directory, name, items):
+    path = os.path.join(directory, f"run_{name}.spill")
+    with open(path, 'wb') as f:
+        for item in items:
+            pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+
+
+def external_sort(items, key, limit=None, directory=None):
+    '''
+    items in key order (stable). items are buffered until they take `limit` bytes (--memory-limit,
+    SORT_RUN_BYTES without one), each full buffer is sorted and written to a temp file as a run,
+    and the runs are k-way merged with heapq.merge, MERGE_FANIN at a time; a table that fits
+    is sorted in memory
+    '''
+    limit = limit or memory_limit() or SORT_RUN_BYTES
+    buffer = []
+    used = 0
+    with tempfile.TemporaryDirectory(prefix='synthquery_sort_', dir=directory) as tmpdir:
+        runs = []
+        for item in items:
+            buffer.append(item)
+            used += approx_size(item)
+            if used > limit:
+                buffer.sort(key=key)
+                runs.append(write_run(tmpdir, len(runs), buffer))
+                buffer, used = [], 0
+
+        buffer.sort(key=key)
+        if not runs:
+            yield from buffer
+            return
+        if buffer:
+            runs.append(write_run(tmpdir, len(runs), buffer))
+            buffer = []
+
+        merge_pass = 0
+        while len(runs) > MERGE_FANIN:
+            merge_pass += 1
+            merged = []
+            # neighbouring runs are merged together, which keeps the sort stable
+            for start in range(0, len(runs), MERGE_FANIN):
+                group = runs[start:start + MERGE_FANIN]
+                merged.append(write_run(tmpdir, f"{merge_pass}_{len(merged)}",
+                                        heapq.merge(*(read_run(path) for path in group), key=key)))
+                for path in group:
+                    os.remove(path)
+            runs = merged
+        yield from heapq.merge(*(read_run(path) for path in runs), key=key)
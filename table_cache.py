@@ -0,0 +1,88 @@
+import os
+import sys
+from collections import OrderedDict
+
+# absolute path -> ((mtime_ns, size), value, weight); disabled (max_bytes == 0) unless the daemon turns it on
+_entries = OrderedDict()
+_settings = {"max_bytes": 0, "used_bytes": 0}
+
+
+def enable(max_mb):
+    _settings["max_bytes"] = int(max_mb * 1024 * 1024)
+
+
+def enabled():
+    return _settings["max_bytes"] > 0
+
+
+def get(path, loader):
+    '''
+    return loader(path), reusing the previous result while the file's mtime and size are unchanged.
+    entries are keyed by absolute path (the daemon changes directory per client), weighted by the
+    estimated memory of the loaded value and evicted least recently used first
+    '''
+    if not enabled():
+        return loader(path)
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    entry = _entries.get(path)
+    if entry is not None and entry[0] == key:
+        _entries.move_to_end(path)
+        return entry[1]
+
+    value = loader(path)
+    invalidate(path)
+    weight = max(memory_size(value), 1)
+    if weight <= _settings["max_bytes"]:
+        _entries[path] = (key, value, weight)
+        _settings["used_bytes"] += weight
+        while _settings["used_bytes"] > _settings["max_bytes"]:
+            _, (_, _, evicted) = _entries.popitem(last=False)
+            _settings["used_bytes"] -= evicted
+    return value
+
+
+def memory_size(value):
+    '''
+    estimated bytes held by value: sys.getsizeof of every object reachable through containers,
+    dicts, and __slots__ / __dict__ attributes, counting an object shared by several of them once
+    '''
+    seen = set()
+    total = 0
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif not isinstance(item, (str, bytes, int, float, bool, type(None))):
+            for name in getattr(type(item), '__slots__', ()):
+                if hasattr(item, name):
+                    stack.append(getattr(item, name))
+            if hasattr(item, '__dict__'):
+                stack.append(item.__dict__)
+    return total
+
+
+def invalidate(path):
+    entry = _entries.pop(os.path.abspath(path), None)
+    if entry is not None:
+        _settings["used_bytes"] -= entry[2]
+
+
+def clear():
+    _entries.clear()
+    _settings["used_bytes"] = 0
+
+
+def stats():
+    return {"entries": len(_entries), "used_bytes": _settings["used_bytes"],
+            "max_bytes": _settings["max_bytes"]}
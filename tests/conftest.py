@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+import table_cache
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    ''' an empty working directory with a database/ folder, the way the commands expect to run '''
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'database').mkdir()
+    yield tmp_path
+    table_cache.enable(0)
+    table_cache.clear()
+
+
+@pytest.fixture
+def run():
+    ''' run(*args) invokes main.py with args and returns the click result, failing on an error exit '''
+    runner = CliRunner()
+
+    def invoke(*args, ok=True):
+        result = runner.invoke(main.cli, list(args), catch_exceptions=False)
+        if ok:
+            assert result.exit_code == 0, result.output
+        return result
+    return invoke
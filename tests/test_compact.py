@@ -0,0 +1,51 @@
+import json
+
+import compact
+
+RECORDS = [
+    {"id": 1, "name": "Ada", "tags": ["math"], "city": "London"},
+    {"id": 2, "name": "Alan", "tags": [], "city": "London"},
+    {"id": 3, "city": "New York", "name": "Grace"},
+    "not a record",
+    {"id": 4, "name": "Edsger", "tags": ["go to"], "city": "Austin"},
+]
+
+
+def test_records_read_like_the_list():
+    records = compact.Records(RECORDS)
+    assert len(records) == len(RECORDS)
+    assert list(records) == RECORDS
+    assert [records[n] for n in range(len(RECORDS))] == RECORDS
+    assert records[1:3] == RECORDS[1:3] and records[-1] == RECORDS[-1]
+    assert records.keys == ("id", "name", "tags", "city")
+    # records with other keys (or no keys) are kept as they are
+    assert type(records.rows[0]) is tuple and records.rows[2] is RECORDS[2] and records.rows[3] == "not a record"
+    assert compact.is_table(records) and compact.is_table([]) and not compact.is_table({})
+
+
+def test_repeated_strings_are_stored_once():
+    cities = [json.loads(json.dumps({"city": "London"}))["city"] for _ in range(2)]
+    assert cities[0] is not cities[1]
+    records = compact.Records({"city": city} for city in cities)
+    assert records.rows[0][0] is records.rows[1][0]
+
+
+def test_to_list_copies_nested_values():
+    records = compact.Records(RECORDS)
+    copied = records.to_list()
+    assert copied == RECORDS
+    copied[0]["tags"].append("logic")
+    copied[2]["name"] = "G. Hopper"
+    copied[1]["city"] = "Manchester"
+    assert list(records) == RECORDS
+
+
+def test_load(workdir):
+    table = workdir / 't.json'
+    table.write_text(json.dumps(RECORDS, indent=4))
+    records = compact.load(str(table))
+    assert isinstance(records, compact.Records) and list(records) == RECORDS
+
+    other = workdir / 'o.json'
+    other.write_text(json.dumps({"not": "a table"}))
+    assert compact.load(str(other)) == {"not": "a table"}
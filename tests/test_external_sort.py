@@ -0,0 +1,37 @@
+import random
+
+import physical
+import spill
+
+
+def shuffled(count, seed=7):
+    items = [(number % 97, number) for number in range(count)]
+    random.Random(seed).shuffle(items)
+    return items
+
+
+def test_sort_in_memory():
+    items = shuffled(500)
+    assert list(spill.external_sort(iter(items), key=lambda item: item[0])) == \
+        sorted(items, key=lambda item: item[0])
+
+
+def test_spilled_runs_merge_stably():
+    items = shuffled(5000)
+    # a few hundred bytes per run makes dozens of runs
+    result = list(spill.external_sort(iter(items), key=lambda item: item[0], limit=2000))
+    assert result == sorted(items, key=lambda item: item[0])
+
+
+def test_multi_pass_merge(monkeypatch):
+    monkeypatch.setattr(spill, 'MERGE_FANIN', 3)
+    items = shuffled(3000)
+    result = list(spill.external_sort(iter(items), key=lambda item: item[0], limit=1000))
+    assert result == sorted(items, key=lambda item: item[0])
+
+
+def test_external_sort_operator_limit():
+    records = [{"n": n} for _, n in shuffled(1000)]
+    key = lambda record: record["n"]
+    assert list(physical.ExternalSort(physical.Scan(records), key, 5).records()) == [{"n": n} for n in range(5)]
+    assert list(physical.ExternalSort(physical.Scan(records), key).records()) == sorted(records, key=key)
@@ -0,0 +1,90 @@
+import json
+import os
+
+import pytest
+
+import field_index
+import table_cache
+
+PEOPLE = [
+    {"id": 1, "name": "Ada Lovelace", "city": "London", "age": 36},
+    {"id": 2, "name": "Alan Turing", "city": "London", "age": 41},
+    {"id": 3, "name": "Grace Hopper", "city": "New York", "age": 85},
+    {"id": 4, "name": "Edsger Dijkstra", "city": "Austin"},
+    {"id": 5, "name": "Barbara Liskov", "city": "Boston", "age": 84},
+]
+INDEXES = [("city", "hash"), ("age", "sorted"), ("name", "text")]
+
+
+@pytest.fixture
+def people(workdir, run):
+    table_dir = workdir / 'database' / 'db' / 'people'
+    table_dir.mkdir(parents=True)
+    (table_dir / 'people.json').write_text(json.dumps(PEOPLE, indent=4))
+    for field, kind in INDEXES:
+        run('create-index-jval', '--db=db', '--table=people', f'--field={field}', f'--kind={kind}')
+    return str(table_dir)
+
+
+def contents(index, kind):
+    ''' the entries of an index with its location lists in a canonical order '''
+    data = index.data
+    if kind == "hash":
+        return {key: sorted(locations) for key, locations in data["entries"].items() if locations}
+    if kind == "sorted":
+        return sorted(zip(data["keys"], data["locations"])), sorted(data["nulls"])
+    return {value: sorted(data["locations"][value_id]) for value, value_id in data["ids"].items()
+            if data["locations"][value_id]}
+
+
+def assert_patched(table_dir):
+    ''' every index is fresh as saved (patched, not rebuilt) and holds what a rebuild would '''
+    paths = [os.path.join(table_dir, 'people.json')]
+    for field, kind in INDEXES:
+        index = field_index.open_index(table_dir, paths, field, kind)
+        assert index.fresh() and not index.dirty, (field, kind)
+        rebuilt = field_index.open_index(table_dir, paths, field, kind)
+        rebuilt.rebuild()
+        assert contents(index, kind) == contents(rebuilt, kind), (field, kind)
+
+
+def test_insert_patches_indexes(people, run):
+    run('ins-jval', '--db=db', '--table=people', '--values=[{"name": "Donald Knuth", "city": "Stanford", "age": 86}]')
+    assert_patched(people)
+
+
+def test_update_patches_indexes(people, run):
+    run('update-jval', '--db=db', '--table=people', '--record-id=2', '--new-values={"city": "Manchester", "age": 42}')
+    assert_patched(people)
+    run('update-jval', '--db=db', '--table=people', '--record-id=4', '--new-values={"age": 72, "name": "E. W. Dijkstra"}')
+    assert_patched(people)
+
+
+def test_delete_patches_indexes(people, run):
+    run('del-rows-jval', '--db=db', '--table=people', '--conditions={"city": "London"}')
+    assert_patched(people)
+
+
+def test_lookup_after_changes(people, run):
+    run('ins-jval', '--db=db', '--table=people', '--values=[{"name": "Ken Thompson", "city": "Boston", "age": 81}]')
+    run('del-rows-jval', '--db=db', '--table=people', '--conditions={"id": 5}')
+    result = run('filter-jval', '--db=db', '--table=people', '--criteria={"city": "Boston"}')
+    assert [record["name"] for record in json.loads(result.output[result.output.index("["):])] == ["Ken Thompson"]
+
+
+def test_failed_change_leaves_cached_index(people):
+    table_cache.enable(64)
+    paths = [os.path.join(people, 'people.json')]
+    cached = field_index.open_index(people, paths, "city", "hash").data
+    before = json.dumps(cached, sort_keys=True, default=list)
+    index_file = field_index.index_path(people, "city", "hash")
+    saved = os.path.getmtime(index_file)
+
+    with pytest.raises(RuntimeError):
+        with field_index.Indexes(people, paths) as indexes:
+            indexes.add({"id": 9, "city": "Paris"}, paths[0], 5)
+            raise RuntimeError("the write failed")
+
+    assert json.dumps(cached, sort_keys=True, default=list) == before
+    assert field_index.open_index(people, paths, "city", "hash").data is cached
+    assert os.path.getmtime(index_file) == saved
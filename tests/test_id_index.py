@@ -0,0 +1,75 @@
+import json
+import os
+
+import pytest
+
+import id_index
+
+BIG_ID = 300000000
+RECORDS = [
+    {"id": 1, "name": "Ada"},
+    {"id": BIG_ID, "name": "Alan"},
+    {"id": "x7", "name": "Grace"},
+    {"id": -4, "name": "Edsger"},
+]
+
+
+@pytest.fixture(params=['json', 'jsonl'])
+def table(request, workdir, run):
+    table_dir = workdir / 'database' / 'db' / 't'
+    table_dir.mkdir(parents=True)
+    if request.param == 'json':
+        (table_dir / 't.json').write_text(json.dumps(RECORDS, indent=4))
+    else:
+        (table_dir / 't.jsonl').write_text(''.join(json.dumps(record) + '\n' for record in RECORDS))
+    return table_dir
+
+
+def get(run, record_id):
+    output = run('get-jval', '--db=db', '--table=t', f'--id={record_id}').output
+    return json.loads(output[output.index('{'):])
+
+
+def test_large_and_negative_ids(table, run):
+    assert get(run, BIG_ID)["name"] == "Alan"
+    assert get(run, -4)["name"] == "Edsger"
+    result = run('update-jval', '--db=db', '--table=t', f'--record-id={BIG_ID}', '--new-values={"name": "Alan T."}')
+    assert "Record updated successfully." in result.output
+    assert get(run, BIG_ID)["name"] == "Alan T."
+    # the slot file stays sized by the number of records, not by the largest id
+    assert os.path.getsize(table / id_index.INDEX_DIR / 'slots') == id_index.MIN_SLOTS * id_index.SLOT.size
+
+
+def test_missing_id(table, run):
+    result = run('get-jval', '--db=db', '--table=t', '--id=2', ok=False)
+    assert result.exit_code == 1 and "No record with id 2." in result.output
+    result = run('update-jval', '--db=db', '--table=t', '--record-id=2', '--new-values={"name": "x"}')
+    assert "No matching record found to update." in result.output
+
+
+def test_insert_continues_the_sequence(table, run):
+    run('ins-jval', '--db=db', '--table=t', '--values=[{"name": "Barbara"}]')
+    assert get(run, BIG_ID + 1)["name"] == "Barbara"
+
+
+def test_growth_and_scan_fallback(tmp_path):
+    path = str(tmp_path / 't.jsonl')
+    ids = [i * 1024 for i in range(3000)] + [2 ** 62, -2 ** 63]
+    with open(path, 'w') as f:
+        for record_id in ids + ["text"]:
+            f.write(json.dumps({"id": record_id}) + '\n')
+
+    with id_index.IdIndex(str(tmp_path), [path]) as index:
+        assert index.meta["count"] == len(ids)
+        assert index.meta["slots"] >= 2 * len(ids)
+        for record_id in ids:
+            assert id_index.read_at(*index.lookup(record_id))["id"] == record_id
+        assert index.lookup(1) is None and index.locate(1) is None
+        # ids without a slot are found by a scan
+        assert index.lookup("text") is None
+        assert id_index.read_at(*index.locate("text"))["id"] == "text"
+
+    # reopened fresh, not rebuilt
+    with id_index.IdIndex(str(tmp_path), [path]) as index:
+        assert index.fresh()
+        assert id_index.read_at(*index.lookup(2 ** 62))["id"] == 2 ** 62
@@ -0,0 +1,111 @@
+import json
+import os
+
+import json_file
+import json_split
+
+MAX_BYTES = 400
+
+
+def make_records(count, start=1, tag="a"):
+    return [{"id": number, "tag": tag, "text": f"record {number}"} for number in range(start, start + count)]
+
+
+def read_parts(output_dir):
+    records = []
+    for name in json_split.part_names(output_dir):
+        records.extend(json_split.iter_file(os.path.join(output_dir, name)))
+    return records
+
+
+def split(workdir, records):
+    table_dir = workdir / 'table'
+    table_dir.mkdir()
+    source = table_dir / 'table.json'
+    source.write_text(json.dumps(records))
+    output_dir = table_dir / 'split_json'
+    json_split.split_table(str(source), str(table_dir), str(output_dir), MAX_BYTES)
+    return str(source), str(table_dir), str(output_dir)
+
+
+def test_split_keeps_records_in_order(workdir):
+    records = make_records(60)
+    source, table_dir, output_dir = split(workdir, records)
+    manifest = json_split.load_manifest(table_dir)
+    assert len(manifest["parts"]) > 1
+    assert read_parts(output_dir) == records
+    assert sum(entry["records"] for entry in manifest["parts"]) == len(records)
+    assert manifest["parts"][0]["min_id"] == 1 and manifest["parts"][-1]["max_id"] == 60
+
+
+def test_grown_part_is_resplit(workdir):
+    records = make_records(60)
+    source, table_dir, output_dir = split(workdir, records)
+    first = os.path.join(output_dir, json_split.part_names(output_dir)[0])
+    with open(first) as f:
+        part = json.load(f)
+    extra = make_records(30, start=1000, tag="grown")
+    with open(first, 'w') as f:
+        json.dump(part + extra, f)
+
+    assert json_split.maintain(source, table_dir, output_dir, MAX_BYTES)
+    expected = part + extra + records[len(part):]
+    assert read_parts(output_dir) == expected
+    manifest = json_split.load_manifest(table_dir)
+    assert [entry["file"] for entry in manifest["parts"]] == json_split.part_names(output_dir)
+    assert all(os.path.getsize(os.path.join(output_dir, entry["file"])) < json_split.GROWTH * MAX_BYTES
+               for entry in manifest["parts"])
+    assert not json_split.maintain(source, table_dir, output_dir, MAX_BYTES)
+
+
+def test_touched_source_keeps_parts(workdir):
+    source, table_dir, output_dir = split(workdir, make_records(60))
+    changed = make_records(2, start=500, tag="inserted")
+    first = os.path.join(output_dir, json_split.part_names(output_dir)[-1])
+    with open(first) as f:
+        part = json.load(f)
+    with open(first, 'w') as f:
+        json.dump(part + changed, f)
+
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not json_split.source_replaced(source, table_dir)
+    assert json_split.load_manifest(table_dir)["source_stamp"] == json_split.file_stamp(source)
+    json_split.maintain(source, table_dir, output_dir, MAX_BYTES)
+    assert read_parts(output_dir)[-2:] == changed
+
+
+def test_replaced_source_needs_resplit(workdir):
+    source, table_dir, output_dir = split(workdir, make_records(60))
+    parts = read_parts(output_dir)
+    replacement = make_records(10, tag="new")
+    with open(source, 'w') as f:
+        json.dump(replacement, f)
+
+    assert json_split.source_replaced(source, table_dir)
+    assert json_split.source_replaced(source, table_dir)
+    json_split.maintain(source, table_dir, output_dir, MAX_BYTES)
+    assert read_parts(output_dir) == parts
+
+    json_split.resplit_table(source, table_dir, output_dir, MAX_BYTES)
+    assert read_parts(output_dir) == replacement
+    assert not json_split.source_replaced(source, table_dir)
+
+
+def test_split_json_file_warns_on_replaced_source(workdir, capsys):
+    table_dir = workdir / 'database' / 'db' / 'table'
+    table_dir.mkdir(parents=True)
+    source = table_dir / 'table.json'
+    source.write_text(json.dumps(make_records(60)))
+    split_path = json_file.split_json_file('db', 'table', max_size_mb=0.0005)
+    parts = read_parts(split_path)
+    assert len(json_split.part_names(split_path)) > 1
+
+    source.write_text(json.dumps(make_records(80, tag="new")))
+    capsys.readouterr()
+    json_file.split_json_file('db', 'table', max_size_mb=0.0005)
+    assert "--resplit" in capsys.readouterr().err
+    assert read_parts(split_path) == parts
+
+    json_file.split_json_file('db', 'table', max_size_mb=0.0005, resplit=True)
+    assert read_parts(split_path) == make_records(80, tag="new")
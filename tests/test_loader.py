@@ -0,0 +1,134 @@
+import csv
+import io
+import mmap
+import os
+
+import pytest
+
+import chunk_stats
+import csv_file
+import loader
+import row_index
+
+HEADER = ['id', 'city', 'note']
+
+
+def make_rows(count):
+    ''' rows whose notes hold quoted newlines, commas and quotes, so rows span several lines '''
+    rows = []
+    for number in range(count):
+        note = f'line one\nline "two" of {number}' if number % 3 == 0 else f'plain, {number}'
+        rows.append([str(number), ['Seattle', 'Tacoma', 'Spokane'][number % 3], note])
+    return rows
+
+
+def write_source(path, rows, header=HEADER):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return str(path)
+
+
+def table_rows_of(chunk):
+    with open(chunk, newline='') as f:
+        return list(csv.reader(f))[1:]
+
+
+def table_rows(table_path):
+    chunks = [os.path.join(table_path, name) for name in csv_file.get_ordered_chunk_files(table_path)]
+    rows = []
+    for chunk in chunks:
+        with open(chunk, newline='') as f:
+            assert next(csv.reader(f)) == HEADER
+        rows.extend(table_rows_of(chunk))
+    return chunks, rows
+
+
+@pytest.fixture
+def db(workdir):
+    (workdir / 'database' / 'db').mkdir()
+    return workdir / 'database' / 'db'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1000])
+def test_ranges_end_on_row_boundaries(workdir, chunk_size):
+    rows = make_rows(50)
+    source = write_source(workdir / 'source.csv', rows)
+    with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header, start = loader.read_header(mm)
+        ranges = list(loader.byte_ranges(mm, start, chunk_size))
+        assert header == HEADER
+        assert ranges[0][0] == start and ranges[-1][1] == len(mm)
+        assert all(end == next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:]))
+        parsed = []
+        for range_start, range_end in ranges:
+            parsed.extend(csv.reader(io.StringIO(mm[range_start:range_end].decode(), newline='')))
+    assert parsed == rows
+
+
+def test_load_splits_quoted_newlines_correctly(db, run):
+    rows = make_rows(300)
+    source = write_source(db / 'source.csv', rows)
+    run('load-tb', '--db=db', '--table=t', f'--source={source}', '--chunk-size=2k', '--workers=1', '--index=city')
+
+    table_path = str(db / 't')
+    chunks, loaded = table_rows(table_path)
+    assert len(chunks) > 1
+    assert loaded == rows
+    for chunk in chunks:
+        # the row index written by the load is current and points at every row of its chunk
+        offsets, size, mtime_ns = row_index._read(row_index.index_path(chunk))
+        assert (size, mtime_ns) == (os.stat(chunk).st_size, os.stat(chunk).st_mtime_ns)
+        assert list(offsets) == list(row_index.scan_offsets(chunk))
+        assert [list(row.values()) for row in row_index.read_rows(chunk, 0)] == table_rows_of(chunk)
+    assert set(chunk_stats.fresh_entries(table_path)) == set(chunks)
+    assert sum(entry["rows"] for entry in chunk_stats.fresh_entries(table_path).values()) == len(rows)
+
+    result = run('filter-tb', '--db=db', '--table=t', '--conditions={"city": {"operator": "eq", "value": "Tacoma"}}',
+                 '--save=no')
+    matched = [row for row in csv.reader(io.StringIO(result.output)) if row != HEADER]
+    # filter-tb goes through the chunks in directory order
+    assert sorted(matched, key=lambda row: int(row[0])) == [row for row in rows if row[1] == 'Tacoma']
+
+
+def test_parallel_load_matches_serial(db, run):
+    rows = make_rows(300)
+    source = write_source(db / 'source.csv', rows)
+    run('load-tb', '--db=db', '--table=serial', f'--source={source}', '--chunk-size=1k', '--workers=1')
+    run('load-tb', '--db=db', '--table=parallel', f'--source={source}', '--chunk-size=1k', '--workers=2')
+    assert table_rows(str(db / 'serial'))[1] == table_rows(str(db / 'parallel'))[1] == rows
+    assert len(table_rows(str(db / 'serial'))[0]) == len(table_rows(str(db / 'parallel'))[0])
+
+
+def test_header_only_source(db, run):
+    source = write_source(db / 'source.csv', [])
+    run('load-tb', '--db=db', '--table=t', f'--source={source}', '--workers=1')
+    chunks, loaded = table_rows(str(db / 't'))
+    assert len(chunks) == 1 and loaded == []
+
+
+def test_failed_replace_keeps_table(db, run):
+    rows = make_rows(100)
+    good = write_source(db / 'good.csv', rows)
+    run('load-tb', '--db=db', '--table=t', f'--source={good}', '--chunk-size=1k', '--workers=1')
+    before = table_rows(str(db / 't'))
+
+    bad = write_source(db / 'bad.csv', make_rows(100) + [['1', 'Seattle', 'note', 'one field too many']])
+    result = run('load-tb', '--db=db', '--table=t', f'--source={bad}', '--chunk-size=1k', '--workers=1',
+                 '--replace', ok=False)
+    assert result.exit_code == 1
+    assert table_rows(str(db / 't')) == before
+    assert not os.path.exists(db / 't' / loader.STAGING_DIR)
+
+    replacement = make_rows(10)
+    run('load-tb', '--db=db', '--table=t', f'--source={write_source(db / "small.csv", replacement)}',
+        '--workers=1', '--replace')
+    assert table_rows(str(db / 't'))[1] == replacement
+
+
+def test_existing_table_needs_replace(db, run):
+    source = write_source(db / 'source.csv', make_rows(10))
+    run('load-tb', '--db=db', '--table=t', f'--source={source}', '--workers=1')
+    result = run('load-tb', '--db=db', '--table=t', f'--source={source}', '--workers=1', ok=False)
+    assert result.exit_code == 1 and '--replace' in result.output
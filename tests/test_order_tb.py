@@ -0,0 +1,48 @@
+import csv
+import random
+
+import csv_file
+import ordering
+import spill
+
+
+def test_csv_sort_by_typed_columns(workdir):
+    path = workdir / 'chunk_1.csv'
+    rows = [[str(value % 13) if value % 10 else '', f"name {value % 5}", str(value)] for value in range(2000)]
+    random.Random(3).shuffle(rows)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['size', 'name', 'row'])
+        writer.writerows(rows)
+
+    spill.set_memory_limit('4k')
+    try:
+        order = ordering.parse_order('name desc, size asc')
+        fieldnames, ordered = csv_file.sorted_rows([str(path)], order)
+        ordered = list(ordered)
+    finally:
+        spill.set_memory_limit(None)
+
+    assert fieldnames == ['size', 'name', 'row']
+    # numbers compare by value, empty sizes go last, ties keep their table order
+    expected = sorted(rows, key=lambda row: (row[0] == '', float(row[0] or 0)))
+    expected = sorted(expected, key=lambda row: row[1], reverse=True)
+    assert ordered == expected
+
+
+def test_order_tb_across_chunks(workdir, run):
+    table = workdir / 'database' / 'db' / 'cars'
+    table.mkdir(parents=True)
+    rows = [['TESLA', '2020', '308'], ['FORD', '2022', ''], ['TESLA', '2019', '9'], ['KIA', '2021', '239'],
+            ['FORD', '2018', '100'], ['TESLA', '2020', '40']]
+    for number, part in enumerate((rows[:3], rows[3:]), 1):
+        with open(table / f'chunk_{number}.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Make', 'Model Year', 'Electric Range'])
+            writer.writerows(part)
+
+    result = run('order-tb', '--db=db', '--table=cars', '--column=Make desc, Electric Range', '--ascending=T',
+                 '--save=no')
+    assert list(csv.reader(result.output.splitlines()))[1:] == [
+        ['TESLA', '2019', '9'], ['TESLA', '2020', '40'], ['TESLA', '2020', '308'],
+        ['KIA', '2021', '239'], ['FORD', '2018', '100'], ['FORD', '2022', '']]
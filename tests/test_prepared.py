@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+import main
+import prepared
+
+PEOPLE = [{"id": n, "name": f"p{n}", "age": 20 + n} for n in range(1, 11)]
+QUERY = ('select-jval --db=db --table=people --where=\'{"age": {"operation": ">", "value": $age}}\' '
+         '--orderby=\'age desc\' --limit=\'$n\'')
+
+
+@pytest.fixture
+def people(workdir, run):
+    table_dir = workdir / 'database' / 'db' / 'people'
+    table_dir.mkdir(parents=True)
+    (table_dir / 'people.json').write_text(json.dumps(PEOPLE, indent=4))
+    run('prepare', '--name=older', QUERY)
+
+
+def execute(run, *params, ok=True):
+    return run('execute', '--name=older', *(f'--param={param}' for param in params), ok=ok)
+
+
+def records(output):
+    return json.loads(output[output.index('['):])
+
+
+def test_execute_binds_values(people, run):
+    assert [record["id"] for record in records(execute(run, 'age=25', 'n=2').output)] == [10, 9]
+    # a second binding of the same statement
+    assert [record["id"] for record in records(execute(run, 'age=28.5', 'n=3').output)] == [10, 9]
+
+
+def test_prompted_options_get_defaults():
+    statement = prepared.Statement(main.cli, 'p', 'select-jval --db=db --table=people')
+    assert '--groupby=' in statement.args and '--where={}' in statement.args
+    with pytest.raises(ValueError, match="--db"):
+        prepared.Statement(main.cli, 'p', 'select-jval --table=people')
+
+
+@pytest.mark.parametrize('value', ['5}, "id": {"operation": ">", "value": 0', '[1]', '"5"', 'abc', 'NaN'])
+def test_bare_placeholder_takes_only_scalars(people, run, value):
+    result = execute(run, f'age={value}', 'n=2', ok=False)
+    assert result.exit_code == 1
+    assert "$age is a bare placeholder" in result.output
+
+
+@pytest.mark.parametrize('value, text', [('5', '5'), (' 2.5 ', '2.5'), ('true', 'true'), ('null', 'null')])
+def test_bare_value(value, text):
+    assert prepared.bare_value('n', value) == text
+
+
+def test_missing_and_unknown_parameters(people, run):
+    assert "Missing value for $n." in execute(run, 'age=25', ok=False).output
+    assert "Unknown parameter $x." in execute(run, 'age=25', 'n=1', 'x=2', ok=False).output
@@ -0,0 +1,82 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+from click.testing import CliRunner
+
+import main
+import server
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+RECORDS = [{"id": n, "text": "x" * 40} for n in range(1, 3001)]
+
+
+@pytest.fixture
+def daemon(workdir):
+    table_dir = workdir / 'database' / 'db' / 't'
+    table_dir.mkdir(parents=True)
+    (table_dir / 't.json').write_text(json.dumps(RECORDS))
+    # a short path: Unix socket paths are limited to about 100 characters
+    socket_path = f'/tmp/synthquery-test-{os.getpid()}.sock'
+    process = subprocess.Popen([sys.executable, MAIN, 'serve', f'--socket={socket_path}'], cwd=workdir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+        yield socket_path
+    finally:
+        process.terminate()
+        process.wait()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def test_prompted_options_get_defaults(daemon, run):
+    # --where, --groupby and --orderby would prompt, the daemon fills in their defaults
+    result = run(f'--socket={daemon}', 'select-jval', '--db=db', '--table=t', '--output-format=ndjson')
+    lines = [line for line in result.output.splitlines() if line.startswith('{')]
+    assert [json.loads(line) for line in lines] == RECORDS
+
+
+def test_option_without_default_runs_locally(daemon):
+    # the client asks for --db itself
+    result = CliRunner().invoke(main.cli, [f'--socket={daemon}', 'get-jval', '--table=t', '--id=2'], input='db\n')
+    assert result.exit_code == 0, result.output
+    assert "would prompt for" in result.output and "Running locally." in result.output
+    assert json.loads(result.output[result.output.index('{'):]) == RECORDS[1]
+
+
+def test_exit_code_and_stderr(daemon, run):
+    result = run(f'--socket={daemon}', 'get-jval', '--db=db', '--table=t', '--id=9999', ok=False)
+    assert result.exit_code == 1 and "No record with id 9999." in result.output
+
+
+def test_output_is_sent_in_chunks(tmp_path):
+    left, right = socket.socketpair()
+    with left, right:
+        stream = server.MessageStream(left, "stdout", chunk_chars=100)
+        for n in range(30):
+            stream.write(f"{n:09d}\n")
+        stream.flush()
+        left.shutdown(socket.SHUT_WR)
+        with right.makefile('rb') as replies:
+            messages = [json.loads(line) for line in replies]
+    assert len(messages) == 3
+    assert ''.join(message["stdout"] for message in messages) == ''.join(f"{n:09d}\n" for n in range(30))
+    with pytest.raises(TypeError):
+        stream.write(b"bytes")
+
+
+def test_with_prompt_defaults():
+    given = ['--memory-limit', '1g', 'filter-tb', '--db=db', '--table', 't', '--conditions={}']
+    args = server.with_prompt_defaults(main.cli, given)
+    assert args[:7] == given
+    assert '--save=no' in args[7:] and not any(arg.startswith('--table') for arg in args[7:])
+    with pytest.raises(ValueError, match="--db"):
+        server.with_prompt_defaults(main.cli, ['filter-tb', '--table=t'])
@@ -0,0 +1,77 @@
+import json
+import os
+
+import pytest
+
+import compact
+import json_split
+import snapshot
+
+RECORDS = [{"id": n, "name": f"name {n}", "group": n % 3} for n in range(500)]
+
+
+@pytest.fixture
+def table(workdir):
+    path = workdir / 't.json'
+    path.write_text(json.dumps(RECORDS))
+    yield str(path)
+    snapshot.set_limit(None)
+
+
+def snapshots():
+    if not os.path.isdir(snapshot.SNAPSHOT_DIR):
+        return []
+    return sorted(name for name in os.listdir(snapshot.SNAPSHOT_DIR) if name.endswith('.snap'))
+
+
+def test_snapshot_is_used_until_the_file_changes(table, monkeypatch):
+    assert list(compact.load(table)) == RECORDS
+    assert snapshots() == [os.path.basename(snapshot.snapshot_path(table))]
+
+    # the second load comes from the snapshot, the file is not parsed again
+    def no_parse(path):
+        raise AssertionError("parsed again")
+    with monkeypatch.context() as patched:
+        patched.setattr(json_split, 'iter_array', no_parse)
+        assert list(compact.load(table)) == RECORDS
+
+    changed = RECORDS + [{"id": 500, "name": "new", "group": 2}]
+    with open(table, 'w') as f:
+        json.dump(changed, f)
+    assert snapshot.load(table) is None
+    assert list(compact.load(table)) == changed
+
+
+def test_limit_zero_turns_snapshots_off(table, run):
+    snapshot.set_limit('0')
+    assert not snapshot.enabled()
+    compact.load(table)
+    assert snapshots() == []
+
+    table_dir = os.path.join('database', 'db', 'people')
+    os.makedirs(table_dir)
+    with open(os.path.join(table_dir, 'people.json'), 'w') as f:
+        json.dump(RECORDS, f)
+    run('--snapshot-limit=0', 'select-jval', '--db=db', '--table=people', '--where={}', '--groupby=', '--orderby=')
+    assert snapshots() == []
+    run('select-jval', '--db=db', '--table=people', '--where={}', '--groupby=', '--orderby=')
+    assert len(snapshots()) == 1
+
+
+def test_least_recently_used_snapshots_are_evicted(table, workdir):
+    paths = []
+    for number in range(3):
+        path = str(workdir / f'p{number}.json')
+        with open(path, 'w') as f:
+            json.dump(RECORDS, f)
+        paths.append(path)
+    compact.load(paths[0])
+    size = os.path.getsize(snapshot.snapshot_path(paths[0]))
+    snapshot.set_limit(f"{(2 * size + size // 2) / 1024}k")
+
+    compact.load(paths[1])
+    # using the first snapshot makes the second the least recently used one
+    os.utime(snapshot.snapshot_path(paths[1]), ns=(1, 1))
+    assert snapshot.load(paths[0]) is not None
+    compact.load(paths[2])
+    assert snapshots() == sorted(os.path.basename(snapshot.snapshot_path(path)) for path in (paths[0], paths[2]))
@@ -0,0 +1,87 @@
+import csv
+import io
+import json
+
+import pytest
+
+import id_index
+import text_index
+
+UTILITIES = ["PUGET SOUND ENERGY INC", "CITY OF SEATTLE - (WA)", "PACIFICORP", "Puget Sound Energy",
+             "BONNEVILLE POWER ADMINISTRATION||CITY OF TACOMA", "", None, 42]
+QUERIES = [("contains", "SOUND"), ("contains", "Sound"), ("contains", "OF"), ("contains", "x"),
+           ("contains", "CORP"), ("match", "puget energy"), ("match", "city tacoma"), ("match", "seattle power"),
+           ("match", "42"), ("match", "")]
+
+
+@pytest.fixture
+def jsonl(tmp_path):
+    path = tmp_path / 't.jsonl'
+    with open(path, 'w') as f:
+        for number in range(200):
+            f.write(json.dumps({"id": number, "utility": UTILITIES[number % len(UTILITIES)]}) + '\n')
+    return str(path)
+
+
+def open_index(tmp_path, path):
+    return text_index.TextIndex(str(tmp_path), [path], "utility", id_index.iter_offsets,
+                                lambda record: record.get("utility"))
+
+
+def scanned(path, operator, text):
+    ''' the locations a full scan finds '''
+    return {(0, offset) for offset, record in id_index.iter_offsets(path)
+            if text_index.OPERATORS[operator](record.get("utility"), text)}
+
+
+@pytest.mark.parametrize('operator, text', QUERIES)
+def test_search_matches_a_scan(tmp_path, jsonl, operator, text):
+    assert open_index(tmp_path, jsonl).search(operator, text) == scanned(jsonl, operator, text)
+
+
+def test_appends_patch_and_other_changes_rebuild(tmp_path, jsonl):
+    index = open_index(tmp_path, jsonl)
+    index.save()
+    with open(jsonl, 'a') as f:
+        offset = f.tell()
+        f.write(json.dumps({"id": 200, "utility": "Tacoma Power"}) + '\n')
+    index.add({"utility": "Tacoma Power"}, jsonl, offset)
+    index.stamp(jsonl)
+    index.save()
+
+    reopened = open_index(tmp_path, jsonl)
+    assert reopened.fresh() and not reopened.dirty
+    assert reopened.search("match", "tacoma") == scanned(jsonl, "match", "tacoma")
+
+    # a change the index was not told about
+    with open(jsonl, 'a') as f:
+        f.write(json.dumps({"id": 201, "utility": "tacoma"}) + '\n')
+    rebuilt = open_index(tmp_path, jsonl)
+    assert rebuilt.dirty
+    assert rebuilt.search("match", "tacoma") == scanned(jsonl, "match", "tacoma")
+
+
+def filtered_ids(run, conditions):
+    output = run('filter-tb', '--db=db', '--table=ev', f'--conditions={json.dumps(conditions)}', '--save=no').output
+    rows = csv.DictReader(io.StringIO(output))
+    return sorted(int(row["id"]) for row in rows if row["id"] != "id")
+
+
+def test_filter_tb_through_the_index(workdir, run):
+    (workdir / 'database' / 'db').mkdir()
+    with open(workdir / 'ev.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "utility"])
+        writer.writerows([number, UTILITIES[number % 6]] for number in range(300))
+    run('load-tb', '--db=db', '--table=ev', '--source=ev.csv', '--chunk-size=2k')
+    conditions = {"utility": {"operator": "match", "value": "puget energy"}}
+    without_index = filtered_ids(run, conditions)
+
+    run('create-index-tb', '--db=db', '--table=ev', '--column=utility')
+    assert text_index.exists('database/db/ev', 'utility')
+    assert filtered_ids(run, conditions) == without_index
+    run('ins-cval', '--db=db', '--table=ev', '--values={"id": "300", "utility": "Puget Sound Energy"}')
+    assert filtered_ids(run, conditions) == without_index + [300]
+
+    run('create-index-tb', '--db=db', '--table=ev', '--column=utility', '--drop')
+    assert not text_index.exists('database/db/ev', 'utility')
@@ -0,0 +1,135 @@
+import importlib
+import json
+import os
+import random
+import sys
+import time
+
+import pytest
+
+PROJECT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Project')
+# modules of the web app that share their names with the CLI modules
+WEB_MODULES = ('main', 'csv_file', 'json_file', 'cursors', 'executor', 'prepared')
+
+
+@pytest.fixture
+def web(workdir):
+    ''' the web app's main module (Project/), imported in place of the CLI modules of the same names '''
+    (workdir / 'Project').mkdir()
+    os.chdir(workdir / 'Project')
+    saved = {name: sys.modules.pop(name) for name in WEB_MODULES if name in sys.modules}
+    sys.path.insert(0, PROJECT)
+    try:
+        yield importlib.import_module('main')
+    finally:
+        sys.path.remove(PROJECT)
+        for name in WEB_MODULES:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+
+
+def shuffled(count, seed=7):
+    numbers = list(range(count))
+    random.Random(seed).shuffle(numbers)
+    return numbers
+
+
+def test_page_tokens(web):
+    cursors = web.cursors
+    client = web.app.test_client()
+    token = cursors.open_cursor(({"n": n} for n in range(250)), 'python main.py filter-tb --db=db --table=t',
+                                'csv_results.html')
+
+    assert client.get(f'/page/{token}?size=100').status_code == 200
+    # a reload shows the same page again
+    assert client.get(f'/page/{token}?size=100').status_code == 200
+    rows, offset, second = cursors.fetch_page(token, 100)
+    assert offset == 0 and rows[0] == {"n": 0} and second
+
+    rows, offset, third = cursors.fetch_page(second, 100)
+    assert offset == 100 and rows[0] == {"n": 100}
+    # the first page was not kept once the second one was read
+    assert client.get(f'/page/{token}?size=100').status_code == 410
+
+    rows, offset, last = cursors.fetch_page(third, 100)
+    assert offset == 200 and len(rows) == 50 and last is None
+    assert cursors.fetch_page(third, 100)[0] == rows
+    assert client.get('/page/unknown.0').status_code == 404
+    assert client.get(f'/page/{token.partition(".")[0]}.999').status_code == 410
+
+
+def test_sort_runs_keep_types_and_keys(web):
+    rows = [{"n": n, "label": str(n)} if n % 3 else {"n": n, "extra": [n]} for n in shuffled(1200)]
+    ascending = list(web.cf.iter_external_sort(iter(rows), "n", True, chunk_size=100))
+    assert ascending == sorted(rows, key=lambda row: row["n"])
+    descending = list(web.cf.iter_external_sort(iter(rows), "n", False, chunk_size=100))
+    assert [row["n"] for row in descending] == sorted((row["n"] for row in rows), reverse=True)
+
+
+def test_groupby_aggregates_per_group(web):
+    rows = [{"Make": "ABC"[n % 3], "Range": str(n) if n % 4 else "n/a", "Name": "x"} for n in shuffled(600)]
+    by_make = {}
+    for row in rows:
+        if row["Range"] != "n/a":
+            by_make.setdefault(row["Make"], []).append(float(row["Range"]))
+
+    for agg, expected in (("count", len), ("sum", sum), ("min", min), ("max", max),
+                          ("mean", lambda values: sum(values) / len(values))):
+        result = {row["Group"]: row for row in web.cf.groupby_aggregate(iter(rows), "Make", agg)}
+        assert {make: row["Range"] for make, row in result.items()} == \
+            {make: expected(values) for make, values in by_make.items()}
+        assert all("Name" not in row for row in result.values())
+
+
+def people_table(workdir):
+    (workdir / 'database' / 'db').mkdir()
+    # the web engine checks ../database/db but reads its tables under Project/database
+    table_dir = workdir / 'Project' / 'database' / 'db' / 'people'
+    table_dir.mkdir(parents=True)
+    (table_dir / 'people.json').write_text(json.dumps([{"id": n, "age": 20 + n} for n in range(1, 6)]))
+
+
+def test_prepared_bare_values(web, workdir, monkeypatch):
+    people_table(workdir)
+    monkeypatch.setattr(web.executor, 'WAIT_SECONDS', 10)
+    client = web.app.test_client()
+    query = 'python main.py filter-jval --db=db --table=people --criteria=\'{"age":$age}\''
+    assert client.post('/prepare', data={"name": "aged", "query": query}).status_code == 201
+
+    response = client.get('/execute/aged?age=23')
+    assert response.status_code == 200 and b'"id": 3' in response.data
+    for value in ('23,"id":1', '[23]', '"23"', 'x'):
+        response = client.get('/execute/aged', query_string={"age": value})
+        assert response.status_code == 400 and "bare placeholder" in response.get_json()["error"]
+
+
+QUERY = 'python main.py filter-jval --db=db --table=people --criteria={"age":23}'
+
+
+def test_unfinished_job_is_answered_with_its_id(web, workdir, monkeypatch):
+    people_table(workdir)
+    client = web.app.test_client()
+    monkeypatch.setattr(web.executor, 'WAIT_SECONDS', 0)
+    response = client.post('/results', data={"query": QUERY})
+    assert response.status_code == 202
+    job = response.get_json()
+    assert job["result"] == f'/result/{job["id"]}'
+
+    for _ in range(200):
+        if client.get(job["status"]).get_json()["state"] not in ("queued", "running"):
+            break
+        time.sleep(0.05)
+    response = client.get(job["result"])
+    assert response.status_code == 200 and b'"id": 3' in response.data
+
+
+def test_evicted_job_is_gone(web, workdir, monkeypatch):
+    people_table(workdir)
+    client = web.app.test_client()
+    # finished jobs are evicted as soon as they finish
+    monkeypatch.setattr(web.executor, 'KEEP_FINISHED', 0)
+    monkeypatch.setattr(web.executor, 'WAIT_SECONDS', 10)
+    response = client.post('/results', data={"query": QUERY})
+    assert response.status_code == 410 and "evicted" in response.get_json()["error"]
+    assert client.get(f'/result/{response.get_json()["id"]}').status_code == 404
+    assert web.executor.wait("unknown", timeout=0) == (None, None)
@@ -0,0 +1,254 @@
+'''
+inverted text index on one string field of a CSV or JSON table, for the contains (substring) and
+match (every word) operators. The distinct values of the field each get a posting list of the
+locations holding them; the lowercase words and character trigrams of every distinct value point
+at the values containing them. A lookup intersects the postings of the words / trigrams of the
+query, checks the few candidate values exactly and returns the union of their locations, so
+repeated values (Make, Model, Electric Utility, job_title) are matched once, not once per row.
+stored as table/.field_index/<field>.text next to the other indexes, with the (size, mtime_ns)
+stamps of the files it covers: appends patch it, other changes get it rebuilt on next use.
+'''
+import os
+import re
+import json
+import pickle
+from urllib.parse import quote, unquote
+
+import table_cache
+
+INDEX_DIR = '.field_index'
+WORD = re.compile(r'\w+')
+GRAM = 3
+
+
+def text_of(value):
+    ''' the text a field value is searched as, None for a null / missing value '''
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, sort_keys=True)
+
+
+def words(text):
+    return set(WORD.findall(text.lower()))
+
+
+def grams(text):
+    text = text.lower()
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+def contains(value, text):
+    value = text_of(value)
+    return value is not None and text in value
+
+
+def match(value, text):
+    ''' every word of text appears as a word of value, ignoring case; an empty query matches nothing '''
+    value = text_of(value)
+    query = words(text)
+    return value is not None and bool(query) and query <= words(value)
+
+
+OPERATORS = {"contains": contains, "match": match}
+
+
+def index_path(table_dir, field):
+    return os.path.join(table_dir, INDEX_DIR, f"{quote(field, safe='')}.text")
+
+
+def exists(table_dir, field):
+    return os.path.exists(index_path(table_dir, field))
+
+
+def declared(table_dir):
+    ''' the fields with a text index in the table '''
+    directory = os.path.join(table_dir, INDEX_DIR)
+    if not os.path.isdir(directory):
+        return []
+    return [unquote(name[:-len('.text')]) for name in sorted(os.listdir(directory)) if name.endswith('.text')]
+
+
+def drop(table_dir, field):
+    if not exists(table_dir, field):
+        return False
+    os.remove(index_path(table_dir, field))
+    return True
+
+
+class TextIndex:
+    '''
+    scan(path) yields (offset, record) for every record of a table file, value_of(record) is the
+    indexed value; locations are (file number, offset)
+    '''
+
+    def __init__(self, table_dir, paths, field, scan, value_of, postings=None):
+        self.path = index_path(table_dir, field)
+        self.table_dir = table_dir
+        self.field = field
+        self.scan = scan
+        self.value_of = value_of
+        self.paths = list(paths)
+        self.names = [os.path.relpath(path, table_dir) for path in self.paths]
+        self.dirty = False
+        self.data = table_cache.get(self.path, _load) if os.path.exists(self.path) else None
+        self.shared = self.data is not None and table_cache.enabled()
+        if postings is not None or not self.fresh():
+            self.rebuild(postings)
+
+    def fresh(self):
+        return self.data is not None and self.data["files"] == self.names and all(
+            self.data["stamps"].get(name) == _stamp(path) for name, path in zip(self.names, self.paths))
+
+    def rebuild(self, postings=None):
+        '''
+        index every record of the files, or take postings, a {value: [offsets]} per file collected while
+        the files were written (load-tb), instead of scanning them
+        '''
+        self.shared = False
+        self.data = {"field": self.field, "files": list(self.names),
+                     "stamps": {name: _stamp(path) for name, path in zip(self.names, self.paths)},
+                     "values": [], "ids": {}, "locations": [], "words": {}, "grams": {}}
+        if postings is None:
+            for path in self.paths:
+                for offset, record in self.scan(path):
+                    self.add(record, path, offset)
+        else:
+            for file_number, by_value in enumerate(postings):
+                for value, offsets in by_value.items():
+                    text = text_of(value)
+                    if text is not None:
+                        self.data["locations"][self._value_id(text)].extend(
+                            (file_number, offset) for offset in offsets)
+        self.dirty = True
+
+    def _file_number(self, path):
+        if path not in self.paths:
+            # a file created by the change being recorded, e.g. a new chunk of ins-cval
+            self.paths.append(path)
+            self.names.append(os.path.relpath(path, self.table_dir))
+            self.data["files"].append(self.names[-1])
+        return self.paths.index(path)
+
+    def _own(self):
+        ''' copy data the table cache holds before changing it, so a change that fails never reaches the cache '''
+        if self.shared:
+            self.data = pickle.loads(pickle.dumps(self.data, pickle.HIGHEST_PROTOCOL))
+            self.shared = False
+
+    def add(self, record, path, offset):
+        self._own()
+        text = text_of(self.value_of(record))
+        location = (self._file_number(path), offset)
+        self.dirty = True
+        if text is None:
+            return
+        self.data["locations"][self._value_id(text)].append(location)
+
+    def _value_id(self, text):
+        value_id = self.data["ids"].get(text)
+        if value_id is None:
+            value_id = self.data["ids"][text] = len(self.data["values"])
+            self.data["values"].append(text)
+            self.data["locations"].append([])
+            for word in words(text):
+                self.data["words"].setdefault(word, set()).add(value_id)
+            for gram in grams(text):
+                self.data["grams"].setdefault(gram, set()).add(value_id)
+        return value_id
+
+    def remove(self, record, path, offset):
+        self._own()
+        text = text_of(self.value_of(record))
+        value_id = self.data["ids"].get(text) if text is not None else None
+        if value_id is not None:
+            location = (self._file_number(path), offset)
+            if location in self.data["locations"][value_id]:
+                self.data["locations"][value_id].remove(location)
+        self.dirty = True
+
+    def stamp(self, path):
+        self._own()
+        self.data["stamps"][self.names[self._file_number(path)]] = _stamp(path)
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self.data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.path)
+        self.dirty = False
+
+    def search(self, operator, text):
+        ''' set of locations whose value satisfies OPERATORS[operator](value, text) '''
+        if operator == "match":
+            terms, postings = words(text), self.data["words"]
+        else:
+            terms, postings = grams(text), self.data["grams"]
+        if terms:
+            candidates = None
+            for term in sorted(terms, key=lambda term: len(postings.get(term, ()))):
+                candidates = set(postings.get(term, ())) if candidates is None else candidates & postings.get(term, set())
+                if not candidates:
+                    break
+        else:
+            # a query shorter than a trigram is checked against every distinct value
+            candidates = range(len(self.data["values"]))
+
+        check = OPERATORS[operator]
+        locations = set()
+        for value_id in candidates:
+            if check(self.data["values"][value_id], text):
+                locations.update(self.data["locations"][value_id])
+        return locations
+
+
+def text_conditions(table_dir, conditions):
+    '''
+    [(field, operator, text)] of the conditions a text index of the table can answer; conditions are
+    {field: {"operator" | "operation": "contains" | "match", "value": text}}
+    '''
+    found = []
+    for field, condition in conditions.items():
+        if not isinstance(condition, dict):
+            continue
+        operator = condition.get("operator", condition.get("operation"))
+        text = condition.get("value")
+        if operator in OPERATORS and isinstance(text, str) and exists(table_dir, field):
+            found.append((field, operator, text))
+    return found
+
+
+def candidates(table_dir, paths, conditions, scan, value_of):
+    '''
+    {path: sorted offsets} of the records the text indexes allow to satisfy conditions (all of them
+    narrow the set), None when no text index applies. value_of(record, field) reads a field
+    '''
+    lookups = text_conditions(table_dir, conditions)
+    if not lookups:
+        return None
+    found = None
+    for field, operator, text in lookups:
+        index = TextIndex(table_dir, paths, field, scan, lambda record, field=field: value_of(record, field))
+        locations = index.search(operator, text)
+        index.save()
+        found = locations if found is None else found & locations
+    by_path = {path: [] for path in paths}
+    for file_number, offset in sorted(found):
+        if file_number < len(paths):
+            by_path[paths[file_number]].append(offset)
+    return by_path
+
+
+def _load(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
@@ -0,0 +1,80 @@
+'''
+streaming result writers for the query commands (--output-format, --output): records are written
+one at a time through a buffered file as they are produced, never collected into one document.
+json is the indented array the commands have always printed, ndjson one compact record per line,
+csv a header taken from the first record followed by one row per record (later records missing a
+column leave it empty, columns the first record lacks are dropped, nested values are written as JSON)
+'''
+import sys
+import csv
+import json
+from contextlib import contextmanager
+
+FORMATS = ("json", "ndjson", "csv")
+BUFFER_SIZE = 1 << 20
+
+
+@contextmanager
+def open_output(path=None):
+    ''' a buffered text file for path, stdout (as redirected at the time) without one '''
+    if path is None:
+        yield sys.stdout
+        sys.stdout.flush()
+        return
+    with open(path, 'w', newline='', buffering=BUFFER_SIZE) as f:
+        yield f
+
+
+class RecordWriter:
+    def __init__(self, file, output_format="json"):
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown output format '{output_format}'")
+        self.file = file
+        self.format = output_format
+        self.count = 0
+        self.csv = None
+
+    def write(self, record):
+        if self.format == "ndjson":
+            self.file.write(json.dumps(record) + '\n')
+        elif self.format == "csv":
+            if not isinstance(record, dict):
+                record = {"value": record}
+            if self.csv is None:
+                self.csv = csv.DictWriter(self.file, fieldnames=list(record), extrasaction='ignore')
+                self.csv.writeheader()
+            self.csv.writerow({key: json.dumps(value) if isinstance(value, (list, dict)) else value
+                               for key, value in record.items()})
+        else:
+            entry = '\n'.join('    ' + line for line in json.dumps(record, indent=4).split('\n'))
+            self.file.write(("[\n" if self.count == 0 else ",\n") + entry)
+        self.count += 1
+
+    def close(self):
+        if self.format == "json":
+            self.file.write("[]\n" if self.count == 0 else "\n]\n")
+        return self.count
+
+
+def write_records(records, output_format="json", path=None):
+    ''' write a stream of records to path (stdout by default); returns how many were written '''
+    with open_output(path) as f:
+        writer = RecordWriter(f, output_format)
+        for record in records:
+            writer.write(record)
+        return writer.close()
+
+
+def write_groups(pairs, path=None):
+    '''
+    write (key, value) pairs as one indented JSON object, a group at a time; returns the group count
+    '''
+    count = 0
+    with open_output(path) as f:
+        for key, value in pairs:
+            # the indented entry without the braces of its own object
+            entry = json.dumps({key: value}, indent=4)[2:-2]
+            f.write(("{\n" if count == 0 else ",\n") + entry)
+            count += 1
+        f.write("{}\n" if count == 0 else "\n}\n")
+    return count